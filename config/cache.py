@@ -0,0 +1,68 @@
+import time
+
+from asgiref.sync import sync_to_async
+from django.core.cache import cache
+from django.core.cache.backends.db import DatabaseCache as BaseDatabaseCache
+from django.db import connections, router, transaction
+
+
+class DatabaseCache(BaseDatabaseCache):
+    """
+    Database cache whose incr() is atomic across processes.
+
+    The shared version counters rely on every bump returning a value no other
+    process got. Django's incr() is a separate get and set, so two processes could
+    both move a counter from 5 to 6.
+    """
+
+    def incr(self, key, delta=1, version=None):
+        db = router.db_for_write(self.cache_model_class)
+        connection = connections[db]
+        with transaction.atomic(using=db):
+            # Later increments of the key wait for this transaction. SQLite has no
+            # row locks, but its IMMEDIATE transactions already hold the write lock
+            if connection.features.has_select_for_update:
+                table = connection.ops.quote_name(self._table)
+                with connection.cursor() as cursor:
+                    cursor.execute(
+                        f"SELECT cache_key FROM {table} WHERE cache_key = %s FOR UPDATE",
+                        [self.make_and_validate_key(key, version=version)]
+                    )
+            return super().incr(key, delta, version)
+
+    async def aincr(self, key, delta=1, version=None):
+        return await sync_to_async(self.incr, thread_sensitive=True)(key, delta, version)
+
+
+# Version counters shared by every process through the default cache. Whatever is
+# cached from some data is keyed by the data's version, so bumping the version
+# makes all of it stale at once.
+
+def get_version(key):
+    """Current value of a version counter, created if missing"""
+    version = cache.get(key)
+    if version is None:
+        # Start from the clock rather than 0, so a counter that was evicted never
+        # repeats a version that something is still cached under
+        cache.add(key, time.time_ns(), timeout=None)
+        version = cache.get(key, 0)
+    return version
+
+
+async def aget_version(key):
+    """Async version of get_version()"""
+    version = await cache.aget(key)
+    if version is None:
+        await cache.aadd(key, time.time_ns(), timeout=None)
+        version = await cache.aget(key, 0)
+    return version
+
+
+def bump_version(key):
+    """Increment a version counter and return its new value"""
+    try:
+        return cache.incr(key)
+    except ValueError:
+        # Key is missing or was evicted
+        cache.add(key, time.time_ns(), timeout=None)
+        return cache.incr(key)
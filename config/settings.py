@@ -13,6 +13,8 @@ https://docs.djangoproject.com/en/5.2/ref/settings/
 from pathlib import Path
 import os
 
+from django.core.exceptions import ImproperlyConfigured
+
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
 
@@ -83,12 +85,75 @@ WSGI_APPLICATION = 'config.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/5.2/ref/settings/#databases
 
-DATABASES = {
-    'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': BASE_DIR / 'db.sqlite3',
+# SQLite by default. Set DATABASE_ENGINE=postgresql for the production profile,
+# configured through the POSTGRES_* variables below. The test suite runs against
+# either: DATABASE_ENGINE=postgresql python manage.py test
+
+def env_flag(name, default=False):
+    return os.environ.get(name, str(default)).lower() in ('1', 'true', 'yes', 'on')
+
+DATABASE_ENGINE = os.environ.get('DATABASE_ENGINE', 'sqlite')
+
+if DATABASE_ENGINE == 'postgresql':
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.postgresql',
+            'NAME': os.environ.get('POSTGRES_DB', 'therapists'),
+            'USER': os.environ.get('POSTGRES_USER', 'postgres'),
+            'PASSWORD': os.environ.get('POSTGRES_PASSWORD', ''),
+            'HOST': os.environ.get('POSTGRES_HOST', 'localhost'),
+            'PORT': os.environ.get('POSTGRES_PORT', '5432'),
+            # Keep connections open between requests of a worker process, and check
+            # them before reuse so a restarted server does not fail the next request
+            'CONN_MAX_AGE': int(os.environ.get('DATABASE_CONN_MAX_AGE', 60)),
+            'CONN_HEALTH_CHECKS': True,
+            # Large scans use QuerySet.iterator(), which streams through server-side
+            # cursors. Disable them behind a transaction-mode pooler such as PgBouncer.
+            'DISABLE_SERVER_SIDE_CURSORS': env_flag('DATABASE_DISABLE_SERVER_SIDE_CURSORS'),
+        }
     }
-}
+elif DATABASE_ENGINE == 'sqlite':
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': os.environ.get('SQLITE_PATH', BASE_DIR / 'db.sqlite3'),
+            'OPTIONS': {
+                # Take the write lock when a transaction starts, so concurrent survey
+                # writes wait for each other instead of failing with "database is locked"
+                'transaction_mode': 'IMMEDIATE',
+            },
+        }
+    }
+else:
+    raise ImproperlyConfigured(f"Unsupported DATABASE_ENGINE: {DATABASE_ENGINE}")
+
+
+# Cache
+# Shared by every web and match worker process: version counters kept in it tell
+# each process when the therapist pool, the criterion catalog and the therapist
+# catalog changed. The database cache needs `python manage.py createcachetable`;
+# set CACHE_BACKEND=redis and REDIS_URL (requires the redis package) to use Redis.
+
+CACHE_BACKEND = os.environ.get('CACHE_BACKEND', 'database')
+
+if CACHE_BACKEND == 'redis':
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': os.environ.get('REDIS_URL', 'redis://localhost:6379/0'),
+        }
+    }
+elif CACHE_BACKEND == 'database':
+    CACHES = {
+        'default': {
+            'BACKEND': 'config.cache.DatabaseCache',
+            'LOCATION': 'django_cache',
+            # Room for the cached catalog pages and facet counts
+            'OPTIONS': {'MAX_ENTRIES': 10000},
+        }
+    }
+else:
+    raise ImproperlyConfigured(f"Unsupported CACHE_BACKEND: {CACHE_BACKEND}")
 
 
 # Password validation
@@ -152,6 +217,29 @@ LOGIN_URL = 'users:login'
 LOGIN_REDIRECT_URL = 'users:client_account'
 LOGOUT_REDIRECT_URL = 'users:login'
 
+# Matching settings
+# Number of best-ranked therapists stored per client (None stores the whole pool)
+MATCHING_TOP_K = 20
+# Number of matches shown on the client account page and returned per request
+# by the matches endpoint ("load more")
+MATCHING_PAGE_SIZE = 6
+# Capture a MatchTrace of every matching run shown on debug pages; staff users can
+# also ask for one per request with ?trace=1
+MATCHING_TRACE = False
+# Rankings cached by client score vector and therapist pool version. Use
+# matching.ranking_cache.DjangoCacheRankingCache (OPTIONS: alias, timeout) to share
+# the cache between processes
+MATCHING_RANKING_CACHE = {
+    'BACKEND': 'matching.ranking_cache.LRURankingCache',
+    'OPTIONS': {'max_entries': 1024},
+}
+
+# Therapist catalog settings
+# Seconds an unused catalog page stays cached for anonymous visitors. Pages are
+# keyed by the catalog version in the shared cache, so a catalog change makes
+# them stale in every process at once, not when they expire
+CATALOG_PAGE_CACHE_TIMEOUT = 3600
+
 # Messages framework
 from django.contrib.messages import constants as messages
 MESSAGE_TAGS = {
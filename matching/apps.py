@@ -4,3 +4,7 @@ from django.apps import AppConfig
 class MatchingConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'matching'
+
+    def ready(self):
+        # Keep the therapist score index in sync with score, user and criterion changes
+        from . import signals  # noqa: F401
@@ -0,0 +1,278 @@
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from django.conf import settings
+
+from users.models import User
+from .data_access import get_surveyed_clients, load_score_vectors, load_stored_rankings, save_rankings
+from .matching_algorithm import (
+    calculate_client_weights, calculate_pool_weight_table, rank_top_k,
+)
+
+# Relative change of a weight below which an otherwise unchanged ranking is not rewritten;
+# pages show scores with two decimals, so such changes are never visible
+STORED_WEIGHT_RTOL = 1e-3
+
+# Per-process copy of the therapist pool, set once per worker by _init_worker
+_worker_pool = {}
+
+
+def _init_worker(weight_table, therapist_scores, top_k):
+    _worker_pool['weight_table'] = weight_table
+    _worker_pool['therapist_scores'] = therapist_scores
+    _worker_pool['top_k'] = top_k
+
+
+def rank_clients(weight_table, therapist_scores, client_scores, client_filled, top_k=None):
+    """
+    Rank the therapist pool for a block of clients.
+
+    Returns:
+        tuple: (order, ranked_weights), both of shape (n_clients, min(top_k, n_therapists))
+            - order: therapist positions in order of preference for each client
+            - ranked_weights: the corresponding weights
+    """
+    weights = calculate_client_weights(weight_table, client_scores, therapist_scores, client_filled)
+    order = rank_top_k(weights, top_k)
+    return order, np.take_along_axis(weights, order, axis=1)
+
+
+def _rank_chunk(chunk):
+    client_ids, client_scores, client_filled = chunk
+    order, ranked_weights = rank_clients(
+        _worker_pool['weight_table'], _worker_pool['therapist_scores'], client_scores, client_filled,
+        top_k=_worker_pool['top_k'],
+    )
+    return client_ids, order, ranked_weights
+
+
+class BatchRematcher:
+    """
+    Recompute the rankings of many clients against one therapist pool snapshot.
+
+    The pool is reduced to a per-criterion weight table once; each chunk of clients
+    is then ranked with a vectorized clients x therapists x criteria computation,
+    optionally spread over a ProcessPoolExecutor. Workers only do NumPy work;
+    results are written back by the calling process.
+    """
+
+    def __init__(self, pool_snapshot, chunk_size=500, workers=1, top_k=None):
+        self.pool = pool_snapshot
+        self.chunk_size = chunk_size
+        self.workers = workers
+        self.top_k = top_k
+        self.therapist_ids = pool_snapshot.therapist_ids
+        self.therapist_scores = pool_snapshot.scores.astype(np.int64)
+        self.weight_table = calculate_pool_weight_table(pool_snapshot.score_histograms)
+
+    def load_clients(self, start_after=None):
+        """Scores of all surveyed clients, in client id order, optionally after a given id"""
+        clients = get_surveyed_clients()
+        if start_after is not None:
+            clients = clients.filter(pk__gt=start_after)
+        matrix = load_score_vectors(clients, criterion_ids=self.pool.criterion_ids)
+        # Clients without any score have nothing to be matched on
+        has_scores = np.any(matrix.filled, axis=1)
+        return matrix._replace(
+            user_ids=matrix.user_ids[has_scores],
+            scores=matrix.scores[has_scores],
+            filled=matrix.filled[has_scores],
+        )
+
+    def iter_chunks(self, clients):
+        for start in range(0, len(clients.user_ids), self.chunk_size):
+            rows = slice(start, start + self.chunk_size)
+            yield clients.user_ids[rows], clients.scores[rows], clients.filled[rows]
+
+    def iter_rankings(self, clients):
+        """
+        Yield (client_ids, order, ranked_weights) per chunk, in client id order.
+        """
+        if len(self.therapist_ids) == 0:
+            return
+        chunks = self.iter_chunks(clients)
+        if self.workers <= 1:
+            _init_worker(self.weight_table, self.therapist_scores, self.top_k)
+            yield from map(_rank_chunk, chunks)
+            return
+
+        with ProcessPoolExecutor(
+            max_workers=self.workers,
+            initializer=_init_worker,
+            initargs=(self.weight_table, self.therapist_scores, self.top_k),
+        ) as executor:
+            yield from executor.map(_rank_chunk, chunks)
+
+    def save_rankings(self, client_ids, order, ranked_weights):
+        """Store the rankings of a chunk of clients in one transaction"""
+        save_rankings(
+            client_ids.tolist(), self.therapist_ids[order].tolist(), ranked_weights.tolist(),
+            pool_size=len(self.therapist_ids),
+        )
+
+
+def rematch_ranked_clients(pool, top_k=None, chunk_size=1000, on_chunk=None):
+    """
+    Recompute every stored ranking against a therapist pool snapshot.
+
+    Args:
+        on_chunk: optional callable, called without arguments after each chunk of clients is saved
+
+    Returns:
+        int: number of clients rematched
+    """
+    if top_k is None:
+        top_k = settings.MATCHING_TOP_K
+    clients = load_score_vectors(
+        User.objects.filter(matching_result_set__isnull=False), criterion_ids=pool.criterion_ids
+    )
+    rematcher = BatchRematcher(pool, chunk_size=chunk_size, top_k=top_k)
+    for client_ids, order, ranked_weights in rematcher.iter_rankings(clients):
+        rematcher.save_rankings(client_ids, order, ranked_weights)
+        if on_chunk is not None:
+            on_chunk()
+    return len(clients.user_ids)
+
+
+def _same_ranking(stored_ids, stored_weights, ranked_ids, ranked_weights):
+    """Whether a stored ranking (padded with -1) lists the same therapists with close enough weights."""
+    n_stored = int(np.sum(stored_ids >= 0))
+    return (
+        n_stored == len(ranked_ids)
+        and np.array_equal(stored_ids[:n_stored], ranked_ids)
+        and np.allclose(stored_weights[:n_stored], ranked_weights, rtol=STORED_WEIGHT_RTOL, atol=0)
+    )
+
+
+def rematch_after_therapist_update(therapist_id, old_pool, new_pool, top_k=None, chunk_size=1000, on_chunk=None):
+    """
+    Update every stored ranking after one therapist changed their scores, joined or left the pool.
+
+    The pool's per-criterion score histograms are patched with the therapist's
+    old -> new scores, giving the weight tables before and after the change. For
+    each client only the stored top therapists and the updated therapist are
+    re-weighted. Every other therapist's weight can grow by at most the largest
+    entry of the table difference on the client's scores, so when the new k-th
+    weight stays above the old k-th weight plus that bound, no outsider can enter
+    and the re-ranked candidates are exact. Clients failing the check are
+    recomputed against the whole pool. Only clients whose ranked therapists or
+    weights differ from the stored ranking are written.
+
+    Stored rankings are assumed to be up to date with the pool before the change,
+    with weights within STORED_WEIGHT_RTOL of their exact values.
+
+    Args:
+        therapist_id: ID of the therapist whose scores changed
+        old_pool: score index snapshot taken before the change
+        new_pool: score index snapshot taken after the change
+        top_k: number of best therapists stored per client; settings.MATCHING_TOP_K if None
+        on_chunk: optional callable, called without arguments after each chunk of clients is done
+
+    Returns:
+        tuple: (patched, recomputed) numbers of clients
+    """
+    if top_k is None:
+        top_k = settings.MATCHING_TOP_K
+    if not np.array_equal(old_pool.criterion_ids, new_pool.criterion_ids):
+        # Criteria changed as well, so nothing can be patched
+        return 0, rematch_ranked_clients(new_pool, top_k=top_k, chunk_size=chunk_size, on_chunk=on_chunk)
+
+    clients = load_score_vectors(
+        User.objects.filter(matching_result_set__isnull=False), criterion_ids=new_pool.criterion_ids
+    )
+
+    old_scores = old_pool.get_scores(therapist_id)
+    new_scores = new_pool.get_scores(therapist_id)
+    if old_scores is None and new_scores is None:
+        return 0, 0
+
+    # Undo this therapist's change on the current histograms, so both tables differ only by it
+    criteria = np.arange(len(new_pool.criterion_ids))
+    old_histograms = new_pool.score_histograms.copy()
+    if new_scores is not None:
+        old_histograms[criteria, new_scores.astype(np.int64) - 1] -= 1
+    if old_scores is not None:
+        old_histograms[criteria, old_scores.astype(np.int64) - 1] += 1
+    old_pool_size = int(old_histograms[0].sum()) if len(criteria) else 0
+    new_pool_size = len(new_pool.therapist_ids)
+
+    new_table = calculate_pool_weight_table(new_pool.score_histograms)
+    table_increase = np.max(new_table - calculate_pool_weight_table(old_histograms), axis=2)  # [c, s]
+    pool_scores = new_pool.scores.astype(np.int64)
+    needed = new_pool_size if top_k is None else min(top_k, new_pool_size)
+    updated_row = np.searchsorted(new_pool.therapist_ids, therapist_id) if new_scores is not None else None
+
+    # Row new_pool_size is a sentinel for "no therapist"
+    padded_ids = np.append(new_pool.therapist_ids, -1)
+    padded_scores = np.vstack([pool_scores, np.ones((1, pool_scores.shape[1]), dtype=np.int64)])
+
+    patched = recomputed = 0
+    for start in range(0, len(clients.user_ids), chunk_size):
+        rows = slice(start, start + chunk_size)
+        client_ids = clients.user_ids[rows]
+        client_scores = clients.scores[rows].astype(np.int64)
+        client_filled = clients.filled[rows]
+        n_filled = np.maximum(client_filled.sum(axis=1), 1)
+        ids, stored_weights = load_stored_rankings(client_ids)
+
+        # Candidates: stored therapists still in the pool, plus the updated therapist
+        pool_rows = np.searchsorted(new_pool.therapist_ids, ids)
+        present = (ids >= 0) & (ids != therapist_id) & (padded_ids[pool_rows] == ids)
+        candidate_rows = np.where(present, pool_rows, new_pool_size)
+        if updated_row is not None:
+            candidate_rows = np.hstack([candidate_rows, np.full((len(client_ids), 1), updated_row)])
+        # Pool order among candidates keeps ties ordered like a full ranking
+        candidate_rows = np.sort(candidate_rows, axis=1)
+        valid = candidate_rows < new_pool_size
+
+        candidate_weights = np.where(
+            valid,
+            calculate_client_weights(new_table, client_scores, padded_scores[candidate_rows], client_filled),
+            -np.inf
+        )
+        top = rank_top_k(candidate_weights, needed)
+        top_weights = np.take_along_axis(candidate_weights, top, axis=1)
+
+        # How far an outsider's weight can have grown, and where the old ranking ended
+        growth = np.sum(
+            np.where(client_filled, table_increase[criteria, np.maximum(client_scores - 1, 0)], 0), axis=1
+        ) / n_filled
+        n_stored = np.sum(ids >= 0, axis=1)
+        old_last = np.take_along_axis(stored_weights, np.maximum(n_stored - 1, 0)[:, np.newaxis], axis=1)[:, 0]
+        # Stored weights may lag their exact values by STORED_WEIGHT_RTOL
+        old_last = old_last + STORED_WEIGHT_RTOL * np.abs(old_last)
+        kth_weight = top_weights[:, -1] if needed else np.full(len(client_ids), np.inf)
+        no_outsiders = n_stored >= old_pool_size
+        safe = (np.sum(valid, axis=1) >= needed) & (
+            no_outsiders | ((n_stored > 0) & (kth_weight > old_last + growth + 1e-12))
+        )
+
+        ranked_ids = padded_ids[np.take_along_axis(candidate_rows, top, axis=1)].tolist()
+        ranked_weights = top_weights.tolist()
+
+        unsafe = np.flatnonzero(~safe)
+        if len(unsafe):
+            full_order, full_weights = rank_clients(
+                new_table, pool_scores, client_scores[unsafe], client_filled[unsafe], top_k=top_k
+            )
+            for position, client_row in enumerate(unsafe):
+                ranked_ids[client_row] = new_pool.therapist_ids[full_order[position]].tolist()
+                ranked_weights[client_row] = full_weights[position].tolist()
+
+        changed = [
+            row for row in range(len(client_ids))
+            if not _same_ranking(ids[row], stored_weights[row], ranked_ids[row], ranked_weights[row])
+        ]
+        if changed:
+            save_rankings(
+                client_ids[changed].tolist(),
+                [ranked_ids[row] for row in changed],
+                [ranked_weights[row] for row in changed],
+                pool_size=new_pool_size,
+            )
+        patched += int(np.sum(safe))
+        recomputed += len(unsafe)
+        if on_chunk is not None:
+            on_chunk()
+
+    return patched, recomputed
@@ -0,0 +1,80 @@
+import threading
+import zlib
+from collections import namedtuple
+
+import numpy as np
+
+from config.cache import bump_version, get_version
+
+from .models import Criterion
+
+# Shared catalog version, so every process notices criteria changed by the others.
+# It lives in the CACHES backend, which settings share between all processes.
+CATALOG_VERSION_CACHE_KEY = 'matching:criterion_catalog_version'
+
+
+class CriterionCatalog(namedtuple('CriterionCatalog', ['criteria', 'criterion_ids', 'version'])):
+    """
+    Immutable list of all criteria, in the column order of every score vector.
+
+    - criteria: tuple of Criterion instances, ordered by id
+    - criterion_ids: int64 array of shape (n_criteria,), ascending
+    - version: catalog version the list was loaded for
+    """
+    __slots__ = ()
+
+    @property
+    def layout_version(self):
+        """
+        Durable id of the column order, stored with packed score vectors.
+
+        Unlike version, which counts changes in the shared cache, it only depends on
+        which criteria exist, so it survives restarts and cache flushes.
+        """
+        return zlib.crc32(self.criterion_ids.tobytes())
+
+    def column(self, criterion_id):
+        """Position of a criterion in score vectors, or None if it is not in the catalog"""
+        column = np.searchsorted(self.criterion_ids, criterion_id)
+        if column < len(self.criterion_ids) and self.criterion_ids[column] == criterion_id:
+            return int(column)
+        return None
+
+
+class CriterionCatalogCache:
+    """
+    In-process copy of the criterion catalog.
+
+    Reloaded with one query whenever the shared catalog version moves, which the
+    Criterion save and delete signals do through invalidate().
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._catalog = None
+
+    @staticmethod
+    def get_version():
+        return get_version(CATALOG_VERSION_CACHE_KEY)
+
+    def get(self):
+        """Return the current CriterionCatalog, reloading it if its version is outdated"""
+        version = self.get_version()
+        with self._lock:
+            if self._catalog is None or self._catalog.version != version:
+                criteria = tuple(Criterion.objects.order_by('id'))
+                criterion_ids = np.fromiter((criterion.id for criterion in criteria), dtype=np.int64)
+                self._catalog = CriterionCatalog(criteria, criterion_ids, version)
+            return self._catalog
+
+    def invalidate(self):
+        """Bump the catalog version, every process reloads on its next access"""
+        bump_version(CATALOG_VERSION_CACHE_KEY)
+
+
+criterion_catalog = CriterionCatalogCache()
+
+
+def get_criterion_catalog():
+    """The current CriterionCatalog"""
+    return criterion_catalog.get()
@@ -0,0 +1,359 @@
+from collections import namedtuple
+from itertools import chain
+
+import numpy as np
+from django.conf import settings
+from django.db import models, transaction
+
+from psychotherapists.pagination import CursorPage, CursorPaginator
+from users.models import User
+from .catalog import get_criterion_catalog
+from .models import CriterionScore, MatchingResult, MatchingResultSet, ScoreVector
+
+# Rows fetched per round trip while streaming scores
+SCORE_STREAM_CHUNK_SIZE = 5000
+
+# Rows inserted per statement when storing rankings
+RESULT_BATCH_SIZE = 5000
+
+
+class ScoreMatrix(namedtuple('ScoreMatrix', ['user_ids', 'criterion_ids', 'scores', 'filled'])):
+    """
+    Scores of several users pivoted into arrays.
+
+    - user_ids: int64 array of shape (n_users,), ascending
+    - criterion_ids: int64 array of shape (n_criteria,), in the requested order
+    - scores: int8 array of shape (n_users, n_criteria), 0 where a score is missing
+    - filled: bool array of shape (n_users, n_criteria), False where a score is missing
+    """
+    __slots__ = ()
+
+    @property
+    def complete(self):
+        """Mask of users who scored every criterion"""
+        return np.all(self.filled, axis=1)
+
+    def only_complete(self):
+        """The same matrix restricted to users who scored every criterion"""
+        complete = self.complete
+        return self._replace(
+            user_ids=self.user_ids[complete],
+            scores=self.scores[complete],
+            filled=self.filled[complete],
+        )
+
+
+def get_criterion_ids():
+    """Ids of all criteria in the order used for score vectors"""
+    return get_criterion_catalog().criterion_ids.tolist()
+
+
+def get_surveyed_therapists():
+    """Therapists who completed the matching survey"""
+    return User.objects.filter(user_role='therapist', survey_done=True)
+
+
+def get_surveyed_clients():
+    """Clients who completed the matching survey"""
+    return User.objects.filter(user_role='client', survey_done=True)
+
+
+def load_user_scores(user):
+    """
+    Load one user's scores.
+
+    Args:
+        user: User instance or user ID
+
+    Returns:
+        dict of {criterion_id: score} ordered by criterion id
+    """
+    return dict(
+        CriterionScore.objects.filter(user=user)
+        .order_by('criterion_id')
+        .values_list('criterion_id', 'score')
+    )
+
+
+def load_score_matrix(users, criterion_ids=None):
+    """
+    Load the scores of many users with a single query.
+
+    Args:
+        users: User queryset selecting whose scores to load
+        criterion_ids: criteria to load, in column order; all criteria by id if None
+
+    Returns:
+        ScoreMatrix for every selected user with at least one of the requested scores
+    """
+    if criterion_ids is None:
+        criterion_ids = get_criterion_ids()
+    criterion_ids = np.asarray(list(criterion_ids), dtype=np.int64)
+
+    stream = (
+        CriterionScore.objects
+        .filter(user__in=users.values('pk'), criterion_id__in=criterion_ids.tolist())
+        .order_by('user_id', 'criterion_id')
+        .values_list('user_id', 'criterion_id', 'score')
+        .iterator(chunk_size=SCORE_STREAM_CHUNK_SIZE)
+    )
+    rows = np.fromiter(chain.from_iterable(stream), dtype=np.int64).reshape(-1, 3)
+
+    user_ids, user_rows = np.unique(rows[:, 0], return_inverse=True)
+    scores = np.zeros((len(user_ids), len(criterion_ids)), dtype=np.int8)
+    filled = np.zeros(scores.shape, dtype=bool)
+
+    # Map criterion ids to their column, whatever order the caller asked for
+    order = np.argsort(criterion_ids)
+    columns = order[np.searchsorted(criterion_ids, rows[:, 1], sorter=order)]
+    scores[user_rows, columns] = rows[:, 2]
+    filled[user_rows, columns] = True
+
+    return ScoreMatrix(user_ids, criterion_ids, scores, filled)
+
+
+def pack_scores(scores, catalog):
+    """
+    Pack {criterion_id: score} into ScoreVector bytes, in the catalog's column order.
+
+    Criteria the catalog does not know are dropped, missing ones are packed as 0.
+    """
+    vector = np.zeros(len(catalog.criterion_ids), dtype=np.uint8)
+    for criterion_id, score in scores.items():
+        column = catalog.column(criterion_id)
+        if column is not None:
+            vector[column] = score
+    return vector.tobytes()
+
+
+def save_score_vectors(user_ids, packed_scores, catalog):
+    """Upsert the ScoreVector rows of many users with one statement"""
+    ScoreVector.objects.bulk_create(
+        [
+            ScoreVector(user_id=user_id, scores=scores, catalog_version=catalog.layout_version)
+            for user_id, scores in zip(user_ids, packed_scores)
+        ],
+        batch_size=RESULT_BATCH_SIZE,
+        update_conflicts=True,
+        unique_fields=['user'],
+        update_fields=['scores', 'catalog_version', 'updated_at'],
+    )
+
+
+def sync_score_vector(user_id, scores=None):
+    """
+    Repack a user's ScoreVector after their scores changed.
+
+    Args:
+        user_id: ID of the user whose vector to write
+        scores: the user's scores as {criterion_id: score}; loaded from CriterionScore
+            unless they cover every criterion of the catalog
+    """
+    catalog = get_criterion_catalog()
+    if scores is None or not set(catalog.criterion_ids.tolist()) <= scores.keys():
+        scores = load_user_scores(user_id)
+    if not scores:
+        # Nothing left to pack, e.g. the user is being deleted
+        ScoreVector.objects.filter(user_id=user_id).delete()
+        return
+    save_score_vectors([user_id], [pack_scores(scores, catalog)], catalog)
+
+
+def load_score_vectors(users, criterion_ids=None):
+    """
+    Load the scores of many users from their packed ScoreVector rows.
+
+    Reads one narrow row per user instead of one row per score. Users whose vector
+    is missing or was packed against an older criterion layout are loaded from
+    their CriterionScore rows instead.
+
+    Args:
+        users: User queryset selecting whose scores to load
+        criterion_ids: criteria to load, in column order; all criteria by id if None
+
+    Returns:
+        ScoreMatrix, the same as load_score_matrix would return
+    """
+    catalog = get_criterion_catalog()
+    if criterion_ids is None:
+        criterion_ids = catalog.criterion_ids
+    criterion_ids = np.asarray(list(criterion_ids), dtype=np.int64)
+    columns = [catalog.column(criterion_id) for criterion_id in criterion_ids.tolist()]
+    if None in columns:
+        # Criteria newer than our catalog, vectors cannot hold them yet
+        return load_score_matrix(users, criterion_ids)
+
+    user_ids = []
+    packed = []
+    has_stale = False
+    stream = (
+        users.order_by('pk')
+        .values_list('pk', 'score_vector__catalog_version', 'score_vector__scores')
+        .iterator(chunk_size=SCORE_STREAM_CHUNK_SIZE)
+    )
+    for user_id, catalog_version, scores in stream:
+        if catalog_version == catalog.layout_version:
+            user_ids.append(user_id)
+            packed.append(scores)
+        else:
+            has_stale = True
+
+    user_ids = np.asarray(user_ids, dtype=np.int64)
+    vectors = np.frombuffer(b''.join(packed), dtype=np.uint8).reshape(len(user_ids), len(catalog.criterion_ids))
+    scores = vectors[:, columns].astype(np.int8)
+    filled = scores > 0
+
+    if has_stale:
+        fallback = load_score_matrix(
+            users.exclude(score_vector__catalog_version=catalog.layout_version), criterion_ids
+        )
+        user_ids = np.concatenate([user_ids, fallback.user_ids])
+        scores = np.concatenate([scores, fallback.scores])
+        filled = np.concatenate([filled, fallback.filled])
+        order = np.argsort(user_ids)
+        user_ids, scores, filled = user_ids[order], scores[order], filled[order]
+
+    # Like load_score_matrix, only users with at least one of the requested scores
+    scored = np.any(filled, axis=1)
+    return ScoreMatrix(user_ids[scored], criterion_ids, scores[scored], filled[scored])
+
+
+def save_rankings(client_ids, ranked_therapist_ids, ranked_weights, pool_size):
+    """
+    Store new rankings of many clients in one transaction.
+
+    Every ranking is written as the next version of the client's result set and
+    the result set is switched to that version in the same transaction, so readers
+    going through MatchingResult.objects.current() see either the old ranking or
+    the new one in full. Rows of the replaced versions are deleted last.
+
+    Args:
+        client_ids: list of client IDs
+        ranked_therapist_ids: per client, the list of therapist IDs in order of preference
+        ranked_weights: per client, the list of corresponding weights
+        pool_size: number of therapists the clients were ranked against
+    """
+    with transaction.atomic():
+        # Clients ranked for the first time get an empty result set first, so there is
+        # a row to lock and concurrent first rankings cannot both write version 1
+        MatchingResultSet.objects.bulk_create(
+            [MatchingResultSet(client_id=client_id, pool_size=pool_size, version=0) for client_id in client_ids],
+            ignore_conflicts=True,
+        )
+        # Lock the result sets being replaced, concurrent writers of the same client take turns
+        versions = dict(
+            MatchingResultSet.objects.select_for_update()
+            .filter(client_id__in=client_ids)
+            .values_list('client_id', 'version')
+        )
+        new_versions = {client_id: versions[client_id] + 1 for client_id in client_ids}
+
+        MatchingResult.objects.bulk_create(
+            (
+                MatchingResult(
+                    client_id=client_id, therapist_id=therapist_id, score=weight, rank=rank,
+                    version=new_versions[client_id],
+                )
+                for client_id, therapist_ids, weights in zip(client_ids, ranked_therapist_ids, ranked_weights)
+                for rank, (therapist_id, weight) in enumerate(zip(therapist_ids, weights), 1)
+            ),
+            batch_size=RESULT_BATCH_SIZE,
+        )
+        MatchingResultSet.objects.bulk_create(
+            [
+                MatchingResultSet(client_id=client_id, pool_size=pool_size, version=new_versions[client_id])
+                for client_id in client_ids
+            ],
+            update_conflicts=True,
+            unique_fields=['client'],
+            update_fields=['version', 'pool_size', 'updated_at'],
+        )
+        MatchingResult.objects.filter(client_id__in=client_ids).exclude(
+            version=models.F('client__matching_result_set__version')
+        ).delete()
+
+
+def load_stored_rankings(client_ids):
+    """
+    Stored rankings of the given clients with one query, as padded arrays.
+
+    Only rows of clients between the first and the last requested ID are read,
+    so loading one chunk of clients at a time stays proportional to the chunk.
+
+    Args:
+        client_ids: ascending int array of client IDs
+
+    Returns:
+        tuple: (therapist_ids, weights), both of shape (n_clients, longest_ranking);
+            missing positions hold -1 and -inf
+    """
+    if not len(client_ids):
+        return np.full((0, 1), -1, dtype=np.int64), np.full((0, 1), -np.inf)
+    stream = (
+        MatchingResult.objects
+        .current()
+        .filter(client_id__gte=client_ids[0], client_id__lte=client_ids[-1])
+        .order_by('client_id', 'rank')
+        .values_list('client_id', 'therapist_id', 'score')
+        .iterator(chunk_size=SCORE_STREAM_CHUNK_SIZE)
+    )
+    rows = np.fromiter(chain.from_iterable(stream), dtype=np.float64).reshape(-1, 3)
+    row_clients = rows[:, 0].astype(np.int64)
+    known = np.isin(row_clients, client_ids)
+    rows, row_clients = rows[known], row_clients[known]
+
+    client_rows = np.searchsorted(client_ids, row_clients)
+    counts = np.bincount(client_rows, minlength=len(client_ids))
+    starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+    columns = np.arange(len(rows)) - starts[client_rows]
+
+    therapist_ids = np.full((len(client_ids), max(counts.max(initial=0), 1)), -1, dtype=np.int64)
+    weights = np.full(therapist_ids.shape, -np.inf)
+    therapist_ids[client_rows, columns] = rows[:, 1].astype(np.int64)
+    weights[client_rows, columns] = rows[:, 2]
+    return therapist_ids, weights
+
+
+def get_client_matches(client_id, version=None):
+    """
+    One version of a client's stored ranking, best first, with each therapist's
+    user, profile and methodology joined in.
+
+    Therapists without a profile are left out. Pages of it are read in rank order
+    through the (client, rank) index, so their cost does not depend on the pool size.
+
+    Args:
+        client_id: ID of the client
+        version: version of the ranking to read; the one the client's result set
+            points to if None, decided in the same query that reads the rows
+    """
+    matches = MatchingResult.objects.filter(client_id=client_id, therapist__therapist__isnull=False)
+    matches = matches.current() if version is None else matches.filter(version=version)
+    # All rows share one version; leading with it puts the version into page cursors
+    return matches.select_related(
+        'therapist__therapist__working_methodology'
+    ).order_by('version', 'rank')
+
+
+async def aload_match_page(client_id, cursor=None):
+    """
+    One page of a client's current ranking, see get_client_matches().
+
+    The version and the rows are read in one query, so a ranking saved in between
+    cannot leave the page pointing at rows that were just deleted. A cursor of an
+    older ranking starts again from the best match, as the current rows all come
+    after its version.
+
+    Args:
+        client_id: ID of the client
+        cursor: token of the page to load, from the previous page's next_cursor
+
+    Returns:
+        tuple: (CursorPage of MatchingResult, pool_size); the page is empty before the
+            client's first ranking
+    """
+    matches = get_client_matches(client_id).annotate(
+        pool_size=models.F('client__matching_result_set__pool_size')
+    )
+    page = await CursorPaginator(matches, settings.MATCHING_PAGE_SIZE).apage(cursor)
+    return page, page.object_list[0].pool_size if page else 0
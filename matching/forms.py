@@ -1,6 +1,14 @@
+import logging
+
 from django import forms
+from django.db import transaction
 from django.utils.translation import gettext_lazy as _
-from .models import Criterion, CriterionScore
+from users.models import User
+from .catalog import get_criterion_catalog
+from .models import CriterionScore
+from .signals import scores_changed
+
+logger = logging.getLogger(__name__)
 
 class BaseMatchingForm(forms.ModelForm):
     """Base form for rating criteria"""
@@ -30,87 +38,116 @@ class BaseMatchingForm(forms.ModelForm):
             instance.save()
         return instance
 
-class ClientMatchingForm(forms.Form):
-    """Form for clients to rate their preferences"""
+class SurveyForm(forms.Form):
+    """
+    Base form for the matching surveys, with one rating field per criterion.
+
+    The criterion fields are declared on a subclass built once per criterion
+    catalog version; use for_catalog() to get it.
+    """
+    catalog = None
+    intro_text = ''
+    rating_widget = forms.RadioSelect
+
     def __init__(self, *args, **kwargs):
+        if self.catalog is None:
+            raise TypeError(f"Use {type(self).__name__}.for_catalog() to get a form with the criterion fields")
         self.user = kwargs.pop('user', None)
         super().__init__(*args, **kwargs)
-        
-        # Get all criteria
-        self.criteria = list(Criterion.objects.all().order_by('id'))
-        
-        # Add fields for each criterion
-        for criterion in self.criteria:
-            field_name = f'criterion_{criterion.id}'
-            field = forms.ChoiceField(
-                label=criterion.name,
-                choices=[(i, str(i)) for i in range(1, 10)],
-                widget=forms.RadioSelect,
-                required=True
+
+    @classmethod
+    def for_catalog(cls, catalog=None):
+        """
+        The form class with a field for every criterion of the catalog.
+
+        Args:
+            catalog: CriterionCatalog to build the fields from; the current one if None
+
+        Returns:
+            subclass of cls, cached until the catalog version changes
+        """
+        if catalog is None:
+            catalog = get_criterion_catalog()
+        key = (cls, catalog.version)
+        form_class = _survey_form_classes.get(key)
+        if form_class is None:
+            fields = {f'criterion_{criterion.id}': cls.build_field(criterion) for criterion in catalog.criteria}
+            form_class = type(cls.__name__, (cls,), {**fields, 'catalog': catalog, '__module__': cls.__module__})
+            # Classes of older catalog versions are never used again
+            for old_key in [old_key for old_key in _survey_form_classes if old_key[0] is cls]:
+                del _survey_form_classes[old_key]
+            _survey_form_classes[key] = form_class
+        return form_class
+
+    @classmethod
+    def build_field(cls, criterion):
+        """The rating field for one criterion"""
+        field = forms.ChoiceField(
+            label=criterion.name,
+            choices=[(i, str(i)) for i in range(1, 10)],
+            widget=cls.rating_widget,
+            help_text=criterion.description,
+            required=True
+        )
+        field.criterion = criterion  # Attach criterion to field
+        return field
+
+    def get_scores(self):
+        """Cleaned ratings as {criterion_id: score}"""
+        return {
+            field.criterion.id: int(self.cleaned_data[field_name])
+            for field_name, field in self.fields.items()
+            if field_name.startswith('criterion_')
+        }
+
+    def save(self):
+        """
+        Save all ratings and mark the user's survey as done in one transaction.
+
+        Scores are upserted with a single statement, only survey_done is written
+        to the user, and scores_changed is sent once for the whole survey.
+        """
+        scores = self.get_scores()
+        with transaction.atomic():
+            CriterionScore.objects.bulk_create(
+                [
+                    CriterionScore(user=self.user, criterion_id=criterion_id, score=score)
+                    for criterion_id, score in scores.items()
+                ],
+                update_conflicts=True,
+                unique_fields=['user', 'criterion'],
+                update_fields=['score'],
             )
-            field.criterion = criterion  # Attach criterion to field
-            field.help_text = criterion.description
-            self.fields[field_name] = field
-        
-        # Add intro text
-        self.intro_text = _("""
+            self.user.survey_done = True
+            self.user.save(update_fields=['survey_done'])
+            scores_changed.send(sender=User, user=self.user, scores=scores)
+        return scores
+
+# Survey form classes built by SurveyForm.for_catalog, by (form class, catalog version)
+_survey_form_classes = {}
+
+class ClientMatchingForm(SurveyForm):
+    """Form for clients to rate their preferences"""
+    intro_text = _("""
         Please rate each criterion on a scale of 1 to 9.
         
         Your ratings will help us match you with therapists who best align with your preferences.
         """)
-    
+
+    @property
+    def criteria(self):
+        return self.catalog.criteria
+
     def save(self):
         """Save the client's preferences"""
-        print("Saving client preferences...")  # Debug print
-        print(f"Form data: {self.cleaned_data}")  # Debug print
-        
-        # Delete any existing scores for this user
-        CriterionScore.objects.filter(user=self.user).delete()
-        
-        # Save new scores
-        for criterion in self.criteria:
-            score_value = int(self.cleaned_data[f'criterion_{criterion.id}'])
-            print(f"Saving score for criterion {criterion.id}: {score_value}")  # Debug print
-            CriterionScore.objects.create(
-                user=self.user,
-                criterion=criterion,
-                score=score_value
-            )
-        
-        print("All scores saved successfully")  # Debug print
+        scores = super().save()
+        logger.debug("Saved %d scores for client %s", len(scores), self.user.pk)
+        return scores
 
-class TherapistMatchingForm(forms.Form):
+class TherapistMatchingForm(SurveyForm):
     """Form for therapists to rate themselves"""
-    def __init__(self, *args, **kwargs):
-        self.user = kwargs.pop('user', None)
-        super().__init__(*args, **kwargs)
-        
-        # Add introduction text
-        self.intro_text = _("""
+    intro_text = _("""
         Please rate how well each of these characteristics describes you and your therapeutic approach.
         Rate from 1 to 9.
         """)
-
-        # Create a form field for each criterion
-        for criterion in Criterion.objects.all():
-            field_name = f'criterion_{criterion.id}'
-            field = forms.ChoiceField(
-                choices=[(i, str(i)) for i in range(1, 10)],
-                widget=forms.RadioSelect(attrs={'class': 'rating-radio'}),
-                label=criterion.name,
-                help_text=criterion.description,
-                required=True
-            )
-            field.criterion = criterion  # Attach criterion to field
-            self.fields[field_name] = field
-
-    def save(self):
-        for field_name, value in self.cleaned_data.items():
-            if field_name.startswith('criterion_'):
-                criterion_id = int(field_name.split('_')[1])
-                criterion = Criterion.objects.get(id=criterion_id)
-                CriterionScore.objects.update_or_create(
-                    user=self.user,
-                    criterion=criterion,
-                    defaults={'score': int(value)}
-                ) 
\ No newline at end of file
+    rating_widget = forms.RadioSelect(attrs={'class': 'rating-radio'})
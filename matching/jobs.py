@@ -0,0 +1,194 @@
+import logging
+import traceback
+from datetime import timedelta
+
+from django.db import connection, transaction
+from django.db.models import F
+from django.utils import timezone
+
+from .batch_matching import rematch_after_therapist_update, rematch_ranked_clients
+from .matching_algorithm import run_algorithm
+from .models import MatchJob, TherapistRematchJob
+from .score_index import therapist_score_index
+
+logger = logging.getLogger(__name__)
+
+
+def enqueue_match_job(client):
+    """
+    Ask the worker to recompute a client's ranking.
+
+    Jobs are deduplicated per client: a single upsert either creates the client's
+    job or moves it back to pending with a new requested_at.
+    """
+    MatchJob.objects.bulk_create(
+        [MatchJob(client=client, status=MatchJob.STATUS_PENDING, requested_at=timezone.now(), error='')],
+        update_conflicts=True,
+        unique_fields=['client'],
+        update_fields=['status', 'requested_at', 'error'],
+    )
+
+
+def is_match_pending(client):
+    """Whether a ranking for the client is still being computed"""
+    return MatchJob.objects.filter(
+        client=client, status__in=[MatchJob.STATUS_PENDING, MatchJob.STATUS_RUNNING]
+    ).exists()
+
+
+async def ais_match_pending(client):
+    """Async version of is_match_pending()"""
+    return await MatchJob.objects.filter(
+        client=client, status__in=[MatchJob.STATUS_PENDING, MatchJob.STATUS_RUNNING]
+    ).aexists()
+
+
+def claim_match_jobs(limit):
+    """
+    Mark up to limit of the oldest pending jobs as running and return them.
+
+    Concurrent workers skip each other's locked rows where the database supports
+    it; SQLite serializes the claiming transactions instead.
+    """
+    with transaction.atomic():
+        pending = MatchJob.objects.filter(status=MatchJob.STATUS_PENDING).order_by('requested_at')
+        if connection.features.has_select_for_update_skip_locked:
+            pending = pending.select_for_update(skip_locked=True)
+        jobs = list(pending.select_related('client')[:limit])
+        MatchJob.objects.filter(pk__in=[job.pk for job in jobs]).update(
+            status=MatchJob.STATUS_RUNNING, started_at=timezone.now(), attempts=F('attempts') + 1
+        )
+    return jobs
+
+
+def requeue_stale_match_jobs(stale_after):
+    """
+    Put running jobs of both queues back when their worker stopped before finishing.
+
+    A client job is stale once it has run for stale_after seconds. A therapist
+    rematch can legitimately run much longer, so it is only stale when its worker
+    has not reported progress for that long; requeueing a live one would let two
+    rematches run at once.
+    """
+    cutoff = timezone.now() - timedelta(seconds=stale_after)
+    return MatchJob.objects.filter(status=MatchJob.STATUS_RUNNING, started_at__lt=cutoff).update(
+        status=MatchJob.STATUS_PENDING
+    ) + TherapistRematchJob.objects.filter(status=MatchJob.STATUS_RUNNING, heartbeat_at__lt=cutoff).update(
+        status=MatchJob.STATUS_PENDING
+    )
+
+
+def run_match_job(job):
+    """
+    Compute and store one client's ranking.
+
+    The job is only marked done or failed if it was not requested again while it
+    ran; otherwise it stays pending for the next round.
+
+    Returns:
+        bool: True if the ranking was stored
+    """
+    # Only the job as claimed may be finished, not a newer request for the same client
+    claimed = MatchJob.objects.filter(pk=job.pk, status=MatchJob.STATUS_RUNNING, requested_at=job.requested_at)
+    try:
+        run_algorithm(job.client)
+    except Exception:
+        logger.exception("Match job for client %s failed", job.client_id)
+        claimed.update(status=MatchJob.STATUS_FAILED, finished_at=timezone.now(), error=traceback.format_exc())
+        return False
+
+    claimed.update(status=MatchJob.STATUS_DONE, finished_at=timezone.now())
+    return True
+
+
+def enqueue_therapist_rematch(therapist_id, old_scores, old_pool_version):
+    """
+    Ask the worker to update the stored rankings after a therapist saved their survey.
+
+    Only the therapist's score rows are stored; the worker rebuilds the pool from
+    before the change out of its own copy of the pool.
+
+    Args:
+        therapist_id: ID of the therapist whose scores changed
+        old_scores: the therapist's score row before the change, None if they were not in the pool
+        old_pool_version: pool version the old score row was read at
+    """
+    pool = therapist_score_index.snapshot()
+    new_scores = pool.get_scores(therapist_id)
+    if old_scores is not None:
+        old_scores = [int(score) for score in old_scores]
+    # Every survey write bumps the pool version at least once, so a single bump
+    # means nothing but this therapist changed in between
+    only_therapist_changed = pool.version == old_pool_version + 1
+    TherapistRematchJob.objects.create(
+        therapist_id=therapist_id,
+        old_scores=old_scores,
+        new_scores=new_scores.tolist() if new_scores is not None else None,
+        pool_version=pool.version if only_therapist_changed else None,
+    )
+
+
+def claim_therapist_rematch_job():
+    """
+    Mark the oldest pending therapist rematch job as running and return it, or None.
+
+    Each job patches the rankings the previous one left, so they run one at a time:
+    nothing is claimed while another worker runs a job.
+    """
+    with transaction.atomic():
+        # Locks every open job, so concurrent workers check them one after the other
+        jobs = list(
+            TherapistRematchJob.objects.select_for_update()
+            .filter(status__in=[MatchJob.STATUS_PENDING, MatchJob.STATUS_RUNNING])
+            .order_by('requested_at')
+        )
+        if not jobs or any(job.status == MatchJob.STATUS_RUNNING for job in jobs):
+            return None
+        job = jobs[0]
+        now = timezone.now()
+        TherapistRematchJob.objects.filter(pk=job.pk).update(
+            status=MatchJob.STATUS_RUNNING, started_at=now, heartbeat_at=now, attempts=F('attempts') + 1
+        )
+    return job
+
+
+def run_therapist_rematch_job(job):
+    """
+    Update the stored rankings for one therapist change.
+
+    The rankings are patched when the pool is still the one the change produced
+    and no earlier job failed. Otherwise every ranking is recomputed against the
+    current pool, which also settles the jobs requested before that started.
+
+    Returns:
+        bool: True if the rankings were updated
+    """
+    started = timezone.now()
+    claimed = TherapistRematchJob.objects.filter(pk=job.pk, status=MatchJob.STATUS_RUNNING)
+
+    def heartbeat():
+        # Keeps requeue_stale_match_jobs off the job while it makes progress
+        claimed.update(heartbeat_at=timezone.now())
+
+    try:
+        pool = therapist_score_index.snapshot()
+        earlier_failed = TherapistRematchJob.objects.filter(status=MatchJob.STATUS_FAILED).exists()
+        current_scores = pool.get_scores(job.therapist_id)
+        still_current = job.pool_version == pool.version and (
+            current_scores.tolist() if current_scores is not None else None
+        ) == job.new_scores
+        if still_current and not earlier_failed:
+            old_pool = pool.with_therapist_scores(job.therapist_id, job.old_scores)
+            rematch_after_therapist_update(job.therapist_id, old_pool, pool, on_chunk=heartbeat)
+        else:
+            rematch_ranked_clients(pool, on_chunk=heartbeat)
+            TherapistRematchJob.objects.filter(
+                status__in=[MatchJob.STATUS_PENDING, MatchJob.STATUS_FAILED], requested_at__lte=started
+            ).update(status=MatchJob.STATUS_DONE, finished_at=timezone.now())
+    except Exception:
+        logger.exception("Rematch job for therapist %s failed", job.therapist_id)
+        claimed.update(status=MatchJob.STATUS_FAILED, finished_at=timezone.now(), error=traceback.format_exc())
+        return False
+
+    claimed.update(status=MatchJob.STATUS_DONE, finished_at=timezone.now())
+    return True
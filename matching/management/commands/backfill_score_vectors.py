@@ -0,0 +1,50 @@
+from django.core.management.base import BaseCommand
+
+from matching.catalog import get_criterion_catalog
+from matching.data_access import load_score_matrix, save_score_vectors
+from users.models import User
+
+
+class Command(BaseCommand):
+    help = (
+        'Pack the scores of every user into ScoreVector rows. Run after deploying '
+        'score vectors and after adding or removing criteria.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--chunk-size', type=int, default=5000,
+            help='Number of users packed per transaction'
+        )
+        parser.add_argument(
+            '--stale-only', action='store_true',
+            help='Only pack users without a vector for the current criterion layout'
+        )
+
+    def handle(self, *args, **options):
+        catalog = get_criterion_catalog()
+        users = User.objects.filter(criterion_scores__isnull=False).distinct()
+        if options['stale_only']:
+            users = users.exclude(score_vector__catalog_version=catalog.layout_version)
+
+        done = 0
+        last_user_id = 0
+        while True:
+            user_ids = list(
+                users.filter(pk__gt=last_user_id).order_by('pk').values_list('pk', flat=True)[:options['chunk_size']]
+            )
+            if not user_ids:
+                break
+
+            matrix = load_score_matrix(User.objects.filter(pk__in=user_ids), catalog.criterion_ids)
+            save_score_vectors(
+                matrix.user_ids.tolist(), [row.astype('uint8').tobytes() for row in matrix.scores], catalog
+            )
+
+            done += len(matrix.user_ids)
+            last_user_id = user_ids[-1]
+            self.stdout.write(f"{done} score vectors packed")
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Packed {done} score vectors for catalog layout {catalog.layout_version}"
+        ))
@@ -0,0 +1,86 @@
+import json
+import os
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from matching.batch_matching import BatchRematcher
+from matching.score_index import therapist_score_index
+
+
+class Command(BaseCommand):
+    help = 'Recompute MatchingResult rankings for every client who completed the survey'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--chunk-size', type=int, default=500,
+            help='Number of clients ranked together in one vectorized block'
+        )
+        parser.add_argument(
+            '--workers', type=int, default=os.cpu_count() or 1,
+            help='Number of worker processes (1 ranks in this process)'
+        )
+        parser.add_argument(
+            '--top-k', type=int, default=settings.MATCHING_TOP_K,
+            help='Number of best therapists stored per client'
+        )
+        parser.add_argument(
+            '--checkpoint', default='rematch_all.checkpoint.json',
+            help='File recording the last client whose rankings were saved'
+        )
+        parser.add_argument(
+            '--resume', action='store_true',
+            help='Continue after the client recorded in the checkpoint file'
+        )
+
+    def handle(self, *args, **options):
+        pool = therapist_score_index.snapshot()
+        rematcher = BatchRematcher(
+            pool, chunk_size=options['chunk_size'], workers=options['workers'], top_k=options['top_k']
+        )
+        checkpoint_path = options['checkpoint']
+
+        pool_fingerprint = pool.fingerprint()
+        start_after = None
+        if options['resume']:
+            start_after = self._read_checkpoint(checkpoint_path, pool_fingerprint)
+
+        clients = rematcher.load_clients(start_after=start_after)
+        total = len(clients.user_ids)
+        self.stdout.write(
+            f"Rematching {total} clients against {len(pool.therapist_ids)} therapists "
+            f"(pool version {pool.version})"
+        )
+
+        done = 0
+        started = time.monotonic()
+        for client_ids, order, ranked_weights in rematcher.iter_rankings(clients):
+            rematcher.save_rankings(client_ids, order, ranked_weights)
+            self._write_checkpoint(checkpoint_path, pool_fingerprint, int(client_ids[-1]))
+
+            done += len(client_ids)
+            rate = done / max(time.monotonic() - started, 1e-9)
+            self.stdout.write(f"{done}/{total} clients ({done / total:.1%}), {rate:.0f} clients/s")
+
+        if os.path.exists(checkpoint_path):
+            os.remove(checkpoint_path)
+        self.stdout.write(self.style.SUCCESS(f"Rematched {done} clients"))
+
+    def _read_checkpoint(self, path, pool_fingerprint):
+        if not os.path.exists(path):
+            self.stdout.write("No checkpoint found, starting from the first client")
+            return None
+        with open(path) as checkpoint_file:
+            checkpoint = json.load(checkpoint_file)
+        if checkpoint.get('pool_fingerprint') != pool_fingerprint:
+            self.stdout.write(self.style.WARNING(
+                "Therapist pool changed since the checkpoint was written, starting over"
+            ))
+            return None
+        self.stdout.write(f"Resuming after client {checkpoint['last_client_id']}")
+        return checkpoint['last_client_id']
+
+    def _write_checkpoint(self, path, pool_fingerprint, last_client_id):
+        with open(path, 'w') as checkpoint_file:
+            json.dump({'pool_fingerprint': pool_fingerprint, 'last_client_id': last_client_id}, checkpoint_file)
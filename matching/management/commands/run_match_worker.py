@@ -0,0 +1,79 @@
+import time
+
+from django.core.cache import caches
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.management.base import BaseCommand
+
+from matching.jobs import (
+    claim_match_jobs, claim_therapist_rematch_job, requeue_stale_match_jobs, run_match_job,
+    run_therapist_rematch_job,
+)
+
+
+class Command(BaseCommand):
+    help = (
+        'Process queued match jobs: rank clients who submitted the survey and update '
+        'stored rankings after therapists changed theirs'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size', type=int, default=20,
+            help='Number of jobs claimed at once'
+        )
+        parser.add_argument(
+            '--poll-interval', type=float, default=1.0,
+            help='Seconds to wait before polling again when the queue is empty'
+        )
+        parser.add_argument(
+            '--stale-after', type=int, default=600,
+            help='Requeue running jobs whose worker has not finished them (client jobs) or not '
+                 'reported progress on them (therapist rematches) for this many seconds'
+        )
+        parser.add_argument(
+            '--queue', choices=['all', 'clients', 'rematches'], default='all',
+            help='Jobs to process: client rankings, therapist rematches or both. A rematch '
+                 'rewrites many rankings, so a separate worker per queue keeps client jobs moving'
+        )
+        parser.add_argument(
+            '--once', action='store_true',
+            help='Exit once the queue is empty instead of polling'
+        )
+
+    def handle(self, *args, **options):
+        if isinstance(caches['default'], LocMemCache):
+            # Pool and catalog versions would never reach this process
+            self.stderr.write(self.style.WARNING(
+                "The default cache is local to this process, so the worker will not see "
+                "therapist or criterion changes made by the web processes. Configure a "
+                "shared CACHES backend."
+            ))
+
+        done = failed = 0
+        while True:
+            requeued = requeue_stale_match_jobs(options['stale_after'])
+            if requeued:
+                self.stdout.write(self.style.WARNING(f"Requeued {requeued} stale jobs"))
+
+            # Therapist rematches run one at a time, see claim_therapist_rematch_job
+            jobs = []
+            if options['queue'] in ('all', 'rematches'):
+                rematch_job = claim_therapist_rematch_job()
+                if rematch_job is not None:
+                    jobs.append((run_therapist_rematch_job, rematch_job))
+            if options['queue'] in ('all', 'clients'):
+                jobs += [(run_match_job, job) for job in claim_match_jobs(options['batch_size'])]
+            if not jobs:
+                if options['once']:
+                    break
+                time.sleep(options['poll_interval'])
+                continue
+
+            for run_job, job in jobs:
+                if run_job(job):
+                    done += 1
+                else:
+                    failed += 1
+            self.stdout.write(f"{done} jobs done, {failed} failed")
+
+        self.stdout.write(self.style.SUCCESS(f"Queue empty: {done} jobs done, {failed} failed"))
@@ -1,51 +1,83 @@
-from django.db.models import Q
-from .models import Criterion, CriterionScore
-from users.models import User
+import logging
 
-def get_client_matching_data(client_user):
+from django.conf import settings
+from .data_access import get_surveyed_therapists, load_score_matrix, load_user_scores, save_rankings
+from .ranking_cache import get_ranking_cache, make_ranking_key
+
+logger = logging.getLogger(__name__)
+
+def get_client_matching_data(client_user, trace=None):
     """
     Get matching data for a client to find suitable therapists.
     
+    Loads the client's scores with one query and every surveyed therapist's scores
+    for the same criteria with one more. Therapists missing any of those criteria
+    are left out, since their score lists could not be compared position by position.
+    
     Args:
         client_user: The User instance of the logged-in client
+        trace: optional MatchTrace that receives the loaded score dicts
         
     Returns:
         tuple: (client_scores_dict, therapist_scores_dict)
             - client_scores_dict: dict of {client_id: list_of_scores}
             - therapist_scores_dict: dict of {therapist_id: list_of_scores}
     """
-    # Get client's scores as a list
-    client_scores = list(
-        CriterionScore.objects.filter(user=client_user)
-        .order_by('criterion_id')
-        .values_list('score', flat=True)
-    )
-    
-    # Format client scores in the same way as therapist scores
-    client_scores_dict = {client_user.id: client_scores}
+    # Get client's scores, ordered by criterion id
+    client_scores = load_user_scores(client_user)
+    client_scores_dict = {client_user.id: list(client_scores.values())}
     
-    # Get all therapists who have completed their survey
-    therapists = User.objects.filter(
-        user_role='therapist',
-        survey_done=True
-    )
+    # Get scores of all therapists who have completed their survey, in one query
+    therapists = load_score_matrix(get_surveyed_therapists(), criterion_ids=client_scores.keys())
+    complete = therapists.complete
+    if not np.all(complete):
+        logger.debug("Skipping therapists with missing criteria: %s", therapists.user_ids[~complete])
     
-    # Get all therapist scores
-    therapist_scores_dict = {}
-    for therapist in therapists:
-        scores = list(
-            CriterionScore.objects.filter(user=therapist)
-            .order_by('criterion_id')
-            .values_list('score', flat=True)
-        )
-        if scores:  # Only add if therapist has any scores
-            therapist_scores_dict[therapist.id] = scores
+    therapist_scores_dict = dict(zip(
+        therapists.user_ids[complete].tolist(),
+        therapists.scores[complete].tolist()
+    ))
     
-    print(f"{client_scores_dict=}\n")
-    print(f"{therapist_scores_dict=}\n")
+    if trace is not None:
+        trace.record('client_scores_dict', client_scores_dict)
+        trace.record('therapist_scores_dict', therapist_scores_dict)
     
     return client_scores_dict, therapist_scores_dict
 
+def get_indexed_matching_data(client_user, client_scores_by_criterion=None, snapshot=None):
+    """
+    Get matching data for a client, reading the therapist side from the score index.
+    
+    Only the client's scores are loaded from the database. Therapist scores are
+    restricted to the criteria the client has rated, in criterion id order.
+    
+    Args:
+        client_user: The User instance of the logged-in client
+        client_scores_by_criterion: the client's scores as loaded by load_user_scores;
+            loaded here if None
+        snapshot: ScoreIndexSnapshot to read therapist scores from; the current one if None
+        
+    Returns:
+        tuple: (client_scores, therapist_ids, therapist_scores)
+            - client_scores: int array of shape (n_criteria,)
+            - therapist_ids: list of therapist IDs
+            - therapist_scores: int8 array of shape (n_therapists, n_criteria)
+    """
+    # Imported here because the index itself builds on this module
+    from .score_index import therapist_score_index
+
+    if client_scores_by_criterion is None:
+        client_scores_by_criterion = load_user_scores(client_user)
+    criterion_ids = list(client_scores_by_criterion.keys())
+    client_scores = np.array(list(client_scores_by_criterion.values()), dtype=np.int64)
+
+    if snapshot is None:
+        snapshot = therapist_score_index.snapshot_for(criterion_ids)
+    if not criterion_ids or not len(snapshot.therapist_ids):
+        return client_scores, [], np.empty((0, len(criterion_ids)), dtype=np.int8)
+
+    return client_scores, snapshot.therapist_ids.tolist(), snapshot.select(criterion_ids)
+
 # def get_therapist_matching_data(therapist_user):
 #     """
 #     Get matching data for a therapist.
@@ -79,18 +111,80 @@ def get_client_matching_data(client_user):
 
 
 
-import re
 import numpy as np
 
-float_formatter = "{:.5f}".format
-np.set_printoptions(linewidth=np.inf,
-                    formatter={'float_kind':float_formatter})
-
 # Значення CIS для різних розмірів матриць
 CIS_values = {1: 0, 2: 0, 3: 0.52, 4: 0.89, 5: 1.11, 6: 1.25, 7: 1.35, 8: 1.40, 9: 1.45, 10: 1.49}
 
+# Scores are given on a 1..9 scale, so a client-therapist difference is 0..8
+MAX_SCORE_DIFFERENCE = 8
+
+# Engine modes for run_algorithm
+ENGINE_MATRIX = 'matrix'  # builds explicit T x T alternative matrices
+ENGINE_HISTOGRAM = 'histogram'  # closed form over per-criterion difference histograms
+
+
+def _build_preference_table():
+    """
+    Pairwise comparison value a_ij for every pair of differences.
+
+    A therapist with difference d_i compared to one with difference d_j gets
+    |d_i - d_j| + 1 when d_i < d_j, its reciprocal when d_i > d_j and 1 otherwise.
+    """
+    differences = np.arange(MAX_SCORE_DIFFERENCE + 1, dtype=np.float64)
+    delta = differences[np.newaxis, :] - differences[:, np.newaxis]  # d_j - d_i
+    return np.where(delta >= 0, delta + 1, 1 / (np.abs(delta) + 1))
+
+
+# PREFERENCE_TABLE[d_i, d_j] == a_ij, LOG_PREFERENCE_TABLE[d_i, d_j] == log(a_ij)
+PREFERENCE_TABLE = _build_preference_table()
+LOG_PREFERENCE_TABLE = np.log(PREFERENCE_TABLE)
+
 
-def create_mpp_matrices(client_scores_dict, therapist_scores_dict):
+def build_alternative_matrices(differences):
+    """
+    Build the alternative matrices of all criteria at once.
+
+    Args:
+        differences: int array of shape (n_therapists, n_criteria) with values 0..8
+
+    Returns:
+        array of shape (n_criteria, n_therapists, n_therapists) where
+        [c, i, j] compares therapist i with therapist j on criterion c
+    """
+    criterion_differences = np.asarray(differences, dtype=np.int64).T  # (C, T)
+    return PREFERENCE_TABLE[criterion_differences[:, :, np.newaxis], criterion_differences[:, np.newaxis, :]]
+
+
+def iter_alternative_matrices(differences, row_block_size=None):
+    """
+    Yield the alternative matrices one criterion (or one block of rows) at a time.
+
+    Only one (row_block_size, n_therapists) block is held in memory, which keeps
+    large pools bounded where build_alternative_matrices would need C * T^2 floats.
+
+    Args:
+        differences: int array of shape (n_therapists, n_criteria) with values 0..8
+        row_block_size: number of matrix rows per block; None yields whole matrices
+
+    Yields:
+        tuple: (criterion_idx, rows, block)
+            - criterion_idx: index of the criterion
+            - rows: slice of matrix rows covered by the block
+            - block: array of shape (rows, n_therapists)
+    """
+    differences = np.asarray(differences, dtype=np.int64)
+    n_therapists, n_criteria = differences.shape
+    block_size = row_block_size or max(n_therapists, 1)
+
+    for criterion_idx in range(n_criteria):
+        column = differences[:, criterion_idx]
+        for start in range(0, n_therapists, block_size):
+            rows = slice(start, min(start + block_size, n_therapists))
+            yield criterion_idx, rows, PREFERENCE_TABLE[column[rows, np.newaxis], column[np.newaxis, :]]
+
+
+def create_mpp_matrices(client_scores_dict, therapist_scores_dict, trace=None):
     """
     Create three types of pairwise comparison matrices:
     1. Expert matrix (1x1) - since we have one client
@@ -100,6 +194,7 @@ def create_mpp_matrices(client_scores_dict, therapist_scores_dict):
     Args:
         client_scores_dict: dict of {client_id: list_of_scores}
         therapist_scores_dict: dict of {therapist_id: list_of_scores}
+        trace: optional MatchTrace that receives every matrix built
         
     Returns:
         tuple: (expert_matrix, criteria_matrices, alternative_matrices)
@@ -121,68 +216,28 @@ def create_mpp_matrices(client_scores_dict, therapist_scores_dict):
     criteria_matrices = {client_id: criteria_matrix}  # Dict with one matrix for our single client
     
     # Find valid therapists (those with matching score lengths)
-    valid_therapist_ids = []
-    therapist_score_differences = {}  # Store differences for each therapist
-    
-    for therapist_id, therapist_scores in therapist_scores_dict.items():
-        if len(therapist_scores) == client_score_length:
-            valid_therapist_ids.append(therapist_id)
-            # Calculate absolute differences between client and therapist scores
-            differences = [abs(client_score - therapist_score) 
-                         for client_score, therapist_score in zip(client_scores, therapist_scores)]
-            therapist_score_differences[therapist_id] = differences
+    valid_therapist_ids, differences = calculate_score_differences(client_scores, therapist_scores_dict)
     
     if not valid_therapist_ids:
         return expert_matrix, criteria_matrices, {}
     
     # 3. Create alternative matrices (one for each criterion)
-    alternative_matrices = {}
-    n_therapists = len(valid_therapist_ids)
-    
-    # For each criterion
-    for criterion_idx in range(client_score_length):
-        # Create matrix filled with ones (diagonal)
-        matrix = np.ones((n_therapists, n_therapists))
-        
-        # Get differences for this criterion for all therapists
-        criterion_differences = {
-            therapist_id: differences[criterion_idx]
-            for therapist_id, differences in therapist_score_differences.items()
-        }
-        
-        # Fill the matrix with pairwise comparisons
-        for i, therapist1_id in enumerate(valid_therapist_ids):
-            for j, therapist2_id in enumerate(valid_therapist_ids):
-                if i != j:  # Skip diagonal
-                    diff1 = criterion_differences[therapist1_id]
-                    diff2 = criterion_differences[therapist2_id]
-                    
-                    if diff1 < diff2:
-                        # If therapist1's difference is less, it's preferred
-                        matrix[i, j] = abs(diff2 - diff1) + 1
-                        matrix[j, i] = 1 / matrix[i, j]
-                    elif diff2 < diff1:
-                        # If therapist2's difference is less, it's preferred
-                        matrix[j, i] = abs(diff1 - diff2) + 1
-                        matrix[i, j] = 1 / matrix[j, i]
-                    else:
-                        # If differences are equal, both are equally preferred
-                        matrix[i, j] = 1
-                        matrix[j, i] = 1
-        
-        alternative_matrices[(client_id, criterion_idx)] = matrix
-    
-    print(f"Expert matrix (1x1):\n{expert_matrix}\n")
-    print(f"Criteria matrix ({client_score_length}x{client_score_length}):\n{criteria_matrix}\n")
-    print(f"Number of alternative matrices: {len(alternative_matrices)}")
-    for (expert_id, criterion_idx), matrix in alternative_matrices.items():
-        print(f"\nAlternative matrix for expert {expert_id}, criterion {criterion_idx + 1}:")
-        print(f"Client score for this criterion: {client_scores[criterion_idx]}")
-        print("Therapist differences from client score:")
-        for therapist_id in valid_therapist_ids:
-            print(f"Therapist {therapist_id}: {therapist_score_differences[therapist_id][criterion_idx]}")
-        print("Pairwise comparison matrix:")
-        print(matrix)
+    alternative_matrices = {
+        (client_id, criterion_idx): matrix
+        for criterion_idx, _, matrix in iter_alternative_matrices(differences)
+    }
+    
+    if trace is not None:
+        trace.record("Expert matrix (1x1)", expert_matrix)
+        trace.record(f"Criteria matrix ({client_score_length}x{client_score_length})", criteria_matrix)
+        for (expert_id, criterion_idx), matrix in alternative_matrices.items():
+            label = f"expert {expert_id}, criterion {criterion_idx + 1}"
+            trace.record(f"Client score, {label}", client_scores[criterion_idx])
+            trace.record(
+                f"Therapist differences from client score, {label}",
+                dict(zip(valid_therapist_ids, differences[:, criterion_idx].tolist()))
+            )
+            trace.record(f"Alternative matrix, {label}", matrix)
     
     return expert_matrix, criteria_matrices, alternative_matrices
 
@@ -223,17 +278,314 @@ def calculate_lambda_CI_CR(matrix, max_iterations=100):
     return np.array(vectors).T, np.array(lambda_values).T, lambda_max, CI, CR
 
 
+def calculate_batch_consistency(matrices, max_iterations=100, tolerance=1e-5, return_trace=False):
+    """
+    Calculate lambda_max, CI and CR for a stack of matrices with one shared power iteration.
+
+    Every iteration multiplies all still-running matrices at once; a matrix is masked
+    out as soon as its lambda vector changes by less than the tolerance. Iteration
+    vectors are rescaled to a maximum of 1 after each step (lambda = x^(m+1) / x^(m)
+    does not depend on the scale), so large matrices do not overflow.
+
+    Args:
+        matrices: array of shape (n_matrices, k, k)
+        max_iterations: maximum number of power iterations
+        tolerance: stop once every component of the lambda vector moves less than this
+        return_trace: also return the per-matrix iteration vectors and lambda vectors
+
+    Returns:
+        tuple: (lambda_max, CI, CR), each an array of shape (n_matrices,);
+            with return_trace a fourth element, a list of (vectors, lambda_values)
+            per matrix in the layout of calculate_lambda_CI_CR
+    """
+    matrices = np.asarray(matrices, dtype=np.float64)
+    n_matrices, n = matrices.shape[0], matrices.shape[-1]
+
+    x = np.ones((n_matrices, n))  # Початковий вектор x^(0)
+    prev_lambda_values = np.zeros((n_matrices, n))
+    lambda_vectors = np.ones((n_matrices, n))
+    active = np.ones(n_matrices, dtype=bool)
+
+    if return_trace:
+        vectors_trace = [[row.copy()] for row in x]
+        lambda_trace = [[] for _ in range(n_matrices)]
+
+    for _ in range(max_iterations):
+        running = np.flatnonzero(active)
+        if running.size == 0:
+            break
+
+        x_new = np.einsum('mij,mj->mi', matrices[running], x[running])
+        lambda_vec = x_new / x[running]
+        lambda_vectors[running] = lambda_vec
+
+        x_new /= np.max(np.abs(x_new), axis=1, keepdims=True)
+        if return_trace:
+            for row, matrix_idx in enumerate(running):
+                vectors_trace[matrix_idx].append(x_new[row].copy())
+                lambda_trace[matrix_idx].append(lambda_vec[row].copy())
+
+        converged = np.all(np.abs(lambda_vec - prev_lambda_values[running]) < tolerance, axis=1)
+        active[running[converged]] = False
+        prev_lambda_values[running] = lambda_vec
+        x[running] = x_new
+
+    lambda_max = np.mean(lambda_vectors, axis=1)
+
+    CI = (lambda_max - n) / (n - 1) if n > 1 else np.zeros(n_matrices)
+    CIS = CIS_values.get(n, 0)
+    CR = CI / CIS if CIS != 0 else np.zeros(n_matrices)
+
+    if return_trace:
+        trace = [
+            (np.array(vectors_trace[i]).T, np.array(lambda_trace[i]).T)
+            for i in range(n_matrices)
+        ]
+        return lambda_max, CI, CR, trace
+    return lambda_max, CI, CR
+
+
 def calculate_local_weights(matrix):
     """Обчислення вагових коефіцієнтів методом середніх геометричних"""
-    k = matrix.shape[0]
+    return calculate_batch_weights(matrices=matrix)
+
+
+def calculate_score_differences(client_scores, therapist_scores_dict):
+    """
+    Calculate absolute client-therapist score differences for every criterion.
+
+    Args:
+        client_scores: list of the client's scores ordered by criterion
+        therapist_scores_dict: dict of {therapist_id: list_of_scores}
+
+    Returns:
+        tuple: (valid_therapist_ids, differences)
+            - valid_therapist_ids: list of therapist IDs whose score lists match the client's length
+            - differences: int array of shape (n_therapists, n_criteria)
+    """
+    client_scores = np.asarray(client_scores, dtype=np.int64)
+    valid_therapist_ids = [
+        therapist_id for therapist_id, therapist_scores in therapist_scores_dict.items()
+        if len(therapist_scores) == len(client_scores)
+    ]
+    if not valid_therapist_ids:
+        return [], np.empty((0, len(client_scores)), dtype=np.int64)
+
+    therapist_scores = np.array(
+        [therapist_scores_dict[therapist_id] for therapist_id in valid_therapist_ids],
+        dtype=np.int64
+    )
+    differences = np.abs(therapist_scores - client_scores[np.newaxis, :])
+    return valid_therapist_ids, differences
+
+
+def calculate_difference_histograms(differences):
+    """
+    Count how many therapists have each difference value, per criterion.
+
+    Args:
+        differences: int array of shape (n_therapists, n_criteria) with values 0..8
+
+    Returns:
+        int array of shape (n_criteria, 9)
+    """
+    differences = np.asarray(differences, dtype=np.int64)
+    n_criteria = differences.shape[1]
+    n_values = MAX_SCORE_DIFFERENCE + 1
+
+    # One bincount for all criteria: criterion c uses bins c * 9 .. c * 9 + 8
+    offsets = n_values * np.arange(n_criteria)
+    return np.bincount(
+        (differences + offsets[np.newaxis, :]).ravel(),
+        minlength=n_values * n_criteria
+    ).reshape(n_criteria, n_values)
+
+
+def calculate_histogram_log_means(differences, histograms=None):
+    """
+    Calculate log geometric means of every alternative matrix row without building the matrix.
+
+    Row i of the alternative matrix for criterion c only depends on the difference d_i
+    of therapist i and on how many therapists share each difference value, so the log of
+    its geometric mean is (1 / T) * sum_v h_c[v] * log(a(d_i, v)), where h_c is the
+    histogram of differences for criterion c. This takes O(T * C) time and memory
+    instead of O(C * T^2).
+
+    Args:
+        differences: int array of shape (n_therapists, n_criteria) with values 0..8
+        histograms: optional precomputed calculate_difference_histograms(differences)
+
+    Returns:
+        array of shape (n_criteria, n_therapists)
+    """
+    differences = np.asarray(differences, dtype=np.int64)
+    if histograms is None:
+        histograms = calculate_difference_histograms(differences)
+
+    # log_row_sums[c, v] = sum of log(a_ij) over a row whose own difference is v
+    log_row_sums = histograms @ LOG_PREFERENCE_TABLE.T
+    return np.take_along_axis(log_row_sums, differences.T, axis=1) / differences.shape[0]
+
+
+def _weights_from_log_means(log_means):
+    """Normalize log geometric means along the last axis into weights that sum to 1"""
+    # Shifting by the row maximum keeps exp() finite however large the pool is
+    shifted = np.exp(log_means - np.max(log_means, axis=-1, keepdims=True))
+    weights = shifted / np.sum(shifted, axis=-1, keepdims=True)
+    return weights, np.exp(log_means)
+
+
+def calculate_batch_weights(matrices=None, differences=None):
+    """
+    Calculate geometric-mean weights for a stack of pairwise comparison matrices at once.
+
+    Geometric means are taken in log space with one reduction over the whole stack,
+    so a row product can neither overflow to inf nor underflow to 0 on large pools.
+    Pass either the explicit matrices or the score differences (histogram form).
+
+    Args:
+        matrices: array of shape (..., k, k), e.g. (n_criteria, n_therapists, n_therapists)
+        differences: int array of shape (n_therapists, n_criteria) with values 0..8
+
+    Returns:
+        tuple: (weights, geometric_means), both of shape (..., k);
+            (n_criteria, n_therapists) for the histogram form
+    """
+    if (matrices is None) == (differences is None):
+        raise ValueError("Pass exactly one of matrices or differences")
 
-    # Обчислення середнього геометричного для кожного рядка
-    geometric_means = np.prod(matrix, axis=1) ** (1 / k)
+    if matrices is not None:
+        log_means = np.mean(np.log(np.asarray(matrices, dtype=np.float64)), axis=-1)
+    else:
+        log_means = calculate_histogram_log_means(differences)
 
-    # Нормування середніх геометричних
-    weights = geometric_means / np.sum(geometric_means)
+    return _weights_from_log_means(log_means)
 
-    return weights, geometric_means
+
+def calculate_score_histograms(therapist_scores):
+    """
+    Count how many therapists gave each score value, per criterion.
+
+    Args:
+        therapist_scores: int array of shape (n_therapists, n_criteria) with values 1..9
+
+    Returns:
+        int array of shape (n_criteria, 9), [c, t - 1] counts therapists with score t
+    """
+    therapist_scores = np.asarray(therapist_scores, dtype=np.int64)
+    return calculate_difference_histograms(therapist_scores - 1)
+
+
+def calculate_pool_weight_table(score_histograms):
+    """
+    Alternative weight of a therapist for every (criterion, client score, therapist score).
+
+    With all therapist scores summarized by per-criterion score histograms, a client's
+    difference histogram for criterion c only depends on the client's score s, so the
+    closed-form weights can be tabulated once per pool for all 9 possible client scores.
+
+    Args:
+        score_histograms: int array of shape (n_criteria, 9) from calculate_score_histograms
+
+    Returns:
+        array of shape (n_criteria, 9, 9), [c, s - 1, t - 1] is the weight on criterion c
+        of a therapist with score t for a client with score s
+    """
+    score_histograms = np.asarray(score_histograms, dtype=np.float64)
+    n_criteria, n_values = score_histograms.shape
+    if n_criteria == 0:
+        return np.zeros((0, n_values, n_values))
+    n_therapists = score_histograms[0].sum()
+
+    score_values = np.arange(n_values)
+    differences = np.abs(score_values[:, np.newaxis] - score_values[np.newaxis, :])  # [s, t]
+    is_difference = differences[:, :, np.newaxis] == score_values[np.newaxis, np.newaxis, :]  # [s, t, v]
+
+    # difference_histograms[c, s, v]: therapists whose difference to client score s is v
+    difference_histograms = np.einsum('ct,stv->csv', score_histograms, is_difference)
+    log_row_sums = difference_histograms @ LOG_PREFERENCE_TABLE.T  # [c, s, d]
+    log_means = np.take_along_axis(
+        log_row_sums, np.broadcast_to(differences, log_row_sums.shape), axis=2
+    ) / n_therapists  # [c, s, t]
+
+    # Log means lie within +-log(9), so exp() cannot overflow here
+    geometric_means = np.exp(log_means)
+    totals = np.einsum('cst,ct->cs', geometric_means, score_histograms)
+    return geometric_means / totals[:, :, np.newaxis]
+
+
+def calculate_client_weights(weight_table, client_scores, therapist_scores, client_filled=None):
+    """
+    Global therapist weights for many clients at once.
+
+    Args:
+        weight_table: array of shape (n_criteria, 9, 9) from calculate_pool_weight_table
+        client_scores: int array of shape (n_clients, n_criteria) with values 1..9
+        therapist_scores: int array with values 1..9, either of shape (n_therapists, n_criteria)
+            for therapists shared by all clients, or of shape (n_clients, n_therapists, n_criteria)
+            for different therapists per client
+        client_filled: optional bool array of shape (n_clients, n_criteria); criteria a
+            client has not scored are left out of that client's mean
+
+    Returns:
+        array of shape (n_clients, n_therapists)
+    """
+    client_scores = np.asarray(client_scores, dtype=np.int64)
+    therapist_scores = np.asarray(therapist_scores, dtype=np.int64)
+    if therapist_scores.ndim == 2:
+        therapist_scores = therapist_scores[np.newaxis]
+    n_clients, n_criteria = client_scores.shape
+    if client_filled is None:
+        client_filled = np.ones(client_scores.shape, dtype=bool)
+
+    # One (clients x therapists) gather per criterion keeps memory at O(B * T)
+    weights = np.zeros((n_clients, therapist_scores.shape[1]))
+    for criterion_idx in range(n_criteria):
+        client_rows = np.maximum(client_scores[:, criterion_idx] - 1, 0)
+        criterion_weights = weight_table[criterion_idx][
+            client_rows[:, np.newaxis], therapist_scores[:, :, criterion_idx] - 1
+        ]
+        weights += np.where(client_filled[:, criterion_idx, np.newaxis], criterion_weights, 0)
+
+    # Criteria are all equal, so the global weight is the mean over scored criteria
+    return weights / np.maximum(client_filled.sum(axis=1), 1)[:, np.newaxis]
+
+
+def rank_top_k(weights, top_k=None):
+    """
+    Positions of the top_k largest weights along the last axis, best first.
+
+    np.argpartition selects the candidates in O(T) and only those k are sorted,
+    instead of sorting the whole pool. Equal weights are ordered by position.
+
+    Args:
+        weights: array of shape (..., n_therapists)
+        top_k: number of positions to return; None returns the full ranking
+
+    Returns:
+        int array of shape (..., min(top_k, n_therapists))
+    """
+    weights = np.asarray(weights)
+    n_therapists = weights.shape[-1]
+    if top_k is None or top_k >= n_therapists:
+        return np.argsort(-weights, axis=-1, kind='stable')
+    if top_k <= 0:
+        return np.zeros(weights.shape[:-1] + (0,), dtype=np.intp)
+
+    # The k-th largest weight; ties with it are resolved by position like a stable sort
+    kth_weight = np.take_along_axis(
+        weights, np.argpartition(-weights, top_k - 1, axis=-1)[..., top_k - 1:top_k], axis=-1
+    )
+    above = weights > kth_weight
+    at_kth = weights == kth_weight
+    ties_needed = top_k - np.sum(above, axis=-1, keepdims=True)
+    selected = above | (at_kth & (np.cumsum(at_kth, axis=-1) <= ties_needed))
+
+    # Exactly top_k positions are selected in every row, in position order
+    candidates = np.nonzero(selected)[-1].reshape(weights.shape[:-1] + (top_k,))
+    candidate_weights = np.take_along_axis(weights, candidates, axis=-1)
+    order = np.lexsort((candidates, -candidate_weights), axis=-1)
+    return np.take_along_axis(candidates, order, axis=-1)
 
 
 def calculate_expert_global_weights(criteria_matrices, alternative_matrices):
@@ -249,7 +601,7 @@ def calculate_expert_global_weights(criteria_matrices, alternative_matrices):
         alternative_weights = np.array(alternative_weights)  # p_ij(s)
 
         global_weights = np.dot(np.diag(criteria_weights), alternative_weights)  # w_j(s) * p_ij(s)
-        print(f"global_weights expert {expert}\n{global_weights}")
+        logger.debug("global_weights expert %s\n%s", expert, global_weights)
         global_sum = np.sum(global_weights, axis=0)  # ∑ w_j(s) * p_ij(s)
 
         expert_global_weights.append(global_sum)
@@ -259,104 +611,153 @@ def calculate_expert_global_weights(criteria_matrices, alternative_matrices):
     return expert_global_weights
 
 
-def run_algorithm(client_user):
+def _record_consistency(trace, label, lambda_max, CI, CR):
+    # Максимальне характеристичне число, індекс та коефіцієнт узгодженості
+    logger.debug("%s: lambda_max=%.5f CI=%.5f CR=%.5f", label, lambda_max, CI, CR)
+    if trace is not None:
+        trace.record(f"Узгодженість, {label}", {'lambda_max': lambda_max, 'CI': CI, 'CR': CR})
+
+
+def _run_matrix_engine(client_scores_dict, therapist_scores_dict, check_consistency=True, trace=None):
+    """
+    Calculate global therapist weights from explicit pairwise comparison matrices.
+
+    Consistency results are logged at DEBUG level and recorded into the trace, if any.
+
+    Returns:
+        tuple: (valid_therapist_ids, global_weights)
+    """
+    # Create matrices for the AHP algorithm
+    expert_matrix, criteria_matrices, alternative_matrices = create_mpp_matrices(
+        client_scores_dict, therapist_scores_dict, trace=trace
+    )
+    
+    # Only therapists with a full set of scores take part in the comparison
+    client_scores = next(iter(client_scores_dict.values()))
+    valid_therapist_ids, _ = calculate_score_differences(client_scores, therapist_scores_dict)
+    if not valid_therapist_ids:
+        return [], np.zeros(0)
+    
+    criteria_stack = np.stack(list(criteria_matrices.values()))
+    alternative_stack = np.stack(list(alternative_matrices.values()))
+
+    if check_consistency:
+        _record_consistency(
+            trace, "МПП експертів", *(values[0] for values in calculate_batch_consistency(expert_matrix[np.newaxis]))
+        )
+        for expert_id, *consistency in zip(criteria_matrices, *calculate_batch_consistency(criteria_stack)):
+            _record_consistency(trace, f"МПП критеріїв, експерт {expert_id}", *consistency)
+        for (expert_id, criterion_idx), *consistency in zip(
+            alternative_matrices, *calculate_batch_consistency(alternative_stack)
+        ):
+            _record_consistency(
+                trace, f"МПП альтернатив, експерт {expert_id}, критерій {criterion_idx + 1}", *consistency
+            )
+
+    # Weights of all criteria matrices in one batched reduction
+    criteria_weights, _ = calculate_batch_weights(matrices=criteria_stack)
+
+    # Weights of all alternative matrices in one batched reduction: shape (C, T)
+    alternative_weights, _ = calculate_batch_weights(matrices=alternative_stack)
+
+    if trace is not None:
+        trace.record("Вагові коефіцієнти експертів", calculate_local_weights(expert_matrix)[0])
+        trace.record("Вагові коефіцієнти критеріїв", criteria_weights)
+        trace.record("Вагові коефіцієнти альтернатив", alternative_weights)
+
+    # Since all criteria are equal, the global weight is the mean over criteria
+    global_weights = np.mean(alternative_weights, axis=0)
+
+    return valid_therapist_ids, global_weights
+
+
+def run_algorithm(client_user, engine=ENGINE_HISTOGRAM, check_consistency=False, top_k=None, trace=None):
     """
     Run the matching algorithm for a client to find suitable therapists.
     
     Args:
         client_user: The User instance of the logged-in client
+        engine: ENGINE_HISTOGRAM (default) computes the alternative weights in closed form
+            from per-criterion difference histograms; ENGINE_MATRIX builds the explicit
+            pairwise comparison matrices
+        check_consistency: report lambda_max, CI and CR of every matrix; off by default to
+            keep the client request path fast. Raises ValueError with ENGINE_HISTOGRAM
+        top_k: number of best therapists to rank and store; settings.MATCHING_TOP_K if None
+        trace: optional MatchTrace that receives matrices, weights and the ranking;
+            nothing is formatted or kept when it is None
+    
+    Rankings are cached by client score vector and therapist pool version (see
+    ranking_cache), so clients with identical scores share one computation. Runs
+    that check consistency or capture a trace always compute.
         
     Returns:
         tuple: (ranked_therapist_ids, ranked_weights)
-            - ranked_therapist_ids: list of therapist IDs in order of preference
+            - ranked_therapist_ids: list of the top_k therapist IDs in order of preference
             - ranked_weights: list of corresponding weights
     """
-    # Get client and therapist scores
-    client_scores_dict, therapist_scores_dict = get_client_matching_data(client_user)
-    
-    # Create matrices for the AHP algorithm
-    expert_matrix, criteria_matrices, alternative_matrices = create_mpp_matrices(
-        client_scores_dict, therapist_scores_dict
+    # Imported here because the index itself builds on this module
+    from .score_index import therapist_score_index
+
+    if check_consistency and engine != ENGINE_MATRIX:
+        raise ValueError("check_consistency needs ENGINE_MATRIX, the histogram engine builds no matrices")
+    if top_k is None:
+        top_k = settings.MATCHING_TOP_K
+
+    # Get client scores; therapist scores come from the in-process score index
+    client_scores_by_criterion = load_user_scores(client_user)
+    pool = therapist_score_index.snapshot_for(client_scores_by_criterion.keys())
+
+    ranking_cache = get_ranking_cache()
+    use_cache = not check_consistency and trace is None
+    cache_key = make_ranking_key(
+        list(client_scores_by_criterion.keys()), list(client_scores_by_criterion.values()),
+        pool.version, engine, top_k
+    )
+    cached = ranking_cache.get(cache_key) if use_cache else None
+    if cached is not None:
+        ranked_therapist_ids, ranked_weights, pool_size = cached
+        save_rankings([client_user.id], [ranked_therapist_ids], [ranked_weights], pool_size=pool_size)
+        return list(ranked_therapist_ids), list(ranked_weights)
+
+    client_scores, valid_therapist_ids, therapist_scores = get_indexed_matching_data(
+        client_user, client_scores_by_criterion, pool
     )
-    
-    # Get valid therapist IDs directly from therapist_scores_dict
-    valid_therapist_ids = list(therapist_scores_dict.keys())
     if not valid_therapist_ids:
         return [], []
     
-    print("МПП експертів:")
-    vectors, lambda_values, lambda_max, CI, CR = calculate_lambda_CI_CR(expert_matrix)
-    print(f"Максимальне характеристичне число: {lambda_max:.5f}")
-    print(f"Індекс узгодженості CI: {CI:.5f}")
-    print(f"Коефіцієнт узгодженості CR: {CR:.5f}")
-
-    expert_weights, _ = calculate_local_weights(expert_matrix)
-    print("Вагові коефіцієнти експертів:", expert_weights)
-    
-    print("\n\nМПП критеріїв:")
-    criteria_weights = {}  # Store weights for each expert
-    for expert_id, matrix in criteria_matrices.items():
-        print(f"Експерт {expert_id}:")
-        vectors, lambda_values, lambda_max, CI, CR = calculate_lambda_CI_CR(matrix)
-        print(f"Максимальне характеристичне число: {lambda_max:.5f}")
-        print(f"Індекс узгодженості CI: {CI:.5f}")
-        print(f"Коефіцієнт узгодженості CR: {CR:.5f}")
-
-        weights, _ = calculate_local_weights(matrix)
-        criteria_weights[expert_id] = weights
-        print("Вагові коефіцієнти критеріїв:", weights, "\n")
-
-    print("\n\nМПП альтернатив:")
-    alternative_weights = {}  # Store weights for each criterion
-    for (expert_id, criterion_idx), matrix in alternative_matrices.items():
-        print(f"Експерт {expert_id}, Критерій {criterion_idx + 1}:")
-        vectors, lambda_values, lambda_max, CI, CR = calculate_lambda_CI_CR(matrix)
-        print(f"Максимальне характеристичне число: {lambda_max:.5f}")
-        print(f"Індекс узгодженості CI: {CI:.5f}")
-        print(f"Коефіцієнт узгодженості CR: {CR:.5f}")
-
-        weights, _ = calculate_local_weights(matrix)
-        alternative_weights[(expert_id, criterion_idx)] = weights
-        print("Вагові коефіцієнти альтернатив:", weights, "\n")
-
-    # Calculate global weights for each criterion
-    global_weights = np.zeros(len(valid_therapist_ids))
-    for criterion_idx, weights in alternative_weights.items():
-        # Since all criteria are equal, we just average the weights
-        global_weights += weights / len(alternative_weights)
-
-    # Create a dictionary mapping therapist IDs to their global weights
-    therapist_weights = dict(zip(valid_therapist_ids, global_weights))
-    
-    # Sort therapists by their weights in descending order
-    ranked_therapist_ids = sorted(
-        therapist_weights.keys(),
-        key=lambda x: therapist_weights[x],
-        reverse=True
-    )
-    ranked_weights = [therapist_weights[tid] for tid in ranked_therapist_ids]
-    
-    print("\n\nГлобальні пріоритети альтернатив (ранжовані):")
-    for therapist_id, weight in zip(ranked_therapist_ids, ranked_weights):
-        print(f"Терапевт {therapist_id}: {weight:.5f}")
-    
-    print(f"\nНайкращий терапевт: {ranked_therapist_ids[0]}")
-    
-    # Save results to database
-    from .models import MatchingResult
+    if engine == ENGINE_HISTOGRAM:
+        differences = np.abs(therapist_scores.astype(np.int64) - client_scores[np.newaxis, :])
+
+        # Criteria are all equal, so the global weight is the mean over criteria
+        alternative_weights, _ = calculate_batch_weights(differences=differences)
+        global_weights = np.mean(alternative_weights, axis=0)
+        if trace is not None:
+            trace.record("Вагові коефіцієнти альтернатив", alternative_weights)
+    elif engine == ENGINE_MATRIX:
+        client_scores_dict = {client_user.id: client_scores.tolist()}
+        therapist_scores_dict = dict(zip(valid_therapist_ids, therapist_scores.tolist()))
+        valid_therapist_ids, global_weights = _run_matrix_engine(
+            client_scores_dict, therapist_scores_dict, check_consistency=check_consistency, trace=trace
+        )
+        if not valid_therapist_ids:
+            return [], []
+    else:
+        raise ValueError(f"Unknown matching engine: {engine}")
+
+    # Select the best top_k therapists by weight, in descending order
+    order = rank_top_k(global_weights, top_k)
+    ranked_therapist_ids = np.asarray(valid_therapist_ids)[order].tolist()
+    ranked_weights = global_weights[order].tolist()
     
-    # Delete old results for this client
-    MatchingResult.objects.filter(client=client_user).delete()
+    if trace is not None:
+        trace.record("Глобальні пріоритети альтернатив (ранжовані)", dict(zip(ranked_therapist_ids, ranked_weights)))
+    logger.debug("Best therapist for client %s: %s", client_user.pk, ranked_therapist_ids[0])
     
-    # Save new results
-    for rank, (therapist_id, weight) in enumerate(zip(ranked_therapist_ids, ranked_weights), 1):
-        therapist = User.objects.get(id=therapist_id)
-        MatchingResult.objects.create(
-            client=client_user,
-            therapist=therapist,
-            score=weight,
-            rank=rank
-        )
+    if use_cache:
+        ranking_cache.set(cache_key, (tuple(ranked_therapist_ids), tuple(ranked_weights), len(valid_therapist_ids)))
+
+    # Save results to database, replacing the old ranking in one transaction
+    save_rankings([client_user.id], [ranked_therapist_ids], [ranked_weights], pool_size=len(valid_therapist_ids))
     
     return ranked_therapist_ids, ranked_weights
 
@@ -0,0 +1,25 @@
+# Generated by Django 5.2.1 on 2026-10-18 11:40
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('matching', '0003_matchingresult'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MatchingResultSet',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('pool_size', models.PositiveIntegerField(default=0, help_text='Number of therapists the client was ranked against', verbose_name='Pool Size')),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('client', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='matching_result_set', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+    ]
@@ -0,0 +1,49 @@
+# Generated by Django 5.2.1 on 2026-10-18 11:46
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+def create_missing_result_sets(apps, schema_editor):
+    # Rankings stored before result sets existed are version 0 of a new result set
+    MatchingResult = apps.get_model('matching', 'MatchingResult')
+    MatchingResultSet = apps.get_model('matching', 'MatchingResultSet')
+    client_ids = (
+        MatchingResult.objects
+        .filter(client__matching_result_set__isnull=True)
+        .values_list('client_id', flat=True)
+        .distinct()
+    )
+    MatchingResultSet.objects.bulk_create(
+        [MatchingResultSet(client_id=client_id, version=0) for client_id in client_ids]
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('matching', '0004_matchingresultset'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AlterUniqueTogether(
+            name='matchingresult',
+            unique_together=set(),
+        ),
+        migrations.AddField(
+            model_name='matchingresult',
+            name='version',
+            field=models.PositiveIntegerField(default=0, help_text="Version of the client's result set this row belongs to", verbose_name='Version'),
+        ),
+        migrations.AddField(
+            model_name='matchingresultset',
+            name='version',
+            field=models.PositiveIntegerField(default=0, help_text='Version of the MatchingResult rows that make up the current ranking', verbose_name='Version'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='matchingresult',
+            unique_together={('client', 'version', 'therapist')},
+        ),
+        migrations.RunPython(create_missing_result_sets, migrations.RunPython.noop),
+    ]
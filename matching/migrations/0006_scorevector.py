@@ -0,0 +1,30 @@
+# Generated by Django 5.2.1 on 2026-10-18 11:51
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('matching', '0005_matching_result_versions'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ScoreVector',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('scores', models.BinaryField(help_text='One byte per criterion in criterion id order, 0 if not scored', verbose_name='Scores')),
+                ('catalog_version', models.PositiveBigIntegerField(help_text='Layout version of the criterion catalog the scores were packed against', verbose_name='Catalog Version')),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='score_vector', to=settings.AUTH_USER_MODEL, verbose_name='User')),
+            ],
+            options={
+                'verbose_name': 'Score Vector',
+                'verbose_name_plural': 'Score Vectors',
+            },
+        ),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 5.2.1 on 2026-10-18 11:53
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('matching', '0006_scorevector'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='matchingresult',
+            index=models.Index(fields=['client', 'rank'], name='matchresult_client_rank_idx'),
+        ),
+    ]
@@ -0,0 +1,35 @@
+# Generated by Django 5.2.1 on 2026-10-18 11:55
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('matching', '0007_hot_query_indexes'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MatchJob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('status', models.CharField(choices=[('pending', 'Pending'), ('running', 'Running'), ('done', 'Done'), ('failed', 'Failed')], default='pending', max_length=10, verbose_name='Status')),
+                ('requested_at', models.DateTimeField(default=django.utils.timezone.now, verbose_name='Requested At')),
+                ('started_at', models.DateTimeField(blank=True, null=True, verbose_name='Started At')),
+                ('finished_at', models.DateTimeField(blank=True, null=True, verbose_name='Finished At')),
+                ('attempts', models.PositiveIntegerField(default=0, verbose_name='Attempts')),
+                ('error', models.TextField(blank=True, verbose_name='Error')),
+                ('client', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='match_job', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'verbose_name': 'Match Job',
+                'verbose_name_plural': 'Match Jobs',
+                'indexes': [models.Index(fields=['status', 'requested_at'], name='matchjob_status_requested_idx')],
+            },
+        ),
+    ]
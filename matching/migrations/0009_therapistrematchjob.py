@@ -0,0 +1,37 @@
+# Generated by Django 5.2.1 on 2026-10-18 12:22
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('matching', '0008_matchjob'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TherapistRematchJob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('status', models.CharField(choices=[('pending', 'Pending'), ('running', 'Running'), ('done', 'Done'), ('failed', 'Failed')], default='pending', max_length=10, verbose_name='Status')),
+                ('old_scores', models.JSONField(blank=True, help_text='Score row of the therapist before the change, in criterion id order; empty if they were not in the pool', null=True, verbose_name='Old Scores')),
+                ('pool_version', models.BigIntegerField(blank=True, help_text='Pool version right after the change, if the change only affected this therapist', null=True, verbose_name='Pool Version')),
+                ('requested_at', models.DateTimeField(default=django.utils.timezone.now, verbose_name='Requested At')),
+                ('started_at', models.DateTimeField(blank=True, null=True, verbose_name='Started At')),
+                ('finished_at', models.DateTimeField(blank=True, null=True, verbose_name='Finished At')),
+                ('attempts', models.PositiveIntegerField(default=0, verbose_name='Attempts')),
+                ('error', models.TextField(blank=True, verbose_name='Error')),
+                ('therapist', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='rematch_jobs', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'verbose_name': 'Therapist Rematch Job',
+                'verbose_name_plural': 'Therapist Rematch Jobs',
+                'indexes': [models.Index(fields=['status', 'requested_at'], name='rematchjob_status_req_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.1 on 2026-10-18 12:35
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('matching', '0009_therapistrematchjob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='therapistrematchjob',
+            name='new_scores',
+            field=models.JSONField(blank=True, help_text='Score row of the therapist after the change, in criterion id order; empty if they left the pool', null=True, verbose_name='New Scores'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.1 on 2026-10-18 12:39
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('matching', '0010_therapistrematchjob_new_scores'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='therapistrematchjob',
+            name='heartbeat_at',
+            field=models.DateTimeField(blank=True, help_text='Last time the worker running the job reported progress', null=True, verbose_name='Heartbeat At'),
+        ),
+    ]
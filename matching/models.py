@@ -1,6 +1,7 @@
 from django.db import models
 from django.utils.translation import gettext_lazy as _
 from django.core.validators import MinValueValidator, MaxValueValidator
+from django.utils import timezone
 from users.models import User
 
 class Criterion(models.Model):
@@ -82,15 +83,189 @@ class CriterionScore(models.Model):
         """Check if this score is from a client"""
         return self.user.user_role == 'client'
 
+class ScoreVector(models.Model):
+    """
+    All scores of one user packed into a single row, next to their CriterionScore rows.
+    Byte i of scores is the score for the i-th criterion of the criterion catalog
+    (ordered by id), 0 where the user has no score for it. Vectors packed against
+    another criterion layout than the current one are ignored until repacked.
+    """
+    user = models.OneToOneField(
+        User,
+        on_delete=models.CASCADE,
+        related_name='score_vector',
+        verbose_name=_('User')
+    )
+    scores = models.BinaryField(
+        verbose_name=_('Scores'),
+        help_text=_('One byte per criterion in criterion id order, 0 if not scored')
+    )
+    catalog_version = models.PositiveBigIntegerField(
+        verbose_name=_('Catalog Version'),
+        help_text=_('Layout version of the criterion catalog the scores were packed against')
+    )
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        verbose_name = _('Score Vector')
+        verbose_name_plural = _('Score Vectors')
+
+    def __str__(self):
+        return f"{self.user.get_full_name()}: {list(bytes(self.scores))}"
+
+class MatchingResultQuerySet(models.QuerySet):
+    def current(self):
+        """Only rows of the result set version each client currently points to"""
+        return self.filter(version=models.F('client__matching_result_set__version'))
+
 class MatchingResult(models.Model):
     client = models.ForeignKey(User, on_delete=models.CASCADE, related_name='matching_results')
     therapist = models.ForeignKey(User, on_delete=models.CASCADE, related_name='client_matches')
     score = models.FloatField()
     rank = models.IntegerField()
+    version = models.PositiveIntegerField(
+        default=0,
+        verbose_name=_('Version'),
+        help_text=_('Version of the client\'s result set this row belongs to')
+    )
+
+    objects = MatchingResultQuerySet.as_manager()
     
     class Meta:
-        unique_together = ('client', 'therapist')
+        unique_together = ('client', 'version', 'therapist')
         ordering = ['client', 'rank']
+        indexes = [
+            # A client's ranking in rank order: filter(client=...).order_by('rank')
+            models.Index(fields=['client', 'rank'], name='matchresult_client_rank_idx'),
+        ]
     
     def __str__(self):
         return f"{self.client.get_full_name()} - {self.therapist.get_full_name()}: {self.score:.4f} (rank {self.rank})"
+
+class MatchingResultSet(models.Model):
+    """
+    Summary of the ranking currently stored for a client.
+    Only the top-ranked therapists are kept as MatchingResult rows,
+    pool_size records how many therapists the client was ranked against.
+    A new ranking is written under the next version and becomes visible
+    when version is switched to it, so readers never see a partial ranking.
+    """
+    client = models.OneToOneField(User, on_delete=models.CASCADE, related_name='matching_result_set')
+    version = models.PositiveIntegerField(
+        default=0,
+        verbose_name=_('Version'),
+        help_text=_('Version of the MatchingResult rows that make up the current ranking')
+    )
+    pool_size = models.PositiveIntegerField(
+        default=0,
+        verbose_name=_('Pool Size'),
+        help_text=_('Number of therapists the client was ranked against')
+    )
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.client.get_full_name()}: {self.pool_size} therapists"
+
+class MatchJob(models.Model):
+    """
+    Request to (re)compute a client's ranking in the background.
+    There is at most one job per client: submitting the survey again while a job
+    is pending or running moves requested_at forward and sets it back to pending,
+    so the worker picks it up again with the latest scores.
+    """
+    STATUS_PENDING = 'pending'
+    STATUS_RUNNING = 'running'
+    STATUS_DONE = 'done'
+    STATUS_FAILED = 'failed'
+    STATUS_CHOICES = (
+        (STATUS_PENDING, _('Pending')),
+        (STATUS_RUNNING, _('Running')),
+        (STATUS_DONE, _('Done')),
+        (STATUS_FAILED, _('Failed')),
+    )
+
+    client = models.OneToOneField(User, on_delete=models.CASCADE, related_name='match_job')
+    status = models.CharField(
+        max_length=10,
+        choices=STATUS_CHOICES,
+        default=STATUS_PENDING,
+        verbose_name=_('Status')
+    )
+    requested_at = models.DateTimeField(default=timezone.now, verbose_name=_('Requested At'))
+    started_at = models.DateTimeField(null=True, blank=True, verbose_name=_('Started At'))
+    finished_at = models.DateTimeField(null=True, blank=True, verbose_name=_('Finished At'))
+    attempts = models.PositiveIntegerField(default=0, verbose_name=_('Attempts'))
+    error = models.TextField(blank=True, verbose_name=_('Error'))
+
+    class Meta:
+        verbose_name = _('Match Job')
+        verbose_name_plural = _('Match Jobs')
+        indexes = [
+            # Workers claim the oldest pending jobs first
+            models.Index(fields=['status', 'requested_at'], name='matchjob_status_requested_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.client.get_full_name()}: {self.get_status_display()}"
+
+    @property
+    def is_active(self):
+        return self.status in (self.STATUS_PENDING, self.STATUS_RUNNING)
+
+
+class TherapistRematchJob(models.Model):
+    """
+    Request to update the stored rankings of all clients after a therapist saved
+    their survey.
+
+    The job keeps the therapist's score rows from before and after the change and
+    the pool version right after it. While the pool is still at that version, the
+    worker patches the rankings incrementally; otherwise it recomputes them against
+    the current pool. Jobs run one at a time, in the order they were requested.
+    """
+    therapist = models.ForeignKey(User, on_delete=models.CASCADE, related_name='rematch_jobs')
+    status = models.CharField(
+        max_length=10,
+        choices=MatchJob.STATUS_CHOICES,
+        default=MatchJob.STATUS_PENDING,
+        verbose_name=_('Status')
+    )
+    old_scores = models.JSONField(
+        null=True,
+        blank=True,
+        verbose_name=_('Old Scores'),
+        help_text=_('Score row of the therapist before the change, in criterion id order; empty if they were not in the pool')
+    )
+    new_scores = models.JSONField(
+        null=True,
+        blank=True,
+        verbose_name=_('New Scores'),
+        help_text=_('Score row of the therapist after the change, in criterion id order; empty if they left the pool')
+    )
+    pool_version = models.BigIntegerField(
+        null=True,
+        blank=True,
+        verbose_name=_('Pool Version'),
+        help_text=_('Pool version right after the change, if the change only affected this therapist')
+    )
+    requested_at = models.DateTimeField(default=timezone.now, verbose_name=_('Requested At'))
+    started_at = models.DateTimeField(null=True, blank=True, verbose_name=_('Started At'))
+    heartbeat_at = models.DateTimeField(
+        null=True,
+        blank=True,
+        verbose_name=_('Heartbeat At'),
+        help_text=_('Last time the worker running the job reported progress')
+    )
+    finished_at = models.DateTimeField(null=True, blank=True, verbose_name=_('Finished At'))
+    attempts = models.PositiveIntegerField(default=0, verbose_name=_('Attempts'))
+    error = models.TextField(blank=True, verbose_name=_('Error'))
+
+    class Meta:
+        verbose_name = _('Therapist Rematch Job')
+        verbose_name_plural = _('Therapist Rematch Jobs')
+        indexes = [
+            models.Index(fields=['status', 'requested_at'], name='rematchjob_status_req_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.therapist.get_full_name()}: {self.get_status_display()}"
@@ -0,0 +1,114 @@
+import hashlib
+import threading
+from collections import OrderedDict
+
+import numpy as np
+from django.conf import settings
+from django.core.cache import caches
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django.utils.module_loading import import_string
+
+RANKING_CACHE_KEY_PREFIX = 'matching:ranking'
+
+DEFAULT_RANKING_CACHE = {
+    'BACKEND': 'matching.ranking_cache.LRURankingCache',
+    'OPTIONS': {},
+}
+
+
+def make_ranking_key(criterion_ids, client_scores, pool_version, engine, top_k):
+    """
+    Cache key of one ranking.
+
+    Clients with the same ordered score vector get the same ranking from the same
+    therapist pool, so the key is a hash of the vector (with the criteria it refers
+    to) plus the pool version. Any change to the pool bumps its version, which makes
+    every older entry unreachable.
+    """
+    criterion_ids = np.asarray(criterion_ids, dtype=np.int64)
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(np.int64(len(criterion_ids)).tobytes())
+    digest.update(criterion_ids.tobytes())
+    digest.update(np.asarray(client_scores, dtype=np.int64).tobytes())
+    digest.update(f"{engine}:{top_k}".encode())
+    return f"{RANKING_CACHE_KEY_PREFIX}:{pool_version}:{digest.hexdigest()}"
+
+
+class LRURankingCache:
+    """In-process ranking cache that evicts the least recently used ranking"""
+
+    def __init__(self, max_entries=1024):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    def get(self, key):
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class DjangoCacheRankingCache:
+    """
+    Ranking cache kept in one of the CACHES aliases, shared between processes.
+
+    Eviction is left to the cache backend.
+    """
+
+    def __init__(self, alias='default', timeout=3600):
+        self.alias = alias
+        self.timeout = timeout
+
+    @property
+    def cache(self):
+        return caches[self.alias]
+
+    def get(self, key):
+        return self.cache.get(key)
+
+    def set(self, key, value):
+        self.cache.set(key, value, timeout=self.timeout)
+
+    def clear(self):
+        # Entries of older pool versions are never read again and expire on their own
+        pass
+
+
+_ranking_cache = None
+_ranking_cache_lock = threading.Lock()
+
+
+def get_ranking_cache():
+    """The ranking cache configured by settings.MATCHING_RANKING_CACHE"""
+    global _ranking_cache
+    with _ranking_cache_lock:
+        if _ranking_cache is None:
+            config = getattr(settings, 'MATCHING_RANKING_CACHE', DEFAULT_RANKING_CACHE)
+            backend = import_string(config['BACKEND'])
+            _ranking_cache = backend(**config.get('OPTIONS', {}))
+        return _ranking_cache
+
+
+@receiver(setting_changed)
+def reset_ranking_cache(setting, **kwargs):
+    global _ranking_cache
+    if setting == 'MATCHING_RANKING_CACHE':
+        with _ranking_cache_lock:
+            _ranking_cache = None
@@ -0,0 +1,230 @@
+import hashlib
+import threading
+from collections import namedtuple
+
+import numpy as np
+
+from config.cache import bump_version, get_version
+
+from .data_access import get_surveyed_therapists, load_score_vectors
+from .matching_algorithm import calculate_score_histograms
+
+# Shared pool version, so every process notices changes made by the others. The
+# web and match worker processes share it through the CACHES backend in settings.
+POOL_VERSION_CACHE_KEY = 'matching:therapist_pool_version'
+
+
+class ScoreIndexSnapshot(namedtuple(
+    'ScoreIndexSnapshot', ['therapist_ids', 'criterion_ids', 'scores', 'score_histograms', 'version']
+)):
+    """
+    Immutable view of the therapist score index.
+
+    - therapist_ids: int64 array of shape (n_therapists,), ascending
+    - criterion_ids: int64 array of shape (n_criteria,), ordered by id
+    - scores: int8 array of shape (n_therapists, n_criteria)
+    - score_histograms: int64 array of shape (n_criteria, 9), therapists per score value
+    - version: therapist pool version the snapshot was built for
+    """
+    __slots__ = ()
+
+    def get_scores(self, therapist_id):
+        """A therapist's score row, or None if the therapist is not in the pool"""
+        row = np.searchsorted(self.therapist_ids, therapist_id)
+        if row < len(self.therapist_ids) and self.therapist_ids[row] == therapist_id:
+            return self.scores[row]
+        return None
+
+    def fingerprint(self):
+        """
+        Hash of the therapists, criteria and scores in the snapshot.
+
+        Computed from the pool data alone, so two processes that loaded the same pool
+        agree on it whatever their pool versions are.
+        """
+        digest = hashlib.blake2b(digest_size=16)
+        for array in (self.therapist_ids, self.criterion_ids, self.scores):
+            digest.update(np.int64(array.size).tobytes())
+            digest.update(np.ascontiguousarray(array).tobytes())
+        return digest.hexdigest()
+
+    def with_therapist_scores(self, therapist_id, scores):
+        """
+        Copy of the snapshot with one therapist's score row replaced, added, or
+        removed when scores is None.
+        """
+        row = np.searchsorted(self.therapist_ids, therapist_id)
+        therapist_ids, matrix = self.therapist_ids, self.scores
+        if row < len(therapist_ids) and therapist_ids[row] == therapist_id:
+            therapist_ids = np.delete(therapist_ids, row)
+            matrix = np.delete(matrix, row, axis=0)
+        if scores is not None:
+            therapist_ids = np.insert(therapist_ids, row, therapist_id)
+            matrix = np.insert(matrix, row, np.asarray(scores, dtype=np.int8), axis=0)
+        return self._replace(
+            therapist_ids=therapist_ids, scores=matrix, score_histograms=calculate_score_histograms(matrix)
+        )
+
+    def _columns(self, criterion_ids):
+        """Columns of the given criteria, and which of them are in the snapshot"""
+        criterion_ids = np.asarray(list(criterion_ids), dtype=np.int64)
+        columns = np.searchsorted(self.criterion_ids, criterion_ids)
+        found = columns < len(self.criterion_ids)
+        found[found] = self.criterion_ids[columns[found]] == criterion_ids[found]
+        return criterion_ids, columns, found
+
+    def has_criteria(self, criterion_ids):
+        """Whether the snapshot holds a score column for every given criterion"""
+        _, _, found = self._columns(criterion_ids)
+        return bool(np.all(found))
+
+    def select(self, criterion_ids):
+        """
+        Score columns for the given criteria, in the given order.
+
+        Returns:
+            int8 array of shape (n_therapists, len(criterion_ids))
+
+        Raises:
+            KeyError: a criterion is not in the snapshot, e.g. because it was added
+                after the snapshot was built
+        """
+        criterion_ids, columns, found = self._columns(criterion_ids)
+        if not np.all(found):
+            raise KeyError(f"Criteria not in the score index: {criterion_ids[~found].tolist()}")
+        return self.scores[:, columns]
+
+
+class TherapistScoreIndex:
+    """
+    In-process index of the scores of all therapists who completed their survey.
+
+    Scores live in one dense int8 matrix with aligned therapist-id and criterion-id
+    arrays. Only therapists with a score for every criterion are included. The arrays
+    are never modified in place: updates swap in new arrays, so a snapshot stays
+    valid for as long as a caller holds it.
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._snapshot = None
+        self._positions = {}  # therapist_id -> row in the score matrix
+        self._stale = True
+
+    @staticmethod
+    def get_pool_version():
+        return get_version(POOL_VERSION_CACHE_KEY)
+
+    @staticmethod
+    def _bump_pool_version():
+        return bump_version(POOL_VERSION_CACHE_KEY)
+
+    @property
+    def version(self):
+        return self.snapshot().version
+
+    def snapshot(self):
+        """Return the current ScoreIndexSnapshot, rebuilding it if it is stale"""
+        pool_version = self.get_pool_version()
+        with self._lock:
+            if self._stale or self._snapshot is None or self._snapshot.version != pool_version:
+                self._rebuild(pool_version)
+            return self._snapshot
+
+    def snapshot_for(self, criterion_ids):
+        """
+        Return the current ScoreIndexSnapshot, rebuilt once if it lacks any of the
+        given criteria.
+
+        A criterion created in another process reaches this one through the pool
+        version, so a snapshot can miss it until that bump is committed.
+        """
+        snapshot = self.snapshot()
+        if not snapshot.has_criteria(criterion_ids):
+            self.invalidate()
+            snapshot = self.snapshot()
+        return snapshot
+
+    def invalidate(self):
+        """Bump the pool version and rebuild the index on next access"""
+        with self._lock:
+            self._bump_pool_version()
+            self._stale = True
+
+    def update_score(self, therapist_id, criterion_id, score):
+        """Apply a single changed therapist score"""
+        self.update_scores(therapist_id, {criterion_id: score})
+
+    def update_scores(self, therapist_id, scores):
+        """
+        Apply changed scores of one therapist, given as {criterion_id: score}.
+
+        Falls back to invalidate() when the therapist or a criterion is not indexed yet
+        or when another process changed the pool since our last build.
+        """
+        with self._lock:
+            snapshot = self._snapshot
+            row = self._positions.get(therapist_id)
+            columns = None
+            if snapshot is not None and not self._stale:
+                criterion_ids = np.fromiter(scores.keys(), dtype=np.int64, count=len(scores))
+                columns = np.searchsorted(snapshot.criterion_ids, criterion_ids)
+                known = columns < len(snapshot.criterion_ids)
+                if not np.all(known) or np.any(snapshot.criterion_ids[columns] != criterion_ids):
+                    columns = None
+
+            new_version = self._bump_pool_version()
+            if row is None or columns is None or new_version != snapshot.version + 1:
+                self._stale = True
+                return
+
+            new_scores = np.fromiter(scores.values(), dtype=np.int8, count=len(scores))
+            scores_matrix = snapshot.scores.copy()
+            score_histograms = snapshot.score_histograms.copy()
+            np.subtract.at(score_histograms, (columns, scores_matrix[row, columns] - 1), 1)
+            np.add.at(score_histograms, (columns, new_scores - 1), 1)
+            scores_matrix[row, columns] = new_scores
+            self._snapshot = snapshot._replace(
+                scores=scores_matrix, score_histograms=score_histograms, version=new_version
+            )
+
+    def remove_therapist(self, therapist_id):
+        """Drop a therapist who is no longer part of the matching pool"""
+        with self._lock:
+            snapshot = self._snapshot
+            row = self._positions.get(therapist_id)
+            if row is None:
+                return
+
+            new_version = self._bump_pool_version()
+            if self._stale or new_version != snapshot.version + 1:
+                self._stale = True
+                return
+
+            keep = np.ones(len(snapshot.therapist_ids), dtype=bool)
+            keep[row] = False
+            score_histograms = snapshot.score_histograms.copy()
+            score_histograms[np.arange(len(snapshot.criterion_ids)), snapshot.scores[row] - 1] -= 1
+            self._set_snapshot(
+                snapshot.therapist_ids[keep], snapshot.criterion_ids, snapshot.scores[keep],
+                new_version, score_histograms
+            )
+
+    def contains(self, therapist_id):
+        with self._lock:
+            return not self._stale and therapist_id in self._positions
+
+    def _set_snapshot(self, therapist_ids, criterion_ids, scores, version, score_histograms=None):
+        if score_histograms is None:
+            score_histograms = calculate_score_histograms(scores)
+        self._snapshot = ScoreIndexSnapshot(therapist_ids, criterion_ids, scores, score_histograms, version)
+        self._positions = {therapist_id: row for row, therapist_id in enumerate(therapist_ids.tolist())}
+        self._stale = False
+
+    def _rebuild(self, pool_version):
+        # Only therapists who scored every criterion can be compared
+        pool = load_score_vectors(get_surveyed_therapists()).only_complete()
+        self._set_snapshot(pool.user_ids, pool.criterion_ids, pool.scores, pool_version)
+
+
+therapist_score_index = TherapistScoreIndex()
@@ -0,0 +1,119 @@
+from django.db import transaction
+from django.db.models.signals import post_delete, post_init, post_save
+from django.dispatch import Signal, receiver
+
+from users.models import User
+from .models import Criterion, CriterionScore
+from .catalog import criterion_catalog
+from .data_access import sync_score_vector
+from .score_index import therapist_score_index
+
+# Sent once per survey write, with sender=User and the arguments user and scores
+# ({criterion_id: score}). Surveys are saved with a bulk upsert, which sends no
+# post_save for the scores, so caches and indexes listen to this signal instead.
+scores_changed = Signal()
+
+
+def _is_pool_member(user):
+    return user.user_role == 'therapist' and user.survey_done
+
+
+@receiver(post_save, sender=CriterionScore)
+def update_index_on_score_save(sender, instance, **kwargs):
+    if therapist_score_index.contains(instance.user_id):
+        transaction.on_commit(lambda: therapist_score_index.update_score(
+            instance.user_id, instance.criterion_id, instance.score
+        ))
+    elif _is_pool_member(instance.user):
+        transaction.on_commit(therapist_score_index.invalidate)
+
+
+@receiver(scores_changed)
+def sync_score_vector_on_scores_changed(sender, user, scores, **kwargs):
+    # Written in the same transaction as the scores themselves
+    sync_score_vector(user.pk, scores)
+
+
+@receiver(scores_changed)
+def update_index_on_scores_changed(sender, user, scores, **kwargs):
+    if therapist_score_index.contains(user.pk):
+        transaction.on_commit(lambda: therapist_score_index.update_scores(user.pk, scores))
+    elif _is_pool_member(user):
+        transaction.on_commit(therapist_score_index.invalidate)
+
+
+def _remove_from_pool(therapist_id):
+    """
+    Drop a therapist from the pool of every process on commit.
+
+    The local index may be stale or not built yet while other processes still
+    hold the therapist, so the pool version is bumped either way.
+    """
+    if therapist_score_index.contains(therapist_id):
+        transaction.on_commit(lambda: therapist_score_index.remove_therapist(therapist_id))
+    else:
+        transaction.on_commit(therapist_score_index.invalidate)
+
+
+@receiver(post_delete, sender=CriterionScore)
+def update_index_on_score_delete(sender, instance, **kwargs):
+    # A therapist without a full set of scores drops out of the pool
+    if therapist_score_index.contains(instance.user_id) or _is_pool_member(instance.user):
+        _remove_from_pool(instance.user_id)
+
+
+@receiver(post_init, sender=User)
+def remember_pool_membership(sender, instance, **kwargs):
+    # Compared on save to tell whether the user joined or left the pool; unknown
+    # when the fields it depends on were not loaded. New instances are recognized
+    # by their missing pk, as from_db() only clears _state.adding after post_init
+    if instance.pk is None:
+        instance._was_pool_member = False
+    elif {'user_role', 'survey_done'} & instance.get_deferred_fields():
+        instance._was_pool_member = None
+    else:
+        instance._was_pool_member = _is_pool_member(instance)
+
+
+@receiver(post_save, sender=User)
+def update_index_on_user_save(sender, instance, **kwargs):
+    was_member = getattr(instance, '_was_pool_member', None)
+    is_member = _is_pool_member(instance)
+    instance._was_pool_member = is_member
+    if was_member is not None and was_member == is_member:
+        return
+    if is_member:
+        transaction.on_commit(therapist_score_index.invalidate)
+    else:
+        _remove_from_pool(instance.pk)
+
+
+@receiver(post_delete, sender=User)
+def update_index_on_user_delete(sender, instance, **kwargs):
+    if therapist_score_index.contains(instance.pk) or _is_pool_member(instance):
+        _remove_from_pool(instance.pk)
+
+
+@receiver(post_save, sender=Criterion)
+def update_index_on_criterion_save(sender, instance, created, **kwargs):
+    # Renaming a criterion does not change the score columns
+    if created:
+        transaction.on_commit(therapist_score_index.invalidate)
+
+
+@receiver(post_delete, sender=Criterion)
+def update_index_on_criterion_delete(sender, instance, **kwargs):
+    transaction.on_commit(therapist_score_index.invalidate)
+
+
+@receiver(post_save, sender=Criterion)
+@receiver(post_delete, sender=Criterion)
+def invalidate_catalog_on_criterion_change(sender, **kwargs):
+    # Names and descriptions are shown in the survey forms, so any change counts
+    transaction.on_commit(criterion_catalog.invalidate)
+
+
+@receiver(post_save, sender=CriterionScore)
+@receiver(post_delete, sender=CriterionScore)
+def sync_score_vector_on_score_change(sender, instance, **kwargs):
+    transaction.on_commit(lambda: sync_score_vector(instance.user_id))
@@ -1,3 +1,1003 @@
-from django.test import TestCase
+import datetime
+import json
+import os
+import re
+import tempfile
+from io import StringIO
+from unittest import mock, skipUnless
 
-# Create your tests here.
+import numpy as np
+from asgiref.sync import async_to_sync
+from django.core.cache import caches
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.management import call_command
+from django.db import connection
+from django.db.models import F
+from django.test import SimpleTestCase, TestCase
+from django.test.utils import CaptureQueriesContext, override_settings
+from django.urls import reverse
+from django.utils import timezone
+
+from psychotherapists.cards import rebuild_therapist_cards
+from psychotherapists.models import Psychotherapist, TherapistCard, WorkingMethodology
+from psychotherapists.pagination import CursorPaginator
+from psychotherapists.search import search_cards
+from users.models import User
+from .data_access import (
+    aload_match_page, get_client_matches, get_surveyed_therapists, load_score_matrix, load_score_vectors,
+    save_rankings,
+)
+from .jobs import claim_match_jobs, enqueue_match_job, requeue_stale_match_jobs, run_match_job
+from .models import (
+    Criterion, CriterionScore, MatchJob, MatchingResult, MatchingResultSet, ScoreVector, TherapistRematchJob,
+)
+from .batch_matching import STORED_WEIGHT_RTOL, rematch_after_therapist_update, rematch_ranked_clients
+from .catalog import CriterionCatalogCache, criterion_catalog
+from .score_index import ScoreIndexSnapshot, TherapistScoreIndex, therapist_score_index
+from .ranking_cache import LRURankingCache
+from .forms import ClientMatchingForm, TherapistMatchingForm
+from .trace import MatchTrace
+from .matching_algorithm import (
+    ENGINE_HISTOGRAM, ENGINE_MATRIX, build_alternative_matrices, calculate_batch_consistency,
+    calculate_batch_weights, calculate_lambda_CI_CR, calculate_local_weights, calculate_score_differences, calculate_score_histograms,
+    create_mpp_matrices, get_client_matching_data, iter_alternative_matrices, rank_top_k, run_algorithm,
+)
+
+
+def make_random_scores(n_therapists, n_criteria, seed=0):
+    """Random client and therapist score dicts on the 1..9 scale"""
+    rng = np.random.default_rng(seed)
+    client_scores_dict = {0: rng.integers(1, 10, n_criteria).tolist()}
+    therapist_scores_dict = {
+        therapist_id: rng.integers(1, 10, n_criteria).tolist()
+        for therapist_id in range(1, n_therapists + 1)
+    }
+    return client_scores_dict, therapist_scores_dict
+
+
+def build_reference_matrix(criterion_differences):
+    """Pairwise comparison matrix filled cell by cell, as the original builder did"""
+    n = len(criterion_differences)
+    matrix = np.ones((n, n))
+    for i in range(n):
+        for j in range(n):
+            diff1, diff2 = criterion_differences[i], criterion_differences[j]
+            if diff1 < diff2:
+                matrix[i, j] = abs(diff2 - diff1) + 1
+                matrix[j, i] = 1 / matrix[i, j]
+            elif diff2 < diff1:
+                matrix[j, i] = abs(diff1 - diff2) + 1
+                matrix[i, j] = 1 / matrix[j, i]
+    return matrix
+
+
+class AlternativeMatrixBuilderTests(SimpleTestCase):
+    def setUp(self):
+        client_scores_dict, therapist_scores_dict = make_random_scores(25, 5)
+        _, self.differences = calculate_score_differences(client_scores_dict[0], therapist_scores_dict)
+
+    def test_batched_matrices_are_identical_to_reference(self):
+        matrices = build_alternative_matrices(self.differences)
+
+        self.assertEqual(matrices.shape, (5, 25, 25))
+        for criterion_idx in range(5):
+            np.testing.assert_array_equal(
+                matrices[criterion_idx], build_reference_matrix(self.differences[:, criterion_idx])
+            )
+
+    def test_row_blocks_reassemble_full_matrices(self):
+        matrices = build_alternative_matrices(self.differences)
+        reassembled = np.zeros_like(matrices)
+        for criterion_idx, rows, block in iter_alternative_matrices(self.differences, row_block_size=7):
+            self.assertLessEqual(block.shape[0], 7)
+            reassembled[criterion_idx, rows] = block
+
+        np.testing.assert_array_equal(reassembled, matrices)
+
+
+class BatchConsistencyTests(SimpleTestCase):
+    def test_batch_consistency_matches_single_matrix_iteration(self):
+        client_scores_dict, therapist_scores_dict = make_random_scores(8, 4, seed=2)
+        _, differences = calculate_score_differences(client_scores_dict[0], therapist_scores_dict)
+        matrices = build_alternative_matrices(differences)
+
+        lambda_max, CI, CR, trace = calculate_batch_consistency(matrices, return_trace=True)
+
+        for matrix_idx, matrix in enumerate(matrices):
+            _, lambda_values, expected_lambda, expected_CI, expected_CR = calculate_lambda_CI_CR(matrix)
+            self.assertAlmostEqual(lambda_max[matrix_idx], expected_lambda, places=8)
+            self.assertAlmostEqual(CI[matrix_idx], expected_CI, places=8)
+            self.assertAlmostEqual(CR[matrix_idx], expected_CR, places=8)
+            self.assertEqual(trace[matrix_idx][1].shape, lambda_values.shape)
+
+
+class HistogramEngineTests(SimpleTestCase):
+    def test_histogram_weights_match_matrix_weights(self):
+        client_scores_dict, therapist_scores_dict = make_random_scores(40, 6)
+        # One therapist with an incomplete survey is excluded by both paths
+        therapist_scores_dict[99] = [5, 5]
+
+        _, _, alternative_matrices = create_mpp_matrices(client_scores_dict, therapist_scores_dict)
+        valid_therapist_ids, differences = calculate_score_differences(
+            client_scores_dict[0], therapist_scores_dict
+        )
+        weights, geometric_means = calculate_batch_weights(differences=differences)
+
+        self.assertNotIn(99, valid_therapist_ids)
+        for (_, criterion_idx), matrix in alternative_matrices.items():
+            expected_weights, expected_means = calculate_local_weights(matrix)
+            np.testing.assert_allclose(weights[criterion_idx], expected_weights, rtol=1e-10)
+            np.testing.assert_allclose(geometric_means[criterion_idx], expected_means, rtol=1e-10)
+
+    def test_batch_weights_stay_finite_on_large_pools(self):
+        # A row product of 2000 values of 9 overflows float64; the log-space mean does not
+        matrices = np.full((2, 2000, 2000), 1 / 9)
+        matrices[:, 0, :] = 9
+
+        weights, _ = calculate_batch_weights(matrices=matrices)
+
+        self.assertTrue(np.all(np.isfinite(weights)))
+        np.testing.assert_allclose(weights.sum(axis=1), 1)
+        self.assertEqual(weights[0].argmax(), 0)
+
+
+class RankTopKTests(SimpleTestCase):
+    def test_top_k_matches_head_of_full_stable_sort(self):
+        # Few distinct values, so ties cross the top-k boundary
+        weights = np.random.default_rng(3).integers(0, 5, (6, 40)) / 5
+
+        full_order = np.argsort(-weights, axis=1, kind='stable')
+
+        for top_k in (1, 7, 40, 100):
+            np.testing.assert_array_equal(rank_top_k(weights[0], top_k), full_order[0, :top_k])
+        np.testing.assert_array_equal(rank_top_k(weights, 7), full_order[:, :7])
+
+
+# The configured cache is shared between processes through the database. Query
+# counts are about the database work of matching itself, so tests that count
+# queries keep the version counters in an in-process cache instead
+IN_PROCESS_CACHES = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+
+
+@override_settings(CACHES=IN_PROCESS_CACHES)
+class MatchingDataTestCase(TestCase):
+    """Seeds criteria, one client and a pool of therapists with random scores"""
+    n_criteria = 4
+    n_therapists = 12
+
+    def setUp(self):
+        self.criteria = [
+            Criterion.objects.create(name=f'Criterion {i}', description='') for i in range(self.n_criteria)
+        ]
+        client_scores_dict, therapist_scores_dict = make_random_scores(
+            self.n_therapists, self.n_criteria, seed=1
+        )
+        self.client_user = User.objects.create_user(
+            email='client@example.com', user_role='client', survey_done=True
+        )
+        self.therapists = []
+        users_scores = [(self.client_user, client_scores_dict[0])]
+        for therapist_id, scores in therapist_scores_dict.items():
+            therapist = User.objects.create_user(
+                email=f'therapist{therapist_id}@example.com', user_role='therapist', survey_done=True
+            )
+            self.therapists.append(therapist)
+            users_scores.append((therapist, scores))
+        CriterionScore.objects.bulk_create([
+            CriterionScore(user=user, criterion=criterion, score=score)
+            for user, scores in users_scores
+            for criterion, score in zip(self.criteria, scores)
+        ])
+        # The catalog and index outlive the per-test transaction, so start every test from a fresh build
+        criterion_catalog.invalidate()
+        therapist_score_index.invalidate()
+
+
+class ClientMatchingDataTests(MatchingDataTestCase):
+    def test_pool_is_loaded_with_constant_queries(self):
+        CriterionScore.objects.filter(user=self.therapists[0], criterion=self.criteria[1]).delete()
+
+        with self.assertNumQueries(2):
+            client_scores_dict, therapist_scores_dict = get_client_matching_data(self.client_user)
+
+        self.assertEqual(len(client_scores_dict[self.client_user.id]), self.n_criteria)
+        self.assertNotIn(self.therapists[0].id, therapist_scores_dict)
+        self.assertEqual(len(therapist_scores_dict), self.n_therapists - 1)
+        self.assertEqual(
+            therapist_scores_dict[self.therapists[1].id],
+            list(CriterionScore.objects.filter(user=self.therapists[1])
+                 .order_by('criterion_id').values_list('score', flat=True))
+        )
+
+
+class ScoreIndexSnapshotTests(SimpleTestCase):
+    def setUp(self):
+        scores = np.array([[1, 2, 4], [9, 8, 6]], dtype=np.int8)
+        self.snapshot = ScoreIndexSnapshot(
+            np.array([10, 20]), np.array([1, 2, 4]), scores, calculate_score_histograms(scores), 0
+        )
+
+    def test_select_returns_columns_in_requested_order(self):
+        np.testing.assert_array_equal(self.snapshot.select([4, 1]), [[4, 1], [6, 9]])
+
+    def test_select_rejects_criteria_missing_from_snapshot(self):
+        for criterion_ids in ([3], [1, 5]):
+            self.assertFalse(self.snapshot.has_criteria(criterion_ids))
+            with self.assertRaises(KeyError):
+                self.snapshot.select(criterion_ids)
+
+
+class TherapistScoreIndexTests(MatchingDataTestCase):
+    def test_index_holds_complete_therapist_rows(self):
+        incomplete = self.therapists[0]
+        CriterionScore.objects.filter(user=incomplete, criterion=self.criteria[0]).delete()
+        therapist_score_index.invalidate()
+
+        snapshot = therapist_score_index.snapshot()
+
+        self.assertEqual(snapshot.scores.dtype, np.int8)
+        self.assertEqual(snapshot.scores.shape, (self.n_therapists - 1, self.n_criteria))
+        self.assertNotIn(incomplete.id, snapshot.therapist_ids)
+
+    def test_score_save_updates_index_incrementally(self):
+        therapist = self.therapists[3]
+        version = therapist_score_index.snapshot().version
+        score = CriterionScore.objects.get(user=therapist, criterion=self.criteria[2])
+        score.score = 10 - score.score if score.score != 5 else 1
+
+        # The update itself plus reloading and repacking the score vector; the index
+        # is patched in memory
+        with self.assertNumQueries(3), self.captureOnCommitCallbacks(execute=True):
+            score.save()
+        snapshot = therapist_score_index.snapshot()
+
+        row = snapshot.therapist_ids.tolist().index(therapist.id)
+        self.assertEqual(snapshot.scores[row, 2], score.score)
+        self.assertEqual(snapshot.version, version + 1)
+
+    def test_criterion_missing_from_index_rebuilds_it(self):
+        therapist_score_index.snapshot()
+        # Added elsewhere: the catalog moved on but this index was not told
+        criterion = Criterion.objects.create(name='Added', description='')
+        criterion_catalog.invalidate()
+        CriterionScore.objects.bulk_create([
+            CriterionScore(user=user, criterion=criterion, score=5)
+            for user in [self.client_user, *self.therapists]
+        ])
+
+        ranked_ids, _ = run_algorithm(self.client_user, top_k=None)
+
+        self.assertIn(criterion.id, therapist_score_index.snapshot().criterion_ids)
+        self.assertEqual(len(ranked_ids), self.n_therapists)
+
+    def test_therapist_leaving_pool_is_removed(self):
+        therapist = self.therapists[5]
+        therapist_score_index.snapshot()
+
+        therapist.survey_done = False
+        with self.captureOnCommitCallbacks(execute=True):
+            therapist.save()
+
+        self.assertNotIn(therapist.id, therapist_score_index.snapshot().therapist_ids)
+
+
+class StaleIndexPoolChangeTests(MatchingDataTestCase):
+    """Pool changes saved by a process whose own index is not built must still reach the others"""
+
+    def setUp(self):
+        super().setUp()
+        self.worker_index = TherapistScoreIndex()
+        self.worker_index.snapshot()
+        patcher = mock.patch('matching.signals.therapist_score_index', TherapistScoreIndex())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_therapist_leaving_pool(self):
+        therapist = User.objects.get(pk=self.therapists[0].pk)
+        therapist.survey_done = False
+        with self.captureOnCommitCallbacks(execute=True):
+            therapist.save(update_fields=['survey_done'])
+
+        self.assertNotIn(therapist.id, self.worker_index.snapshot().therapist_ids)
+
+    def test_therapist_deleted(self):
+        therapist_id = self.therapists[1].pk
+        with self.captureOnCommitCallbacks(execute=True):
+            User.objects.get(pk=therapist_id).delete()
+
+        self.assertNotIn(therapist_id, self.worker_index.snapshot().therapist_ids)
+
+    def test_therapist_score_deleted(self):
+        therapist_id = self.therapists[2].pk
+        with self.captureOnCommitCallbacks(execute=True):
+            CriterionScore.objects.filter(user_id=therapist_id, criterion=self.criteria[0]).get().delete()
+
+        self.assertNotIn(therapist_id, self.worker_index.snapshot().therapist_ids)
+
+    def test_unrelated_save_keeps_pool_version(self):
+        version = self.worker_index.snapshot().version
+        therapist = User.objects.get(pk=self.therapists[0].pk)
+        with self.captureOnCommitCallbacks(execute=True):
+            therapist.save(update_fields=['last_login'])
+            self.client_user.save()
+
+        self.assertEqual(self.worker_index.snapshot().version, version)
+
+
+class ScoreVectorTests(MatchingDataTestCase):
+    def assert_matrices_equal(self, actual, expected):
+        for field in ('user_ids', 'criterion_ids', 'scores', 'filled'):
+            np.testing.assert_array_equal(getattr(actual, field), getattr(expected, field), err_msg=field)
+
+    def test_backfilled_vectors_load_like_score_rows(self):
+        call_command('backfill_score_vectors', chunk_size=5, stdout=StringIO())
+        self.assertEqual(ScoreVector.objects.count(), self.n_therapists + 1)
+
+        users = User.objects.all()
+        criterion_ids = [self.criteria[2].id, self.criteria[0].id]
+        with self.assertNumQueries(1):
+            vectors = load_score_vectors(users, criterion_ids)
+        self.assert_matrices_equal(vectors, load_score_matrix(users, criterion_ids))
+
+    def test_users_without_current_vector_fall_back_to_score_rows(self):
+        call_command('backfill_score_vectors', stdout=StringIO())
+        ScoreVector.objects.filter(user=self.therapists[0]).delete()
+        ScoreVector.objects.filter(user=self.therapists[1]).update(catalog_version=0)
+
+        users = User.objects.all()
+        self.assert_matrices_equal(load_score_vectors(users), load_score_matrix(users))
+
+    def test_vector_follows_score_changes(self):
+        therapist = self.therapists[2]
+        with self.captureOnCommitCallbacks(execute=True):
+            CriterionScore.objects.filter(user=therapist, criterion=self.criteria[1]).delete()
+        self.assertEqual(list(bytes(ScoreVector.objects.get(user=therapist).scores))[1], 0)
+
+        form = TherapistMatchingForm.for_catalog()(
+            {f'criterion_{criterion.id}': '7' for criterion in self.criteria}, user=therapist
+        )
+        self.assertTrue(form.is_valid())
+        form.save()
+        self.assertEqual(list(bytes(ScoreVector.objects.get(user=therapist).scores)), [7] * self.n_criteria)
+
+
+class CriterionCatalogTests(MatchingDataTestCase):
+    def test_form_classes_are_built_once_per_catalog_version(self):
+        form_class = ClientMatchingForm.for_catalog()
+        self.assertIs(ClientMatchingForm.for_catalog(), form_class)
+        self.assertEqual(list(form_class.base_fields), [f'criterion_{criterion.id}' for criterion in self.criteria])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            Criterion.objects.create(name='Added', description='')
+
+        self.assertIsNot(ClientMatchingForm.for_catalog(), form_class)
+        self.assertEqual(len(ClientMatchingForm.for_catalog().base_fields), self.n_criteria + 1)
+
+    def test_survey_page_does_not_query_criteria_once_cached(self):
+        self.client.force_login(self.client_user)
+        url = reverse('matching:client_matching_form')
+        self.client.get(url)
+
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get(url)
+        self.assertFalse([query for query in queries if 'matching_criterion"' in query['sql']])
+
+
+class SharedCatalogVersionTests(TestCase):
+    """Runs on the configured cache, which every web and worker process shares"""
+
+    def test_configured_cache_is_shared_between_processes(self):
+        self.assertNotIsInstance(caches['default'], LocMemCache)
+
+    def test_criterion_added_by_another_process_reaches_forms(self):
+        # Each CriterionCatalogCache stands for the catalog of one process
+        this_process, other_process = CriterionCatalogCache(), CriterionCatalogCache()
+        Criterion.objects.create(name='First', description='')
+        old_form_class = ClientMatchingForm.for_catalog(this_process.get())
+
+        criterion = Criterion.objects.create(name='Added', description='')
+        other_process.invalidate()
+
+        form_class = ClientMatchingForm.for_catalog(this_process.get())
+        self.assertNotIn(f'criterion_{criterion.id}', old_form_class.base_fields)
+        self.assertIn(f'criterion_{criterion.id}', form_class.base_fields)
+
+
+class SharedPoolVersionTests(TestCase):
+    """Runs on the configured cache, which the web and match worker processes share"""
+
+    def test_worker_index_sees_survey_saved_by_another_process(self):
+        criteria = [Criterion.objects.create(name=f'Criterion {i}', description='') for i in range(3)]
+        therapists = [
+            User.objects.create_user(email=f'therapist{i}@example.com', user_role='therapist', survey_done=True)
+            for i in range(2)
+        ]
+        CriterionScore.objects.bulk_create([
+            CriterionScore(user=therapist, criterion=criterion, score=5)
+            for therapist in therapists for criterion in criteria
+        ])
+        # The worker's index; the signals below update the web process's one
+        worker_index = TherapistScoreIndex()
+        old_snapshot = worker_index.snapshot()
+
+        form = TherapistMatchingForm.for_catalog()(
+            {f'criterion_{criterion.id}': '9' for criterion in criteria}, user=therapists[1]
+        )
+        self.assertTrue(form.is_valid())
+        with self.captureOnCommitCallbacks(execute=True):
+            form.save()
+
+        snapshot = worker_index.snapshot()
+        self.assertNotEqual(snapshot.version, old_snapshot.version)
+        self.assertEqual(snapshot.get_scores(therapists[1].id).tolist(), [9, 9, 9])
+
+
+class SurveyWriteTests(MatchingDataTestCase):
+    def survey_data(self, scores):
+        return {f'criterion_{criterion.id}': str(score) for criterion, score in zip(self.criteria, scores)}
+
+    def test_survey_is_saved_with_constant_queries(self):
+        client = User.objects.create_user(email='new@example.com', user_role='client')
+        form = ClientMatchingForm.for_catalog()(self.survey_data([1, 2, 3, 4]), user=client)
+        self.assertTrue(form.is_valid())
+
+        # Savepoint, one upsert for all scores, one survey_done update, one score
+        # vector upsert, release
+        with self.assertNumQueries(5):
+            form.save()
+
+        client.refresh_from_db()
+        self.assertTrue(client.survey_done)
+        self.assertEqual(
+            list(CriterionScore.objects.filter(user=client).order_by('criterion_id').values_list('score', flat=True)),
+            [1, 2, 3, 4]
+        )
+
+    def test_therapist_survey_updates_index_in_one_step(self):
+        therapist = self.therapists[0]
+        version = therapist_score_index.version
+        form = TherapistMatchingForm.for_catalog()(self.survey_data([9, 8, 7, 6]), user=therapist)
+        self.assertTrue(form.is_valid())
+
+        with self.captureOnCommitCallbacks(execute=True):
+            form.save()
+
+        snapshot = therapist_score_index.snapshot()
+        self.assertEqual(snapshot.version, version + 1)
+        self.assertEqual(snapshot.get_scores(therapist.id).tolist(), [9, 8, 7, 6])
+        np.testing.assert_array_equal(snapshot.score_histograms, calculate_score_histograms(snapshot.scores))
+
+
+class MatchJobTests(MatchingDataTestCase):
+    def submit_survey(self):
+        self.client.force_login(self.client_user)
+        return self.client.post(
+            reverse('matching:client_matching_form'),
+            {f'criterion_{criterion.id}': '5' for criterion in self.criteria}
+        )
+
+    def test_survey_submission_only_enqueues(self):
+        self.submit_survey()
+        self.submit_survey()
+
+        job = MatchJob.objects.get(client=self.client_user)
+        self.assertEqual(job.status, MatchJob.STATUS_PENDING)
+        self.assertFalse(MatchingResult.objects.filter(client=self.client_user).exists())
+
+        response = self.client.get(reverse('users:client_account'))
+        self.assertTrue(response.context['matches_computing'])
+
+    def test_worker_stores_ranking_and_finishes_job(self):
+        self.submit_survey()
+
+        call_command('run_match_worker', once=True, stdout=StringIO(), stderr=StringIO())
+
+        job = MatchJob.objects.get(client=self.client_user)
+        self.assertEqual((job.status, job.attempts), (MatchJob.STATUS_DONE, 1))
+        self.assertTrue(MatchingResult.objects.current().filter(client=self.client_user).exists())
+        response = self.client.get(reverse('users:client_account'))
+        self.assertFalse(response.context['matches_computing'])
+
+    def test_job_requested_again_while_running_stays_pending(self):
+        self.submit_survey()
+        [job] = claim_match_jobs(10)
+        enqueue_match_job(self.client_user)
+
+        run_match_job(job)
+
+        self.assertEqual(MatchJob.objects.get(client=self.client_user).status, MatchJob.STATUS_PENDING)
+
+
+@override_settings(MATCHING_PAGE_SIZE=5)
+class ClientMatchListTests(MatchingDataTestCase):
+    def setUp(self):
+        super().setUp()
+        methodology = WorkingMethodology.objects.create(name='CBT')
+        Psychotherapist.objects.bulk_create([
+            Psychotherapist(
+                user=therapist, birth_date=datetime.date(1980, 1, 1), gender='F', about='About',
+                working_methodology=methodology, education_institution='University',
+                education_start_year=2000, education_end_year=2005, experience=5, price=100,
+            )
+            for therapist in self.therapists
+        ])
+        User.objects.filter(pk=self.client_user.pk).update(profile_completed=True)
+        run_algorithm(self.client_user)
+        self.client.force_login(self.client_user)
+
+    def test_account_page_loads_first_page_with_one_joined_query(self):
+        # Session and user, the pending job check, and the current results joined
+        # with their result set and their therapists' profiles
+        with self.assertNumQueries(4):
+            response = self.client.get(reverse('users:client_account'))
+
+        matches = response.context['matched_therapists']
+        self.assertEqual([match['rank'] for match in matches], [1, 2, 3, 4, 5])
+        self.assertEqual(response.context['pool_size'], self.n_therapists)
+        self.assertTrue(response.context['next_cursor'])
+
+    def test_matches_endpoint_pages_through_ranking(self):
+        ranks = []
+        cursor = self.client.get(reverse('users:client_account')).context['next_cursor']
+        while cursor:
+            with self.assertNumQueries(3):
+                data = self.client.get(reverse('matching:client_matches'), {'cursor': cursor}).json()
+            ranks += [match['rank'] for match in data['matches']]
+            cursor = data['next_cursor']
+
+        self.assertEqual(ranks, list(range(6, self.n_therapists + 1)))
+        self.assertEqual(data['matches'][0]['therapist']['methodology'], 'CBT')
+
+    def save_reversed_ranking(self):
+        therapist_ids = [therapist.id for therapist in reversed(self.therapists)]
+        save_rankings(
+            [self.client_user.id], [therapist_ids], [[1 / rank for rank in range(1, len(therapist_ids) + 1)]],
+            pool_size=len(therapist_ids),
+        )
+        return therapist_ids
+
+    def test_ranking_saved_while_page_loads_is_read_whole(self):
+        saved = {}
+
+        def save_before_results_query(execute, sql, params, many, context):
+            # The first read of the results, after anything read before it
+            if not saved and 'FROM "matching_matchingresult"' in sql:
+                saved['therapist_ids'] = None
+                saved['therapist_ids'] = self.save_reversed_ranking()
+            return execute(sql, params, many, context)
+
+        with connection.execute_wrapper(save_before_results_query):
+            page, pool_size = async_to_sync(aload_match_page)(self.client_user.pk)
+
+        self.assertEqual([result.therapist_id for result in page], saved['therapist_ids'][:5])
+        self.assertEqual(pool_size, self.n_therapists)
+
+    def test_cursor_of_replaced_ranking_starts_from_best_match(self):
+        cursor = async_to_sync(aload_match_page)(self.client_user.pk)[0].next_cursor
+        therapist_ids = self.save_reversed_ranking()
+
+        page, _ = async_to_sync(aload_match_page)(self.client_user.pk, cursor)
+
+        self.assertEqual([result.therapist_id for result in page], therapist_ids[:5])
+
+
+class RunAlgorithmEngineTests(MatchingDataTestCase):
+    def test_histogram_engine_ranks_like_matrix_engine(self):
+        matrix_ids, matrix_weights = run_algorithm(self.client_user, engine=ENGINE_MATRIX)
+        histogram_ids, histogram_weights = run_algorithm(self.client_user, engine=ENGINE_HISTOGRAM)
+
+        np.testing.assert_allclose(histogram_weights, matrix_weights, rtol=1e-10)
+        self.assertEqual(len(histogram_ids), self.n_therapists)
+        self.assertEqual(
+            sorted(zip(np.round(histogram_weights, 12), histogram_ids)),
+            sorted(zip(np.round(matrix_weights, 12), matrix_ids))
+        )
+
+    def test_consistency_check_requires_matrix_engine(self):
+        with self.assertRaises(ValueError):
+            run_algorithm(self.client_user, engine=ENGINE_HISTOGRAM, check_consistency=True)
+
+
+class MatchTraceTests(MatchingDataTestCase):
+    def test_trace_is_only_captured_when_passed(self):
+        trace = MatchTrace()
+        traced = run_algorithm(self.client_user, engine=ENGINE_MATRIX, check_consistency=True, trace=trace)
+        untraced = run_algorithm(self.client_user, engine=ENGINE_MATRIX, check_consistency=True)
+
+        self.assertEqual(traced, untraced)
+        names = [name for name, _ in trace]
+        self.assertIn("Expert matrix (1x1)", names)
+        self.assertIn("Глобальні пріоритети альтернатив (ранжовані)", names)
+        self.assertIn("Alternative matrix, expert", trace.format())
+
+    def test_trace_is_offered_to_staff_only(self):
+        self.client.force_login(self.client_user)
+        response = self.client.get(reverse('matching:test_matching_data'), {'trace': 1})
+        self.assertIsNone(response.context['trace'])
+
+        self.client_user.is_staff = True
+        self.client_user.save()
+        response = self.client.get(reverse('matching:test_matching_data'), {'trace': 1})
+        self.assertGreater(len(response.context['trace']), 0)
+
+
+class TopKPersistenceTests(MatchingDataTestCase):
+    def test_only_top_k_results_are_stored(self):
+        ranked_ids, _ = run_algorithm(self.client_user, top_k=5)
+
+        stored = list(MatchingResult.objects.filter(client=self.client_user).values_list('therapist_id', 'rank'))
+        self.assertEqual(stored, [(therapist_id, rank) for rank, therapist_id in enumerate(ranked_ids, 1)])
+        self.assertEqual(len(stored), 5)
+        self.assertEqual(MatchingResultSet.objects.get(client=self.client_user).pool_size, self.n_therapists)
+
+    def test_new_ranking_replaces_old_version_with_constant_queries(self):
+        run_algorithm(self.client_user, top_k=3)
+        first_version = MatchingResultSet.objects.get(client=self.client_user).version
+
+        # Client scores, then ensure the result set, lock, insert, switch version and delete
+        # old rows inside a savepoint: the same queries however many therapists the ranking holds
+        with self.assertNumQueries(8):
+            ranked_ids, _ = run_algorithm(self.client_user, top_k=None)
+
+        self.assertEqual(MatchingResultSet.objects.get(client=self.client_user).version, first_version + 1)
+        stored = list(MatchingResult.objects.current().filter(client=self.client_user).values_list('therapist_id', flat=True))
+        self.assertEqual(stored, ranked_ids)
+        self.assertEqual(MatchingResult.objects.filter(client=self.client_user).count(), self.n_therapists)
+
+
+class RankingCacheTests(MatchingDataTestCase):
+    def setUp(self):
+        super().setUp()
+        self.twin = User.objects.create_user(email='twin@example.com', user_role='client', survey_done=True)
+        CriterionScore.objects.bulk_create([
+            CriterionScore(user=self.twin, criterion=score.criterion, score=score.score)
+            for score in CriterionScore.objects.filter(user=self.client_user)
+        ])
+
+    def test_identical_score_vectors_share_one_ranking(self):
+        expected = run_algorithm(self.client_user, top_k=5)
+
+        with mock.patch('matching.matching_algorithm.calculate_batch_weights') as engine:
+            self.assertEqual(run_algorithm(self.twin, top_k=5), expected)
+        engine.assert_not_called()
+        self.assertEqual(
+            list(MatchingResult.objects.current().filter(client=self.twin).values_list('therapist_id', flat=True)),
+            expected[0]
+        )
+
+    def test_pool_change_invalidates_cached_rankings(self):
+        run_algorithm(self.client_user, top_k=5)
+        therapist_score_index.invalidate()
+
+        with mock.patch(
+            'matching.matching_algorithm.calculate_batch_weights', wraps=calculate_batch_weights
+        ) as engine:
+            run_algorithm(self.twin, top_k=5)
+        engine.assert_called_once()
+
+
+class LRURankingCacheTests(SimpleTestCase):
+    def test_least_recently_used_entry_is_evicted(self):
+        cache = LRURankingCache(max_entries=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+
+        self.assertEqual((cache.get('a'), cache.get('b'), cache.get('c')), (1, None, 3))
+
+
+class RematchAllTests(MatchingDataTestCase):
+    def test_rematch_all_matches_single_client_ranking(self):
+        other_client = User.objects.create_user(
+            email='other@example.com', user_role='client', survey_done=True
+        )
+        CriterionScore.objects.bulk_create([
+            CriterionScore(user=other_client, criterion=criterion, score=score)
+            for criterion, score in zip(self.criteria, [9, 1, 5, 3])
+        ])
+
+        call_command('rematch_all', workers=1, chunk_size=1, checkpoint=self.id(), stdout=StringIO())
+
+        for client in (self.client_user, other_client):
+            ranked_ids, ranked_weights = run_algorithm(client)
+            stored = list(MatchingResult.objects.filter(client=client).values_list('therapist_id', 'score'))
+            self.assertEqual([therapist_id for therapist_id, _ in stored], ranked_ids)
+            np.testing.assert_allclose([score for _, score in stored], ranked_weights, rtol=1e-10)
+
+
+    def run_in_fresh_process(self, **options):
+        """Run rematch_all with its own index, which has never seen a pool version bump"""
+        stdout = StringIO()
+        with mock.patch('matching.management.commands.rematch_all.therapist_score_index', TherapistScoreIndex()):
+            call_command('rematch_all', workers=1, stdout=stdout, **options)
+        return stdout.getvalue()
+
+    def test_resume_starts_over_when_pool_changed_since_checkpoint(self):
+        with tempfile.TemporaryDirectory() as directory:
+            checkpoint = os.path.join(directory, 'checkpoint.json')
+            with open(checkpoint, 'w') as checkpoint_file:
+                json.dump({
+                    'pool_fingerprint': therapist_score_index.snapshot().fingerprint(),
+                    'last_client_id': self.client_user.id,
+                }, checkpoint_file)
+            # Changed without going through this process's index
+            CriterionScore.objects.filter(user=self.therapists[0], criterion=self.criteria[0]).update(
+                score=F('score') % 9 + 1
+            )
+            ScoreVector.objects.filter(user=self.therapists[0]).delete()
+
+            output = self.run_in_fresh_process(checkpoint=checkpoint, resume=True)
+
+        self.assertIn("starting over", output)
+        self.assertTrue(MatchingResult.objects.filter(client=self.client_user).exists())
+
+    def test_resume_continues_after_checkpoint_of_same_pool(self):
+        with tempfile.TemporaryDirectory() as directory:
+            checkpoint = os.path.join(directory, 'checkpoint.json')
+            with open(checkpoint, 'w') as checkpoint_file:
+                json.dump({
+                    'pool_fingerprint': therapist_score_index.snapshot().fingerprint(),
+                    'last_client_id': self.client_user.id,
+                }, checkpoint_file)
+
+            output = self.run_in_fresh_process(checkpoint=checkpoint, resume=True)
+
+        self.assertIn(f"Resuming after client {self.client_user.id}", output)
+        self.assertFalse(MatchingResult.objects.filter(client=self.client_user).exists())
+
+
+class RankedClientsTestCase(MatchingDataTestCase):
+    """Adds clients whose top_k rankings are stored"""
+    n_therapists = 30
+    top_k = 4
+
+    def setUp(self):
+        super().setUp()
+        rng = np.random.default_rng(4)
+        self.clients = [self.client_user]
+        for i in range(8):
+            client = User.objects.create_user(email=f'client{i}@example.com', user_role='client', survey_done=True)
+            CriterionScore.objects.bulk_create([
+                CriterionScore(user=client, criterion=criterion, score=score)
+                for criterion, score in zip(self.criteria, rng.integers(1, 10, self.n_criteria).tolist())
+            ])
+            self.clients.append(client)
+        therapist_score_index.invalidate()
+        for client in self.clients:
+            run_algorithm(client, top_k=self.top_k)
+
+    def assert_rankings_match_full_recompute(self):
+        stored = {
+            client.id: list(MatchingResult.objects.filter(client=client).values_list('therapist_id', 'score'))
+            for client in self.clients
+        }
+        for client in self.clients:
+            ranked_ids, ranked_weights = run_algorithm(client, top_k=self.top_k)
+            self.assertEqual([therapist_id for therapist_id, _ in stored[client.id]], ranked_ids)
+            np.testing.assert_allclose(
+                [score for _, score in stored[client.id]], ranked_weights, rtol=STORED_WEIGHT_RTOL
+            )
+
+
+class IncrementalRematchTests(RankedClientsTestCase):
+    def test_score_change_is_patched_into_rankings(self):
+        therapist = self.therapists[7]
+        old_pool = therapist_score_index.snapshot()
+        with self.captureOnCommitCallbacks(execute=True):
+            for score in CriterionScore.objects.filter(user=therapist):
+                score.score = 10 - score.score
+                score.save()
+
+        patched, recomputed = rematch_after_therapist_update(
+            therapist.id, old_pool, therapist_score_index.snapshot(), top_k=self.top_k
+        )
+
+        self.assertEqual(patched + recomputed, len(self.clients))
+        self.assert_rankings_match_full_recompute()
+
+    def test_unchanged_rankings_are_not_rewritten(self):
+        therapist = self.therapists[7]
+        old_pool = therapist_score_index.snapshot()
+        versions = dict(MatchingResultSet.objects.values_list('client_id', 'version'))
+        with self.captureOnCommitCallbacks(execute=True):
+            for score in CriterionScore.objects.filter(user=therapist):
+                score.save()
+
+        rematch_after_therapist_update(therapist.id, old_pool, therapist_score_index.snapshot(), top_k=self.top_k)
+
+        self.assertEqual(dict(MatchingResultSet.objects.values_list('client_id', 'version')), versions)
+
+    def test_therapist_leaving_pool_is_patched_into_rankings(self):
+        therapist = MatchingResult.objects.get(client=self.client_user, rank=1).therapist
+        old_pool = therapist_score_index.snapshot()
+        therapist.survey_done = False
+        with self.captureOnCommitCallbacks(execute=True):
+            therapist.save()
+
+        rematch_after_therapist_update(therapist.id, old_pool, therapist_score_index.snapshot(), top_k=self.top_k)
+
+        self.assertFalse(MatchingResult.objects.filter(therapist=therapist).exists())
+        self.assert_rankings_match_full_recompute()
+
+
+class TherapistRematchJobTests(RankedClientsTestCase):
+    def submit_survey(self, therapist, scores):
+        self.client.force_login(therapist)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(
+                reverse('matching:therapist_matching_form'),
+                {f'criterion_{criterion.id}': str(score) for criterion, score in zip(self.criteria, scores)}
+            )
+
+    def run_worker(self):
+        with override_settings(MATCHING_TOP_K=self.top_k), mock.patch(
+            'matching.jobs.rematch_ranked_clients', wraps=rematch_ranked_clients
+        ) as full_rematch:
+            call_command('run_match_worker', once=True, stdout=StringIO(), stderr=StringIO())
+        return full_rematch
+
+    def test_survey_submission_only_enqueues_rematch(self):
+        therapist = self.therapists[7]
+        stored = list(MatchingResult.objects.order_by('pk').values_list('therapist_id', 'score'))
+
+        old_scores = therapist_score_index.snapshot().get_scores(therapist.id).tolist()
+
+        with mock.patch.object(ScoreIndexSnapshot, 'with_therapist_scores') as copy_pool:
+            self.submit_survey(therapist, [9, 1, 9, 1])
+
+        copy_pool.assert_not_called()
+        job = TherapistRematchJob.objects.get(therapist=therapist)
+        self.assertEqual(job.status, MatchJob.STATUS_PENDING)
+        self.assertEqual(job.old_scores, old_scores)
+        self.assertEqual(job.new_scores, [9, 1, 9, 1])
+        self.assertEqual(job.pool_version, therapist_score_index.snapshot().version)
+        self.assertEqual(list(MatchingResult.objects.order_by('pk').values_list('therapist_id', 'score')), stored)
+
+    def test_worker_patches_rankings(self):
+        self.submit_survey(self.therapists[7], [9, 1, 9, 1])
+
+        full_rematch = self.run_worker()
+
+        full_rematch.assert_not_called()
+        self.assertEqual(TherapistRematchJob.objects.get().status, MatchJob.STATUS_DONE)
+        self.assert_rankings_match_full_recompute()
+
+    def test_long_rematch_is_requeued_only_without_heartbeat(self):
+        long_ago = timezone.now() - datetime.timedelta(hours=2)
+        alive, dead = TherapistRematchJob.objects.bulk_create([
+            TherapistRematchJob(
+                therapist=therapist, status=MatchJob.STATUS_RUNNING, started_at=long_ago, heartbeat_at=heartbeat_at
+            )
+            for therapist, heartbeat_at in [(self.therapists[7], timezone.now()), (self.therapists[8], long_ago)]
+        ])
+
+        self.assertEqual(requeue_stale_match_jobs(stale_after=600), 1)
+
+        alive.refresh_from_db()
+        dead.refresh_from_db()
+        self.assertEqual(alive.status, MatchJob.STATUS_RUNNING)
+        self.assertEqual(dead.status, MatchJob.STATUS_PENDING)
+
+    def test_client_queue_worker_leaves_rematches_pending(self):
+        self.submit_survey(self.therapists[7], [9, 1, 9, 1])
+
+        call_command('run_match_worker', once=True, queue='clients', stdout=StringIO(), stderr=StringIO())
+
+        self.assertEqual(TherapistRematchJob.objects.get().status, MatchJob.STATUS_PENDING)
+
+    def test_pool_changed_again_recomputes_rankings_once(self):
+        self.submit_survey(self.therapists[7], [9, 1, 9, 1])
+        self.submit_survey(self.therapists[8], [1, 9, 1, 9])
+
+        full_rematch = self.run_worker()
+
+        full_rematch.assert_called_once()
+        self.assertEqual(
+            list(TherapistRematchJob.objects.values_list('status', flat=True)), [MatchJob.STATUS_DONE] * 2
+        )
+        self.assert_rankings_match_full_recompute()
+
+
+@skipUnless(connection.vendor == 'sqlite', 'Plans are checked in SQLite EXPLAIN QUERY PLAN format')
+class QueryPlanTests(TestCase):
+    """
+    The hot queries must keep using indexes on a seeded, analyzed database.
+
+    Fails when a plan falls back to a full scan of one of the large tables;
+    scans of small lookup tables such as working methodologies are fine.
+    """
+    large_tables = (
+        'users_user', 'psychotherapists_psychotherapist', 'matching_criterionscore',
+        'matching_scorevector', 'matching_matchingresult', 'matching_matchingresultset',
+        'psychotherapists_therapistcard',
+    )
+
+    @classmethod
+    def setUpTestData(cls):
+        methodologies = WorkingMethodology.objects.bulk_create(
+            [WorkingMethodology(name=f'Methodology {i}') for i in range(8)]
+        )
+        criteria = Criterion.objects.bulk_create(
+            [Criterion(name=f'Criterion {i}', description='') for i in range(6)]
+        )
+        cls.clients = User.objects.bulk_create([
+            User(email=f'client{i}@example.com', user_role='client', profile_completed=True, survey_done=i % 2 == 0)
+            for i in range(400)
+        ])
+        therapists = User.objects.bulk_create([
+            User(email=f'therapist{i}@example.com', user_role='therapist',
+                 profile_completed=i % 3 != 0, survey_done=i % 2 == 0)
+            for i in range(150)
+        ])
+        Psychotherapist.objects.bulk_create([
+            Psychotherapist(
+                user=user, birth_date=datetime.date(1980, 1, 1), gender='F', about='About',
+                working_methodology=methodologies[i % len(methodologies)], education_institution='University',
+                education_start_year=2000, education_end_year=2005, experience=i % 20, price=100 + i * 10,
+            )
+            for i, user in enumerate(therapists)
+        ])
+        CriterionScore.objects.bulk_create([
+            CriterionScore(user=user, criterion=criterion, score=(user.pk + criterion.pk) % 9 + 1)
+            for user in cls.clients + therapists
+            for criterion in criteria
+        ])
+        MatchingResultSet.objects.bulk_create([MatchingResultSet(client=client, version=1) for client in cls.clients])
+        MatchingResult.objects.bulk_create([
+            MatchingResult(client=client, therapist=therapist, score=1 / rank, rank=rank, version=1)
+            for client in cls.clients
+            for rank, therapist in enumerate(therapists[:20], 1)
+        ])
+        call_command('backfill_score_vectors', stdout=StringIO())
+        rebuild_therapist_cards()
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE')
+
+    def assert_no_full_scan(self, queryset):
+        plan = queryset.explain()
+        scanned = [
+            table for table in re.findall(r'\bSCAN (\w+)\b(?! USING)', plan)
+            if table in self.large_tables
+        ]
+        self.assertFalse(scanned, f"Full scan of {scanned} in plan:\n{plan}")
+
+    def test_matching_pool_uses_role_survey_index(self):
+        self.assert_no_full_scan(get_surveyed_therapists().values('pk'))
+
+    def test_score_loaders_use_indexes(self):
+        pool = get_surveyed_therapists()
+        self.assert_no_full_scan(CriterionScore.objects.filter(user__in=pool.values('pk')))
+        self.assert_no_full_scan(
+            pool.values_list('pk', 'score_vector__catalog_version', 'score_vector__scores')
+        )
+
+    def test_client_ranking_uses_client_rank_index(self):
+        self.assert_no_full_scan(
+            MatchingResult.objects.current().filter(client=self.clients[3]).select_related('therapist').order_by('rank')
+        )
+        self.assert_no_full_scan(get_client_matches(self.clients[3].pk, 1)[:6])
+        self.assert_no_full_scan(get_client_matches(self.clients[3].pk)[:6])
+
+    def test_catalog_queries_use_indexes(self):
+        catalog = Psychotherapist.objects.filter(user__profile_completed=True).select_related('user', 'working_methodology')
+        self.assert_no_full_scan(catalog)
+        self.assert_no_full_scan(catalog.filter(experience__gte=15))
+        self.assert_no_full_scan(catalog.filter(working_methodology__name='Methodology 1', experience__gte=5))
+        self.assert_no_full_scan(catalog.filter(price__lte=300))
+
+    def test_card_queries_use_indexes(self):
+        self.assert_no_full_scan(TherapistCard.objects.all()[:9])
+        self.assert_no_full_scan(TherapistCard.objects.filter(experience__gte=15))
+        self.assert_no_full_scan(TherapistCard.objects.filter(methodology_name='Methodology 1', experience__gte=5))
+
+    def test_deep_catalog_pages_seek_the_name_index(self):
+        paginator = CursorPaginator(TherapistCard.objects.all(), 9)
+        middle = TherapistCard.objects.all()[50]
+        for backwards in (False, True):
+            queryset, _, _ = paginator.get_page_queryset(paginator.encode_cursor(middle, backwards))
+            self.assert_no_full_scan(queryset)
+            self.assertIn('card_name_idx', queryset.explain())
+
+    def test_search_uses_full_text_index(self):
+        self.assert_no_full_scan(search_cards(TherapistCard.objects.filter(experience__gte=5), 'methodology univ'))
@@ -0,0 +1,57 @@
+import numpy as np
+from django.conf import settings
+
+# How numpy arrays are printed in traces and debug pages: whole rows on one line
+PRINT_OPTIONS = {
+    'linewidth': np.inf,
+    'formatter': {'float_kind': "{:.5f}".format},
+}
+
+
+class MatchTrace:
+    """
+    Diagnostics captured during one matching run.
+
+    Values are recorded as they are, without copying or formatting; the text is
+    only built when the trace is rendered. Code that records into a trace accepts
+    trace=None and then skips the recording entirely, so a run without a trace
+    pays nothing for diagnostics.
+    """
+
+    def __init__(self):
+        self.entries = []
+
+    def record(self, name, value):
+        """Add a named value (array, dict, list or scalar) to the trace"""
+        self.entries.append((name, value))
+
+    def __iter__(self):
+        return iter(self.entries)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def format(self):
+        """Render all entries as text, one block per entry"""
+        with np.printoptions(**PRINT_OPTIONS):
+            return '\n\n'.join(f"{name}:\n{value}" for name, value in self.entries)
+
+    def __str__(self):
+        return self.format()
+
+
+def is_trace_requested(request):
+    """
+    Whether matching diagnostics should be captured for this request.
+
+    Tracing is on for every request when settings.MATCHING_TRACE is set, and for
+    staff users who add ?trace=1 to the URL.
+    """
+    if getattr(settings, 'MATCHING_TRACE', False):
+        return True
+    return request.user.is_staff and bool(request.GET.get('trace'))
+
+
+def start_trace(request):
+    """A new MatchTrace if tracing was requested, otherwise None"""
+    return MatchTrace() if is_trace_requested(request) else None
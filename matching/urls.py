@@ -6,5 +6,6 @@ app_name = 'matching'
 urlpatterns = [
     path('client/matching/', views.client_matching_form, name='client_matching_form'),
     path('therapist/matching/', views.therapist_matching_form, name='therapist_matching_form'),
+    path('client/matches/', views.client_matches, name='client_matches'),
     path('test-matching/', views.test_matching_data, name='test_matching_data'),
 ] 
\ No newline at end of file
@@ -1,13 +1,21 @@
+import numpy as np
+from django.db import transaction
+from django.http import JsonResponse
 from django.shortcuts import render, redirect
+from django.templatetags.static import static
+from django.urls import reverse
+from django.utils.text import Truncator
 from django.contrib.auth.decorators import login_required
 from django.contrib import messages
 from django.utils.translation import gettext_lazy as _
 from .forms import ClientMatchingForm, TherapistMatchingForm
-from .matching_algorithm import get_client_matching_data, run_algorithm, create_mpp_matrices, calculate_local_weights #, get_therapist_matching_data
-from users.models import User  # Use our custom User model
-from .models import Criterion, MatchingResult
+from .matching_algorithm import get_client_matching_data, run_algorithm, create_mpp_matrices, calculate_local_weights, calculate_batch_weights #, get_therapist_matching_data
+from .catalog import get_criterion_catalog
+from .data_access import aload_match_page
+from .jobs import enqueue_match_job, enqueue_therapist_rematch
+from .score_index import therapist_score_index
+from .trace import PRINT_OPTIONS, start_trace
 from psychotherapists.models import Psychotherapist
-from matching.models import CriterionScore
 
 # Create your views here.
 
@@ -18,19 +26,24 @@ def client_matching_form(request):
         messages.error(request, _('This form is only for clients.'))
         return redirect('users:client_account')
     
+    # Criteria and the form class come from the cached criterion catalog
+    catalog = get_criterion_catalog()
+    form_class = ClientMatchingForm.for_catalog(catalog)
+    
     if request.method == 'POST':
-        form = ClientMatchingForm(request.POST, user=request.user)
+        form = form_class(request.POST, user=request.user)
         if form.is_valid():
+            # Saves the scores and marks the survey as done in one transaction
             form.save()
-            request.user.survey_done = True
-            request.user.save()
+            # Matching runs in the background worker, see run_match_worker
+            enqueue_match_job(request.user)
             messages.success(request, _('Your preferences have been saved.'))
             return redirect('users:client_account')
     else:
-        form = ClientMatchingForm(user=request.user)
+        form = form_class(user=request.user)
     
     # Get criteria for display
-    criteria = list(Criterion.objects.all().order_by('id'))
+    criteria = catalog.criteria
     
     return render(request, 'matching/client_matching_form.html', {
         'form': form,
@@ -45,19 +58,29 @@ def therapist_matching_form(request):
         messages.error(request, _('This form is only for therapists.'))
         return redirect('users:therapist_account')
     
+    # Criteria and the form class come from the cached criterion catalog
+    catalog = get_criterion_catalog()
+    form_class = TherapistMatchingForm.for_catalog(catalog)
+    
     if request.method == 'POST':
-        form = TherapistMatchingForm(request.POST, user=request.user)
+        form = form_class(request.POST, user=request.user)
         if form.is_valid():
+            pool = therapist_score_index.snapshot()
+            old_scores = pool.get_scores(request.user.id)
+            # Saves the scores and marks the survey as done in one transaction
             form.save()
-            request.user.survey_done = True
-            request.user.save()
+            # The match worker patches every client's ranking with this therapist's
+            # old -> new scores; the index itself is updated on commit as well
+            transaction.on_commit(lambda: enqueue_therapist_rematch(
+                request.user.id, old_scores, pool.version
+            ))
             messages.success(request, _('Your ratings have been saved.'))
             return redirect('users:therapist_account')
     else:
-        form = TherapistMatchingForm(user=request.user)
+        form = form_class(user=request.user)
     
     # Get criteria for display
-    criteria = list(Criterion.objects.all().order_by('id'))
+    criteria = catalog.criteria
     
     return render(request, 'matching/therapist_matching_form.html', {
         'form': form,
@@ -76,21 +99,20 @@ def test_matching_data(request):
         messages.error(request, _('Please complete the matching survey first.'))
         return redirect('matching:client_matching_form')
     
+    # Diagnostics are only captured for staff users asking for them, or when enabled in settings
+    trace = start_trace(request)
+    
     # Get client and therapist scores
-    client_scores, therapist_scores = get_client_matching_data(request.user)
+    client_scores, therapist_scores = get_client_matching_data(request.user, trace=trace)
     
     # Get criteria for display
-    criteria = list(Criterion.objects.all().order_by('id'))
+    criteria = get_criterion_catalog().criteria
     
     # Get client scores as a list
-    client_score_list = list(
-        CriterionScore.objects.filter(user=request.user)
-        .order_by('criterion_id')
-        .values_list('score', flat=True)
-    )
+    client_score_list = client_scores[request.user.id]
     
     # Run the algorithm
-    ranked_therapist_ids, ranked_weights = run_algorithm(request.user)
+    ranked_therapist_ids, ranked_weights = run_algorithm(request.user, trace=trace)
     
     # Get therapist details
     therapists = Psychotherapist.objects.filter(
@@ -118,15 +140,14 @@ def test_matching_data(request):
     # Calculate weights for each matrix
     expert_weights, _ = calculate_local_weights(expert_matrix)
     
-    criteria_weights = {}
-    for expert_id, matrix in criteria_matrices.items():
-        weights, _ = calculate_local_weights(matrix)
-        criteria_weights[expert_id] = weights
+    # Weights of all criteria and alternative matrices, one batched reduction each
+    stacked_criteria_weights, _ = calculate_batch_weights(matrices=np.stack(list(criteria_matrices.values())))
+    criteria_weights = dict(zip(criteria_matrices.keys(), stacked_criteria_weights))
     
-    alternative_weights = {}
-    for (expert_id, criterion_idx), matrix in alternative_matrices.items():
-        weights, _ = calculate_local_weights(matrix)
-        alternative_weights[(expert_id, criterion_idx)] = weights
+    # Indexed by criterion, shape (n_criteria, n_therapists)
+    alternative_weights = []
+    if alternative_matrices:
+        alternative_weights, _ = calculate_batch_weights(matrices=np.stack(list(alternative_matrices.values())))
     
     context = {
         'client_scores': client_scores,
@@ -148,6 +169,46 @@ def test_matching_data(request):
         'alternative_matrices': alternative_matrices,
         'alternative_weights': alternative_weights,
         'ranked_therapist_ids': ranked_therapist_ids,
+        'trace': trace,
     }
     
-    return render(request, 'matching/test_matching.html', context)
+    # The page prints whole matrices, keep each row on one line
+    with np.printoptions(**PRINT_OPTIONS):
+        return render(request, 'matching/test_matching.html', context)
+
+def match_as_dict(result):
+    """JSON-ready summary of a MatchingResult loaded by get_client_matches()"""
+    therapist = result.therapist.therapist
+    return {
+        'rank': result.rank,
+        'score': result.score,
+        'is_best_match': result.rank == 1,
+        'therapist': {
+            'id': therapist.pk,
+            'full_name': result.therapist.get_full_name(),
+            'methodology': therapist.working_methodology.name,
+            'experience': therapist.experience,
+            'price': therapist.price,
+            'about': Truncator(therapist.about).words(15),
+            'image_url': therapist.image.url if therapist.image else static('img/profile.png'),
+            'profile_url': reverse('psychotherapists:therapist_detail', args=[therapist.pk]),
+        },
+    }
+
+@login_required
+async def client_matches(request):
+    """
+    Page of the client's current matches as JSON, for "load more" on the account page.
+
+    Pass the next_cursor of the previous response as ?cursor= for the next page.
+    """
+    user = await request.auser()
+    if user.user_role != 'client':
+        return JsonResponse({'error': str(_('Only clients have matches.'))}, status=403)
+
+    page, pool_size = await aload_match_page(user.pk, request.GET.get('cursor'))
+    return JsonResponse({
+        'matches': [match_as_dict(result) for result in page],
+        'next_cursor': page.next_cursor,
+        'pool_size': pool_size,
+    })
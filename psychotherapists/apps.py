@@ -4,3 +4,7 @@ from django.apps import AppConfig
 class PsychotherapistsConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'psychotherapists'
+
+    def ready(self):
+        # Keep the catalog cards in sync with profile, user and methodology changes
+        from . import signals  # noqa: F401
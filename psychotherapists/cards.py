@@ -0,0 +1,84 @@
+from django.db import connection, transaction
+from django.templatetags.static import static
+from django.utils.text import Truncator
+
+from .catalog import bump_catalog_version
+from .models import Psychotherapist, TherapistCard
+from .search import get_search_backend, index_therapists
+
+
+def card_fields(therapist, user, methodology_name):
+    """
+    Values of the TherapistCard of a therapist.
+
+    Returns:
+        dict: TherapistCard field values, without the therapist
+    """
+    if therapist.image:
+        thumbnail_url = therapist.image.url
+    else:
+        thumbnail_url = static('img/profile.png')
+    return {
+        'full_name': f"{user.first_name} {user.last_name}".strip(),
+        'methodology_name': methodology_name,
+        'excerpt': Truncator(therapist.about).words(TherapistCard.EXCERPT_WORDS),
+        'experience': therapist.experience,
+        'price': therapist.price,
+        'thumbnail_url': thumbnail_url,
+    }
+
+
+def sync_therapist_card(therapist):
+    """
+    Write the card and search document of a therapist, or remove them once the
+    profile is no longer complete.
+    """
+    if not therapist.user.profile_completed:
+        # The search document goes with the card, see psychotherapists.signals
+        TherapistCard.objects.filter(therapist_id=therapist.pk).delete()
+        return
+    TherapistCard.objects.update_or_create(
+        therapist_id=therapist.pk,
+        defaults=card_fields(therapist, therapist.user, therapist.working_methodology.name),
+    )
+    index_therapists([therapist])
+
+
+def rebuild_therapist_cards(batch_size=1000):
+    """
+    Rebuild every card and the search index from the profiles.
+
+    Returns:
+        int: number of cards written
+    """
+    therapists = Psychotherapist.objects.filter(
+        user__profile_completed=True
+    ).select_related(
+        'user',
+        'working_methodology'
+    ).order_by('pk')
+
+    TherapistCard.objects.exclude(therapist__in=therapists.values('pk')).delete()
+    therapists = list(therapists)
+    cards = [
+        TherapistCard(
+            therapist=therapist,
+            **card_fields(therapist, therapist.user, therapist.working_methodology.name)
+        )
+        for therapist in therapists
+    ]
+    TherapistCard.objects.bulk_create(
+        cards,
+        batch_size=batch_size,
+        update_conflicts=True,
+        unique_fields=['therapist'],
+        update_fields=['full_name', 'methodology_name', 'excerpt', 'experience', 'price', 'thumbnail_url'],
+    )
+
+    backend = get_search_backend()
+    if backend:
+        with connection.cursor() as cursor:
+            backend.clear(cursor)
+    index_therapists(therapists)
+    transaction.on_commit(bump_catalog_version)
+    return len(cards)
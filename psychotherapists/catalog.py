@@ -0,0 +1,71 @@
+import functools
+import hashlib
+from urllib.parse import urlencode
+
+from django.conf import settings
+from django.core.cache import cache
+from django.http import HttpResponse
+from django.utils.translation import get_language
+
+from config.cache import aget_version, bump_version, get_version
+
+# Version of the public therapist catalog, shared by every process through the
+# CACHES backend. Anything cached from the catalog is keyed by it, so bumping it
+# makes all of it stale.
+CATALOG_VERSION_CACHE_KEY = 'psychotherapists:catalog_version'
+CATALOG_PAGE_CACHE_KEY_PREFIX = 'psychotherapists:page'
+
+
+def get_catalog_version():
+    return get_version(CATALOG_VERSION_CACHE_KEY)
+
+
+async def aget_catalog_version():
+    """Async version of get_catalog_version()"""
+    return await aget_version(CATALOG_VERSION_CACHE_KEY)
+
+
+def bump_catalog_version():
+    """Mark everything cached from the catalog as stale"""
+    bump_version(CATALOG_VERSION_CACHE_KEY)
+
+
+def catalog_page_cache_key(request, version):
+    """Cache key of a rendered catalog page: path, sorted query parameters, language and version"""
+    query = urlencode(sorted(request.GET.lists()), doseq=True)
+    digest = hashlib.blake2b(f"{request.path}?{query}".encode(), digest_size=16).hexdigest()
+    return f"{CATALOG_PAGE_CACHE_KEY_PREFIX}:{version}:{get_language()}:{digest}"
+
+
+def cache_catalog_page(view):
+    """
+    Cache the pages an async catalog view renders for anonymous visitors.
+
+    Pages are keyed by the catalog version, which every process reads from the
+    shared CACHES backend. Catalog changes bump it once they are committed, so
+    no process serves a page from before the change after that; the timeout,
+    settings.CATALOG_PAGE_CACHE_TIMEOUT, only bounds how long unused pages are
+    kept. Signed-in users see their own navigation and always get a fresh page.
+    """
+    @functools.wraps(view)
+    async def wrapper(request, *args, **kwargs):
+        user = await request.auser()
+        # Share the loaded user with templates, request.user would load it again
+        request.user = user
+        if request.method not in ('GET', 'HEAD') or user.is_authenticated:
+            return await view(request, *args, **kwargs)
+
+        key = catalog_page_cache_key(request, await aget_catalog_version())
+        cached = await cache.aget(key)
+        if cached is not None:
+            content, content_type = cached
+            return HttpResponse(content, content_type=content_type)
+
+        response = await view(request, *args, **kwargs)
+        if response.status_code == 200 and not response.streaming:
+            await cache.aset(
+                key, (response.content, response['Content-Type']), settings.CATALOG_PAGE_CACHE_TIMEOUT
+            )
+        return response
+
+    return wrapper
@@ -0,0 +1,119 @@
+import hashlib
+from collections import Counter, namedtuple
+
+from django.core.cache import cache
+from django.db.models import Case, Count, IntegerField, Q, Value, When
+
+from .catalog import aget_catalog_version
+from .models import TherapistCard
+from .search import filter_cards, search_terms
+
+FACET_CACHE_KEY_PREFIX = 'psychotherapists:facets'
+FACET_CACHE_TIMEOUT = 3600
+
+# Minimum years of experience offered by the experience filter
+EXPERIENCE_BUCKETS = (5, 10, 15)
+
+# (key, lowest price, highest price or None), upper bounds are exclusive
+PRICE_RANGES = (
+    ('0-50', 0, 50),
+    ('50-100', 50, 100),
+    ('100-200', 100, 200),
+    ('200+', 200, None),
+)
+
+
+class CatalogFacets(namedtuple('CatalogFacets', ['methodologies', 'experience', 'prices', 'total'])):
+    """
+    Number of therapists behind each filter option.
+
+    - methodologies: list of (methodology name, count)
+    - experience: list of (minimum years, count), one per EXPERIENCE_BUCKETS entry
+    - prices: list of (price range key, count), one per PRICE_RANGES entry
+    - total: number of therapists matching all current filters
+
+    Every facet counts what selecting its option would show, so it applies all
+    current filters except its own.
+    """
+    __slots__ = ()
+
+
+def price_range_filter(key):
+    """Filter for a PRICE_RANGES key, or None for an unknown key"""
+    for range_key, low, high in PRICE_RANGES:
+        if range_key == key:
+            condition = Q(price__gte=low)
+            if high is not None:
+                condition &= Q(price__lt=high)
+            return condition
+    return None
+
+
+def facet_cube_queryset(query=''):
+    """
+    Counts of the cards matching a search query, grouped by methodology, exact
+    experience and price range.
+
+    The groups are small and disjoint, so the counts of any combination of
+    methodology, experience and price filters are sums over them.
+    """
+    price_range = Case(
+        *[When(price_range_filter(key), then=Value(index)) for index, (key, _, _) in enumerate(PRICE_RANGES)],
+        output_field=IntegerField(),
+    )
+    return filter_cards(
+        TherapistCard.objects.all(), query
+    ).order_by().values_list(
+        'methodology_name', 'experience', price_range
+    ).annotate(count=Count('pk'))
+
+
+def facet_cache_key(version, query):
+    terms = ' '.join(search_terms(query))
+    digest = hashlib.blake2b(terms.encode(), digest_size=16).hexdigest()
+    return f"{FACET_CACHE_KEY_PREFIX}:{version}:{digest}"
+
+
+async def aget_facet_cube(query=''):
+    """Facet counts of a search query, cached per catalog version"""
+    key = facet_cache_key(await aget_catalog_version(), query)
+    cube = await cache.aget(key)
+    if cube is None:
+        cube = [tuple(row) async for row in facet_cube_queryset(query)]
+        await cache.aset(key, cube, FACET_CACHE_TIMEOUT)
+    return cube
+
+
+def count_facets(cube, methodology=None, experience=None, price=None):
+    """
+    CatalogFacets for the selected methodology, minimum experience and price
+    range key, summed from a facet cube without querying the database.
+    """
+    price_index = next((index for index, (key, _, _) in enumerate(PRICE_RANGES) if key == price), None)
+
+    methodologies = Counter()
+    experience_counts = Counter()
+    price_counts = Counter()
+    total = 0
+    for methodology_name, years, price_range, count in cube:
+        matches_methodology = not methodology or methodology_name == methodology
+        matches_experience = experience is None or years >= experience
+        matches_price = price_index is None or price_range == price_index
+
+        if matches_experience and matches_price:
+            methodologies[methodology_name] += count
+        if matches_methodology and matches_price:
+            for minimum in EXPERIENCE_BUCKETS:
+                if years >= minimum:
+                    experience_counts[minimum] += count
+        if matches_methodology and matches_experience:
+            price_counts[price_range] += count
+            if matches_price:
+                total += count
+
+    return CatalogFacets(
+        methodologies=sorted(methodologies.items()),
+        experience=[(minimum, experience_counts[minimum]) for minimum in EXPERIENCE_BUCKETS],
+        prices=[(key, price_counts[index]) for index, (key, _, _) in enumerate(PRICE_RANGES)],
+        total=total,
+    )
@@ -0,0 +1,97 @@
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.test import AsyncClient, Client
+from django.test.utils import override_settings
+from django.urls import reverse
+
+from users.models import User
+
+
+class Command(BaseCommand):
+    help = (
+        'Compare the throughput of views served through the WSGI handler (a thread per '
+        'concurrent request) and the ASGI handler (one event loop) in this process.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--path', action='append', dest='paths',
+            help='URL to request, may be given several times (default: the therapist catalog)'
+        )
+        parser.add_argument(
+            '--requests', type=int, default=200,
+            help='Number of requests sent per handler'
+        )
+        parser.add_argument(
+            '--concurrency', type=int, default=20,
+            help='Number of requests in flight at once'
+        )
+        parser.add_argument(
+            '--login-email',
+            help='Send the requests as this user, e.g. a client to benchmark the account page'
+        )
+
+    def handle(self, *args, **options):
+        paths = options['paths'] or [
+            reverse('psychotherapists:therapist_list'),
+            reverse('psychotherapists:therapist_search') + '?experience=5',
+        ]
+        user = None
+        if options['login_email']:
+            user = User.objects.filter(email=options['login_email']).first()
+            if user is None:
+                raise CommandError(f"No user with email {options['login_email']}")
+
+        urls = [paths[i % len(paths)] for i in range(options['requests'])]
+        concurrency = options['concurrency']
+
+        # The test clients send requests to the host 'testserver'
+        with override_settings(ALLOWED_HOSTS=[*settings.ALLOWED_HOSTS, 'testserver']):
+            wsgi_seconds = self.run_wsgi(urls, concurrency, user)
+            asgi_seconds = asyncio.run(self.run_asgi(urls, concurrency, user))
+
+        for name, seconds in (('WSGI', wsgi_seconds), ('ASGI', asgi_seconds)):
+            self.stdout.write(
+                f"{name}: {len(urls)} requests in {seconds:.2f}s, {len(urls) / seconds:.1f} req/s"
+            )
+        self.stdout.write(self.style.SUCCESS(f"ASGI/WSGI throughput: {wsgi_seconds / asgi_seconds:.2f}x"))
+
+    @staticmethod
+    def check_response(url, response):
+        if response.status_code != 200:
+            raise CommandError(f"GET {url} returned {response.status_code}")
+
+    def run_wsgi(self, urls, concurrency, user):
+        clients = []
+        for _ in range(concurrency):
+            client = Client()
+            if user is not None:
+                client.force_login(user)
+            clients.append(client)
+
+        def get(index):
+            url = urls[index]
+            self.check_response(url, clients[index % concurrency].get(url))
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            list(executor.map(get, range(len(urls))))
+        return time.perf_counter() - started
+
+    async def run_asgi(self, urls, concurrency, user):
+        client = AsyncClient()
+        if user is not None:
+            await client.aforce_login(user)
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def get(url):
+            async with semaphore:
+                self.check_response(url, await client.get(url))
+
+        started = time.perf_counter()
+        await asyncio.gather(*(get(url) for url in urls))
+        return time.perf_counter() - started
@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+
+from psychotherapists.cards import rebuild_therapist_cards
+
+
+class Command(BaseCommand):
+    help = (
+        'Rebuild the catalog cards and search index of all therapists. Both follow profile '
+        'saves on their own; run this after bulk updates that bypass model signals.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size', type=int, default=1000,
+            help='Number of cards written per query'
+        )
+
+    def handle(self, *args, **options):
+        written = rebuild_therapist_cards(options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f"Rebuilt {written} therapist cards"))
@@ -0,0 +1,27 @@
+# Generated by Django 5.2.1 on 2026-10-18 11:53
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('psychotherapists', '0006_alter_psychotherapist_image'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='psychotherapist',
+            index=models.Index(fields=['working_methodology', 'experience'], name='therapist_method_exp_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='psychotherapist',
+            index=models.Index(fields=['experience'], name='therapist_experience_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='psychotherapist',
+            index=models.Index(fields=['price'], name='therapist_price_idx'),
+        ),
+    ]
@@ -0,0 +1,57 @@
+# Generated by Django 5.2.1 on 2026-10-18 12:00
+
+import django.db.models.deletion
+from django.db import migrations, models
+from django.templatetags.static import static
+from django.utils.text import Truncator
+
+
+def create_cards(apps, schema_editor):
+    # Same values as psychotherapists.cards.card_fields() at the time of this migration
+    Psychotherapist = apps.get_model('psychotherapists', 'Psychotherapist')
+    TherapistCard = apps.get_model('psychotherapists', 'TherapistCard')
+    therapists = Psychotherapist.objects.filter(
+        user__profile_completed=True
+    ).select_related('user', 'working_methodology')
+    TherapistCard.objects.bulk_create([
+        TherapistCard(
+            therapist=therapist,
+            full_name=f"{therapist.user.first_name} {therapist.user.last_name}".strip(),
+            methodology_name=therapist.working_methodology.name,
+            excerpt=Truncator(therapist.about).words(30),
+            experience=therapist.experience,
+            price=therapist.price,
+            thumbnail_url=therapist.image.url if therapist.image else static('img/profile.png'),
+        )
+        for therapist in therapists
+    ], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('psychotherapists', '0007_hot_query_indexes'),
+        ('users', '0005_hot_query_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TherapistCard',
+            fields=[
+                ('therapist', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='card', serialize=False, to='psychotherapists.psychotherapist')),
+                ('full_name', models.CharField(max_length=301)),
+                ('methodology_name', models.CharField(max_length=255)),
+                ('excerpt', models.TextField(blank=True)),
+                ('experience', models.PositiveIntegerField()),
+                ('price', models.PositiveIntegerField()),
+                ('thumbnail_url', models.CharField(max_length=500)),
+            ],
+            options={
+                'verbose_name': 'Therapist Card',
+                'verbose_name_plural': 'Therapist Cards',
+                'ordering': ['full_name', 'therapist_id'],
+                'indexes': [models.Index(fields=['full_name', 'therapist'], name='card_name_idx'), models.Index(fields=['methodology_name', 'experience'], name='card_method_exp_idx'), models.Index(fields=['experience'], name='card_experience_idx'), models.Index(fields=['price'], name='card_price_idx')],
+            },
+        ),
+        migrations.RunPython(create_cards, migrations.RunPython.noop),
+    ]
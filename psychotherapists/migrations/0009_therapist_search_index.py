@@ -0,0 +1,69 @@
+from django.db import migrations
+
+# Schema of psychotherapists.search at the time of this migration: one document per
+# therapist with the columns name, methodology, about and education
+SEARCH_TABLE = 'psychotherapists_therapistsearch'
+
+
+def create_search_index(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor not in ('sqlite', 'postgresql'):
+        # Search falls back to icontains filters on other databases
+        return
+
+    Psychotherapist = apps.get_model('psychotherapists', 'Psychotherapist')
+    therapists = Psychotherapist.objects.filter(
+        user__profile_completed=True
+    ).select_related('user', 'working_methodology')
+    documents = [
+        (
+            therapist.pk,
+            f"{therapist.user.first_name} {therapist.user.last_name}".strip(),
+            therapist.working_methodology.name,
+            therapist.about,
+            therapist.education_institution,
+        )
+        for therapist in therapists
+    ]
+    with schema_editor.connection.cursor() as cursor:
+        if vendor == 'sqlite':
+            cursor.execute(
+                f"CREATE VIRTUAL TABLE IF NOT EXISTS {SEARCH_TABLE} USING fts5("
+                f"name, methodology, about, education, tokenize='unicode61 remove_diacritics 2')"
+            )
+            cursor.executemany(
+                f"INSERT INTO {SEARCH_TABLE} (rowid, name, methodology, about, education) "
+                f"VALUES (%s, %s, %s, %s, %s)",
+                documents
+            )
+        else:
+            cursor.execute(
+                f"CREATE TABLE IF NOT EXISTS {SEARCH_TABLE} "
+                f"(therapist_id bigint PRIMARY KEY, document tsvector NOT NULL)"
+            )
+            cursor.execute(
+                f"CREATE INDEX IF NOT EXISTS {SEARCH_TABLE}_document_idx ON {SEARCH_TABLE} USING GIN (document)"
+            )
+            cursor.executemany(
+                f"INSERT INTO {SEARCH_TABLE} (therapist_id, document) VALUES (%s, "
+                f"setweight(to_tsvector('simple', %s), 'A') || setweight(to_tsvector('simple', %s), 'B') || "
+                f"setweight(to_tsvector('simple', %s), 'D') || setweight(to_tsvector('simple', %s), 'C'))",
+                documents
+            )
+
+
+def drop_search_index(apps, schema_editor):
+    if schema_editor.connection.vendor in ('sqlite', 'postgresql'):
+        with schema_editor.connection.cursor() as cursor:
+            cursor.execute(f"DROP TABLE IF EXISTS {SEARCH_TABLE}")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('psychotherapists', '0008_therapist_card'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
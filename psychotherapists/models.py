@@ -175,6 +175,12 @@ class Psychotherapist(models.Model):
         verbose_name = _('Psychotherapist')
         verbose_name_plural = _('Psychotherapists')
         ordering = ['user__first_name', 'user__last_name']
+        indexes = [
+            # Catalog filters: methodology with a minimum experience, experience or price alone
+            models.Index(fields=['working_methodology', 'experience'], name='therapist_method_exp_idx'),
+            models.Index(fields=['experience'], name='therapist_experience_idx'),
+            models.Index(fields=['price'], name='therapist_price_idx'),
+        ]
     
     def __str__(self):
         return f"{self.user.get_full_name()} - {self.working_methodology.name}"
@@ -279,4 +285,46 @@ class Psychotherapist(models.Model):
         
         # Validate image if it's being changed
         if self.image and self.image != 'static/img/profile.png':
-            validate_image_file(self.image)
\ No newline at end of file
+            validate_image_file(self.image)
+
+
+class TherapistCard(models.Model):
+    """
+    Read model of one therapist in the catalog, kept in sync by the signals in
+    psychotherapists.signals.
+
+    Holds everything a catalog card shows, precomputed, so list and search pages
+    read one table without joins. Only therapists with a completed profile have
+    a card.
+    """
+    EXCERPT_WORDS = 30
+
+    therapist = models.OneToOneField(
+        Psychotherapist,
+        on_delete=models.CASCADE,
+        primary_key=True,
+        related_name='card'
+    )
+    full_name = models.CharField(max_length=301)
+    methodology_name = models.CharField(max_length=255)
+    excerpt = models.TextField(blank=True)
+    experience = models.PositiveIntegerField()
+    price = models.PositiveIntegerField()
+    thumbnail_url = models.CharField(max_length=500)
+
+    class Meta:
+        verbose_name = _('Therapist Card')
+        verbose_name_plural = _('Therapist Cards')
+        # Same order as Psychotherapist: a space sorts before any letter, so ordering
+        # by the full name orders by first name, then last name
+        ordering = ['full_name', 'therapist_id']
+        indexes = [
+            models.Index(fields=['full_name', 'therapist'], name='card_name_idx'),
+            models.Index(fields=['methodology_name', 'experience'], name='card_method_exp_idx'),
+            models.Index(fields=['experience'], name='card_experience_idx'),
+            models.Index(fields=['price'], name='card_price_idx'),
+        ]
+
+    def __str__(self):
+        return self.full_name
+
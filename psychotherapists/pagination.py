@@ -0,0 +1,138 @@
+import base64
+import binascii
+import json
+import zlib
+
+from django.db.models import Q
+from django.http import Http404
+
+
+class CursorPage:
+    """
+    One page of a CursorPaginator.
+
+    Instead of page numbers it links to its neighbours with next_cursor and
+    previous_cursor, opaque tokens for the ?cursor= parameter.
+    """
+
+    def __init__(self, object_list, next_cursor=None, previous_cursor=None):
+        self.object_list = object_list
+        self.next_cursor = next_cursor
+        self.previous_cursor = previous_cursor
+
+    def has_next(self):
+        return self.next_cursor is not None
+
+    def has_previous(self):
+        return self.previous_cursor is not None
+
+    def has_other_pages(self):
+        return self.has_next() or self.has_previous()
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+
+class CursorPaginator:
+    """
+    Keyset pagination: a page continues after the sort key of the last row of the
+    previous one, instead of skipping OFFSET rows.
+
+    With an index on the ordering every page costs the same as the first, and no
+    COUNT query is needed. The queryset ordering (or the model's default ordering)
+    must end with a unique field so that sort keys never tie.
+
+    Args:
+        queryset: rows to paginate, in their final order
+        per_page: number of rows per page
+        scope: string identifying the filters of the queryset; a cursor made for
+            other filters starts again from the first page
+    """
+
+    def __init__(self, queryset, per_page, scope=''):
+        self.queryset = queryset
+        self.per_page = per_page
+        self.scope = zlib.crc32(scope.encode())
+        ordering = queryset.query.order_by or queryset.model._meta.ordering
+        self.ordering = [
+            (field[1:], True) if field.startswith('-') else (field, False)
+            for field in ordering
+        ]
+
+    def encode_cursor(self, obj, backwards):
+        key = [getattr(obj, field) for field, _ in self.ordering]
+        data = json.dumps([self.scope, int(backwards), key], separators=(',', ':'))
+        return base64.urlsafe_b64encode(data.encode()).decode().rstrip('=')
+
+    def decode_cursor(self, cursor):
+        """
+        Returns:
+            tuple: (key, backwards), or None to start from the first page
+        """
+        if not cursor:
+            return None
+        try:
+            data = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+            scope, backwards, key = json.loads(data)
+        except (binascii.Error, UnicodeDecodeError, ValueError, TypeError):
+            raise Http404("Invalid cursor")
+        if scope != self.scope:
+            return None
+        if not isinstance(key, list) or len(key) != len(self.ordering):
+            raise Http404("Invalid cursor")
+        return key, bool(backwards)
+
+    def keyset_filter(self, key, backwards):
+        """Rows after the key in the ordering, or before it when going backwards"""
+        condition = None
+        for (field, descending), value in reversed(list(zip(self.ordering, key))):
+            lookup = 'lt' if descending != backwards else 'gt'
+            after = Q(**{f'{field}__{lookup}': value})
+            condition = after if condition is None else after | (Q(**{field: value}) & condition)
+        # A bound on the first field alone lets the database seek the index to the key
+        field, descending = self.ordering[0]
+        lookup = 'lte' if descending != backwards else 'gte'
+        return Q(**{f'{field}__{lookup}': key[0]}) & condition
+
+    def get_page_queryset(self, cursor):
+        """
+        Returns:
+            tuple: (queryset of up to per_page + 1 rows, cursor was given, backwards)
+        """
+        decoded = self.decode_cursor(cursor)
+        if decoded is None:
+            return self.queryset[:self.per_page + 1], False, False
+
+        key, backwards = decoded
+        queryset = self.queryset.filter(self.keyset_filter(key, backwards))
+        if backwards:
+            queryset = queryset.order_by(*[
+                field if descending else f'-{field}' for field, descending in self.ordering
+            ])
+        return queryset[:self.per_page + 1], True, backwards
+
+    def make_page(self, rows, has_cursor, backwards):
+        # One extra row tells whether there is more in the direction of travel
+        has_more = len(rows) > self.per_page
+        rows = rows[:self.per_page]
+        if backwards:
+            rows.reverse()
+            has_next, has_previous = bool(rows), has_more
+        else:
+            has_next, has_previous = has_more, has_cursor and bool(rows)
+        return CursorPage(
+            rows,
+            next_cursor=self.encode_cursor(rows[-1], False) if has_next else None,
+            previous_cursor=self.encode_cursor(rows[0], True) if has_previous else None,
+        )
+
+    def page(self, cursor=None):
+        queryset, has_cursor, backwards = self.get_page_queryset(cursor)
+        return self.make_page(list(queryset), has_cursor, backwards)
+
+    async def apage(self, cursor=None):
+        queryset, has_cursor, backwards = self.get_page_queryset(cursor)
+        return self.make_page([obj async for obj in queryset], has_cursor, backwards)
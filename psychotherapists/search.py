@@ -0,0 +1,182 @@
+import re
+
+from django.db import connection
+from django.db.models import Q
+from django.db.models.expressions import RawSQL
+
+SEARCH_TABLE = 'psychotherapists_therapistsearch'
+
+# Columns of a search document. The backends rank a match in the name highest,
+# then the methodology, the education and finally the text about the therapist
+SEARCH_COLUMNS = ('name', 'methodology', 'about', 'education')
+
+
+def search_document(therapist, user, methodology_name):
+    """
+    Searchable text of a therapist, one value per SEARCH_COLUMNS entry.
+    """
+    return (
+        therapist.pk,
+        f"{user.first_name} {user.last_name}".strip(),
+        methodology_name,
+        therapist.about,
+        therapist.education_institution,
+    )
+
+
+def search_terms(query):
+    """Words of a search query; operators and punctuation are dropped"""
+    return re.findall(r'\w+', query.lower())
+
+
+class SQLiteSearchBackend:
+    """FTS5 table keyed by rowid = therapist id, ranked with bm25()"""
+    weights = (10.0, 4.0, 1.0, 2.0)
+
+    def create(self, cursor):
+        cursor.execute(
+            f"CREATE VIRTUAL TABLE IF NOT EXISTS {SEARCH_TABLE} USING fts5("
+            f"{', '.join(SEARCH_COLUMNS)}, tokenize='unicode61 remove_diacritics 2')"
+        )
+
+    def drop(self, cursor):
+        cursor.execute(f"DROP TABLE IF EXISTS {SEARCH_TABLE}")
+
+    def match_query(self, terms):
+        # Every word must match, as a whole word or as the start of one
+        return ' '.join(f'"{term}"*' for term in terms)
+
+    def index(self, cursor, documents):
+        documents = list(documents)
+        cursor.executemany(f"DELETE FROM {SEARCH_TABLE} WHERE rowid = %s", [(doc[0],) for doc in documents])
+        cursor.executemany(
+            f"INSERT INTO {SEARCH_TABLE} (rowid, {', '.join(SEARCH_COLUMNS)}) VALUES (%s, %s, %s, %s, %s)",
+            documents
+        )
+
+    def remove(self, cursor, therapist_ids):
+        cursor.executemany(f"DELETE FROM {SEARCH_TABLE} WHERE rowid = %s", [(pk,) for pk in therapist_ids])
+
+    def clear(self, cursor):
+        cursor.execute(f"DELETE FROM {SEARCH_TABLE}")
+
+    def match_sql(self):
+        return f"SELECT rowid FROM {SEARCH_TABLE} WHERE {SEARCH_TABLE} MATCH %s"
+
+    def relevance_sql(self, column):
+        # bm25() is lower for better matches
+        weights = ', '.join(str(weight) for weight in self.weights)
+        return (
+            f"SELECT -bm25({SEARCH_TABLE}, {weights}) FROM {SEARCH_TABLE} "
+            f"WHERE {SEARCH_TABLE} MATCH %s AND rowid = {column}"
+        )
+
+
+class PostgreSQLSearchBackend:
+    """Weighted tsvector per therapist with a GIN index, ranked with ts_rank()"""
+    # Column weights in SEARCH_COLUMNS order
+    weights = ('A', 'B', 'D', 'C')
+    # No stemming: names and texts are in several languages
+    config = 'simple'
+
+    def create(self, cursor):
+        cursor.execute(
+            f"CREATE TABLE IF NOT EXISTS {SEARCH_TABLE} "
+            f"(therapist_id bigint PRIMARY KEY, document tsvector NOT NULL)"
+        )
+        cursor.execute(
+            f"CREATE INDEX IF NOT EXISTS {SEARCH_TABLE}_document_idx ON {SEARCH_TABLE} USING GIN (document)"
+        )
+
+    def drop(self, cursor):
+        cursor.execute(f"DROP TABLE IF EXISTS {SEARCH_TABLE}")
+
+    def match_query(self, terms):
+        return ' & '.join(f"{term}:*" for term in terms)
+
+    def index(self, cursor, documents):
+        document_sql = ' || '.join(
+            f"setweight(to_tsvector('{self.config}', %s), '{weight}')" for weight in self.weights
+        )
+        cursor.executemany(
+            f"INSERT INTO {SEARCH_TABLE} (therapist_id, document) VALUES (%s, {document_sql}) "
+            f"ON CONFLICT (therapist_id) DO UPDATE SET document = EXCLUDED.document",
+            list(documents)
+        )
+
+    def remove(self, cursor, therapist_ids):
+        cursor.execute(f"DELETE FROM {SEARCH_TABLE} WHERE therapist_id = ANY(%s)", [list(therapist_ids)])
+
+    def clear(self, cursor):
+        cursor.execute(f"TRUNCATE {SEARCH_TABLE}")
+
+    def match_sql(self):
+        return f"SELECT therapist_id FROM {SEARCH_TABLE} WHERE document @@ to_tsquery('{self.config}', %s)"
+
+    def relevance_sql(self, column):
+        return (
+            f"SELECT ts_rank(document, to_tsquery('{self.config}', %s)) FROM {SEARCH_TABLE} "
+            f"WHERE therapist_id = {column}"
+        )
+
+
+SEARCH_BACKENDS = {
+    'sqlite': SQLiteSearchBackend,
+    'postgresql': PostgreSQLSearchBackend,
+}
+
+
+def get_search_backend(vendor=None):
+    """Search backend of the database, or None when it has no full-text index"""
+    backend = SEARCH_BACKENDS.get(vendor or connection.vendor)
+    return backend() if backend else None
+
+
+def index_therapists(therapists):
+    """Add or replace the search documents of therapists loaded with their user and methodology"""
+    backend = get_search_backend()
+    documents = [
+        search_document(therapist, therapist.user, therapist.working_methodology.name)
+        for therapist in therapists
+    ]
+    if backend and documents:
+        with connection.cursor() as cursor:
+            backend.index(cursor, documents)
+
+
+def remove_therapists(therapist_ids):
+    backend = get_search_backend()
+    therapist_ids = list(therapist_ids)
+    if backend and therapist_ids:
+        with connection.cursor() as cursor:
+            backend.remove(cursor, therapist_ids)
+
+
+def filter_cards(queryset, query):
+    """
+    Narrow a TherapistCard queryset to the cards matching a search query.
+
+    Databases without a search backend fall back to matching the name and
+    methodology with icontains.
+    """
+    terms = search_terms(query)
+    if not terms:
+        return queryset
+    backend = get_search_backend()
+    if backend is None:
+        return queryset.filter(Q(full_name__icontains=query) | Q(methodology_name__icontains=query))
+    return queryset.filter(therapist_id__in=RawSQL(backend.match_sql(), [backend.match_query(terms)]))
+
+
+def search_cards(queryset, query):
+    """filter_cards(), with the most relevant cards first where the database can rank them"""
+    queryset = filter_cards(queryset, query)
+    terms = search_terms(query)
+    backend = get_search_backend()
+    if not terms or backend is None:
+        return queryset
+
+    column = f'"{queryset.model._meta.db_table}"."therapist_id"'
+    return queryset.annotate(
+        search_relevance=RawSQL(backend.relevance_sql(column), [backend.match_query(terms)])
+    ).order_by('-search_relevance', *queryset.model._meta.ordering)
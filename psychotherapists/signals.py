@@ -0,0 +1,68 @@
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from users.models import User
+from .cards import sync_therapist_card
+from .catalog import bump_catalog_version
+from .models import Psychotherapist, TherapistCard, WorkingMethodology
+from .search import index_therapists, remove_therapists
+
+
+@receiver(post_save, sender=Psychotherapist)
+def sync_card_on_profile_save(sender, instance, raw=False, **kwargs):
+    if not raw:
+        sync_therapist_card(instance)
+
+
+@receiver(post_save, sender=User)
+def sync_card_on_user_save(sender, instance, raw=False, update_fields=None, **kwargs):
+    # Names and profile completion are stored on the user
+    if raw or instance.user_role != 'therapist':
+        return
+    if update_fields is not None and not {'first_name', 'last_name', 'profile_completed'} & set(update_fields):
+        return
+    therapist = Psychotherapist.objects.filter(user=instance).select_related('working_methodology').first()
+    if therapist is not None:
+        therapist.user = instance
+        sync_therapist_card(therapist)
+
+
+@receiver(post_save, sender=WorkingMethodology)
+def sync_cards_on_methodology_save(sender, instance, raw=False, **kwargs):
+    if not raw:
+        TherapistCard.objects.filter(
+            therapist__working_methodology=instance
+        ).update(methodology_name=instance.name)
+        index_therapists(
+            Psychotherapist.objects.filter(
+                working_methodology=instance, card__isnull=False
+            ).select_related('user', 'working_methodology')
+        )
+
+
+@receiver(post_delete, sender=TherapistCard)
+def remove_search_document_on_card_delete(sender, instance, **kwargs):
+    remove_therapists([instance.pk])
+
+
+@receiver([post_save, post_delete], sender=Psychotherapist)
+@receiver([post_save, post_delete], sender=WorkingMethodology)
+def bump_catalog_version_on_change(sender, raw=False, **kwargs):
+    # Cached catalog pages and facet counts are keyed by the catalog version
+    if not raw:
+        transaction.on_commit(bump_catalog_version)
+
+
+# User fields shown on therapist cards and detail pages, or deciding who is listed
+CATALOG_USER_FIELDS = {'first_name', 'last_name', 'email', 'phone_number', 'profile_completed', 'user_role'}
+
+
+@receiver([post_save, post_delete], sender=User)
+def bump_catalog_version_on_therapist_change(sender, instance, raw=False, update_fields=None, **kwargs):
+    # Logins, survey completion and the like save other fields only
+    if raw or instance.user_role != 'therapist':
+        return
+    if update_fields is not None and not CATALOG_USER_FIELDS & set(update_fields):
+        return
+    transaction.on_commit(bump_catalog_version)
@@ -1,3 +1,294 @@
+import datetime
+
+from django.db import connection
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext, override_settings
+from django.urls import reverse
+
+from users.models import User
+from .cards import rebuild_therapist_cards
+from .catalog import bump_catalog_version
+from .models import Psychotherapist, TherapistCard, WorkingMethodology
+
+
+# Tests that count queries keep the cache in process, see matching.tests
+IN_PROCESS_CACHES = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+
+
+@override_settings(CACHES=IN_PROCESS_CACHES)
+class CatalogViewTests(TestCase):
+    """The catalog views are async, AsyncClient runs them through the ASGI handler"""
+
+    @classmethod
+    def setUpTestData(cls):
+        methodologies = WorkingMethodology.objects.bulk_create(
+            [WorkingMethodology(name=name) for name in ('CBT', 'Gestalt')]
+        )
+        users = User.objects.bulk_create([
+            User(email=f'therapist{i}@example.com', first_name=f'Name{i}', last_name='Surname',
+                 user_role='therapist', profile_completed=i != 0)
+            for i in range(12)
+        ])
+        cls.therapists = Psychotherapist.objects.bulk_create([
+            Psychotherapist(
+                user=user, birth_date=datetime.date(1980, 1, 1), gender='F', about='About',
+                working_methodology=methodologies[i % 2], education_institution='University',
+                education_start_year=2000, education_end_year=2005, experience=i, price=100 + i * 10,
+            )
+            for i, user in enumerate(users)
+        ])
+        rebuild_therapist_cards()
+
+    def setUp(self):
+        # Facet counts outlive the per-test transaction, start every test from an empty cache
+        bump_catalog_version()
+
+    async def test_list_is_paginated_with_cursors(self):
+        url = reverse('psychotherapists:therapist_list')
+        first = await self.async_client.get(url)
+        second = await self.async_client.get(url, {'cursor': first.context['page_obj'].next_cursor})
+
+        self.assertEqual(len(first.context['therapists']), 9)
+        self.assertEqual(len(second.context['therapists']), 2)
+        self.assertFalse(second.context['page_obj'].has_next())
+        names = [card.full_name for card in first.context['therapists'] + second.context['therapists']]
+        self.assertEqual(names, sorted(names))
+        self.assertEqual(len(set(names)), 11)
+
+        back = await self.async_client.get(url, {'cursor': second.context['page_obj'].previous_cursor})
+        self.assertEqual(back.context['therapists'], first.context['therapists'])
+        self.assertFalse(back.context['page_obj'].has_previous())
+
+        response = await self.async_client.get(url, {'cursor': 'not-a-cursor'})
+        self.assertEqual(response.status_code, 404)
+
+    async def test_search_cursors_keep_filters_and_relevance_order(self):
+        url = reverse('psychotherapists:therapist_search')
+        filters = {'q': 'surname', 'experience': '2'}
+        first = await self.async_client.get(url, filters)
+        self.assertEqual(first.context['query_params'], 'q=surname&experience=2')
+
+        cards = list(first.context['therapists'])
+        cursor = first.context['page_obj'].next_cursor
+        while cursor:
+            response = await self.async_client.get(url, {**filters, 'cursor': cursor})
+            cards += response.context['therapists']
+            cursor = response.context['page_obj'].next_cursor
+        self.assertEqual(sorted(card.experience for card in cards), list(range(2, 12)))
+
+        # A cursor made for other filters starts from the first page
+        response = await self.async_client.get(url, {'q': 'name', 'cursor': first.context['page_obj'].next_cursor})
+        self.assertFalse(response.context['page_obj'].has_previous())
+
+    def test_list_reads_cards_without_joins(self):
+        # Page and facet counts
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('psychotherapists:therapist_list'))
+
+        self.assertEqual(len(queries), 2)
+        self.assertFalse([query['sql'] for query in queries if 'JOIN' in query['sql']])
+        self.assertEqual(response.context['methodologies'], [('CBT', 5), ('Gestalt', 6)])
+
+        # Facet counts are cached until the catalog changes
+        self.client.force_login(User.objects.get(email='therapist1@example.com'))
+        with self.assertNumQueries(3):
+            # Session and user of the signed-in visitor, and the page
+            self.client.get(reverse('psychotherapists:therapist_list'))
+
+    def test_facets_apply_every_filter_but_their_own(self):
+        response = self.client.get(
+            reverse('psychotherapists:therapist_search'), {'methodology': 'CBT', 'experience': '5', 'price': '100-200'}
+        )
+
+        # CBT therapists have even experience 2..10 and price 120..200, Gestalt odd 1..11 and 110..210
+        facets = response.context['facets']
+        self.assertEqual(response.context['methodologies'], [('CBT', 2), ('Gestalt', 3)])
+        self.assertEqual(facets.experience, [(5, 2), (10, 0), (15, 0)])
+        self.assertEqual(facets.prices, [('0-50', 0), ('50-100', 0), ('100-200', 2), ('200+', 1)])
+        self.assertEqual(facets.total, 2)
+        self.assertEqual(len(response.context['therapists']), facets.total)
+
+    async def test_search_filters_methodology_and_experience(self):
+        response = await self.async_client.get(
+            reverse('psychotherapists:therapist_search'), {'methodology': 'CBT', 'experience': '5'}
+        )
+
+        self.assertEqual(
+            sorted(therapist.experience for therapist in response.context['therapists']), [6, 8, 10]
+        )
+
+    async def test_detail_only_shows_completed_profiles(self):
+        response = await self.async_client.get(
+            reverse('psychotherapists:therapist_detail', args=[self.therapists[1].pk])
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context['methodology'], 'Gestalt')
+
+        response = await self.async_client.get(
+            reverse('psychotherapists:therapist_detail', args=[self.therapists[0].pk])
+        )
+        self.assertEqual(response.status_code, 404)
+
+
+class TherapistCardTests(TestCase):
+    def setUp(self):
+        self.methodology = WorkingMethodology.objects.create(name='CBT')
+        self.user = User.objects.create_user(
+            email='therapist@example.com', first_name='Anna', last_name='Smith',
+            phone_number='+380000000000', user_role='therapist'
+        )
+        self.therapist = Psychotherapist.objects.create(
+            user=self.user, birth_date=datetime.date(1980, 1, 1), gender='F', about='word ' * 40,
+            working_methodology=self.methodology, education_institution='University',
+            education_start_year=2000, education_end_year=2005, experience=7, price=120,
+        )
+
+    def test_card_is_written_for_completed_profile(self):
+        card = TherapistCard.objects.get(therapist=self.therapist)
+
+        self.assertEqual((card.full_name, card.methodology_name, card.experience, card.price),
+                         ('Anna Smith', 'CBT', 7, 120))
+        self.assertEqual(len(card.excerpt.split()), TherapistCard.EXCERPT_WORDS)
+        self.assertTrue(card.thumbnail_url)
+
+    def test_card_follows_user_and_methodology_changes(self):
+        self.user.last_name = 'Brown'
+        self.user.save()
+        self.methodology.name = 'Gestalt'
+        self.methodology.save()
+
+        card = TherapistCard.objects.get(therapist=self.therapist)
+        self.assertEqual((card.full_name, card.methodology_name), ('Anna Brown', 'Gestalt'))
+
+    def test_card_is_removed_when_profile_becomes_incomplete(self):
+        self.user.phone_number = ''
+        self.user.save()
+        self.therapist.save()
+
+        self.assertFalse(TherapistCard.objects.filter(therapist=self.therapist).exists())
+
+
+class TherapistSearchTests(TestCase):
+    def create_therapist(self, first_name, last_name, methodology, about, education='University'):
+        user = User.objects.create_user(
+            email=f'{first_name.lower()}@example.com', first_name=first_name, last_name=last_name,
+            phone_number='+380000000000', user_role='therapist'
+        )
+        return Psychotherapist.objects.create(
+            user=user, birth_date=datetime.date(1980, 1, 1), gender='F', about=about,
+            working_methodology=WorkingMethodology.objects.get_or_create(name=methodology)[0],
+            education_institution=education, education_start_year=2000, education_end_year=2005,
+            experience=7, price=120,
+        )
+
+    def search(self, q):
+        response = self.client.get(reverse('psychotherapists:therapist_search'), {'q': q})
+        return [card.full_name for card in response.context['therapists']]
+
+    def setUp(self):
+        bump_catalog_version()
+        self.anna = self.create_therapist('Anna', 'Kovalenko', 'Gestalt', 'Works with anxiety and grief')
+        self.oleh = self.create_therapist('Oleh', 'Shevchenko', 'CBT', 'Trained by Anna Freud followers',
+                                          education='Kyiv University')
+
+    def test_search_matches_every_document_field_by_prefix(self):
+        self.assertEqual(self.search('koval'), ['Anna Kovalenko'])
+        self.assertEqual(self.search('gesta'), ['Anna Kovalenko'])
+        self.assertEqual(self.search('grief'), ['Anna Kovalenko'])
+        self.assertEqual(self.search('kyiv univ'), ['Oleh Shevchenko'])
+        self.assertEqual(self.search('anxiety*: ('), ['Anna Kovalenko'])
+
+    def test_name_matches_rank_above_text_matches(self):
+        self.assertEqual(self.search('anna'), ['Anna Kovalenko', 'Oleh Shevchenko'])
+
+    def test_index_follows_profile_changes(self):
+        self.assertEqual(self.search('grief'), ['Anna Kovalenko'])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.oleh.about = 'Works with grief'
+            self.oleh.save()
+        self.assertCountEqual(self.search('grief'), ['Anna Kovalenko', 'Oleh Shevchenko'])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.anna.user.phone_number = ''
+            self.anna.user.save()
+            self.anna.save()
+        self.assertEqual(self.search('grief'), ['Oleh Shevchenko'])
+
+
+@override_settings(CACHES=IN_PROCESS_CACHES)
+class CatalogPageCacheTests(TestCase):
+    def setUp(self):
+        bump_catalog_version()
+        self.user = User.objects.create_user(
+            email='therapist@example.com', first_name='Anna', last_name='Smith',
+            phone_number='+380000000000', user_role='therapist'
+        )
+        self.therapist = Psychotherapist.objects.create(
+            user=self.user, birth_date=datetime.date(1980, 1, 1), gender='F', about='About',
+            working_methodology=WorkingMethodology.objects.create(name='CBT'),
+            education_institution='University', education_start_year=2000, education_end_year=2005,
+            experience=7, price=120,
+        )
+        self.urls = [
+            reverse('psychotherapists:therapist_list'),
+            reverse('psychotherapists:therapist_search') + '?q=anna&experience=5',
+            reverse('psychotherapists:therapist_detail', args=[self.therapist.pk]),
+        ]
+
+    def test_anonymous_pages_are_served_from_cache(self):
+        for url in self.urls:
+            first = self.client.get(url)
+            with self.assertNumQueries(0):
+                second = self.client.get(url)
+            self.assertEqual(second.content, first.content)
+
+        # Same parameters in another order
+        with self.assertNumQueries(0):
+            self.client.get(reverse('psychotherapists:therapist_search') + '?experience=5&q=anna')
+
+    def test_catalog_changes_make_cached_pages_stale(self):
+        for url in self.urls:
+            self.client.get(url)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.user.phone_number = '+380111111111'
+            self.user.save(update_fields=['phone_number'])
+        self.assertContains(self.client.get(self.urls[2]), '+380111111111')
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.therapist.working_methodology.name = 'Gestalt'
+            self.therapist.working_methodology.save()
+        for url in self.urls:
+            self.assertContains(self.client.get(url), 'Gestalt')
+
+    def test_saving_fields_not_shown_keeps_cached_pages(self):
+        self.client.get(self.urls[0])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.user.survey_done = True
+            self.user.save(update_fields=['survey_done'])
+
+        with self.assertNumQueries(0):
+            self.client.get(self.urls[0])
+
+    def test_signed_in_users_get_fresh_pages(self):
+        self.client.get(self.urls[0])
+        self.client.force_login(self.user)
+
+        response = self.client.get(self.urls[0])
+        self.assertIsNotNone(response.context)
+
+
+class SharedCatalogPageCacheTests(TestCase):
+    """Runs on the configured cache, which every web process shares"""
+
+    def test_version_bumped_by_another_process_makes_pages_stale(self):
+        url = reverse('psychotherapists:therapist_list')
+        self.client.get(url)
+        self.assertIsNone(self.client.get(url).context)
+
+        # What a catalog change committed by another web process does
+        bump_catalog_version()
 
-# Create your tests here.
+        self.assertIsNotNone(self.client.get(url).context)
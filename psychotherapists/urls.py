@@ -1,12 +1,14 @@
 from django.urls import path
 from . import views
+from .catalog import cache_catalog_page
 
 app_name = 'psychotherapists'
 
 urlpatterns = [
-    path('', views.TherapistListView.as_view(), name='therapist_list'),
-    path('search/', views.TherapistSearchView.as_view(), name='therapist_search'),
-    path('<int:pk>/', views.TherapistDetailView.as_view(), name='therapist_detail'),
+    # Anonymous visitors get cached pages, see cache_catalog_page
+    path('', cache_catalog_page(views.TherapistListView.as_view()), name='therapist_list'),
+    path('search/', cache_catalog_page(views.TherapistSearchView.as_view()), name='therapist_search'),
+    path('<int:pk>/', cache_catalog_page(views.TherapistDetailView.as_view()), name='therapist_detail'),
 ] 
 
 
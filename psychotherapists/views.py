@@ -1,43 +1,76 @@
+from urllib.parse import urlencode
+
+from asgiref.sync import sync_to_async
+from django.http import Http404
 from django.shortcuts import render
-from django.views.generic import ListView, DetailView
-from django.db.models import Q
-from .models import Psychotherapist
+from django.views import View
+from .facets import aget_facet_cube, count_facets, price_range_filter
+from .models import Psychotherapist, TherapistCard
+from .pagination import CursorPaginator
+from .search import search_cards
 from users.models import User
 
 # Create your views here.
+# The catalog views are async: under ASGI their queries go through the async ORM,
+# so one worker keeps serving other requests while a page waits on the database.
 
-class TherapistListView(ListView):
-    model = Psychotherapist
+class TherapistListView(View):
     template_name = 'psychotherapists/therapist_list.html'
-    context_object_name = 'therapists'
     paginate_by = 9
+    # Query parameters that filter the list, kept in the pagination links
+    filter_params = ()
 
     def get_queryset(self):
-        return Psychotherapist.objects.filter(
-            user__profile_completed=True
-        ).select_related(
-            'user',
-            'working_methodology'
+        # Cards are precomputed from the profiles, so the page needs no joins
+        return TherapistCard.objects.all()
+
+    async def get_facets(self, filters):
+        """
+        Counts shown next to the filter options, from the cached facet counts.
+
+        Returns:
+            tuple: (list of (methodology name, count) for the dropdown, CatalogFacets)
+        """
+        experience = filters.get('experience')
+        facets = count_facets(
+            await aget_facet_cube(filters.get('q', '')),
+            methodology=filters.get('methodology'),
+            experience=int(experience) if experience else None,
+            price=filters.get('price'),
         )
+        # Offer every methodology in the catalog, also those the other filters rule out
+        counts = dict(facets.methodologies)
+        names = sorted({row[0] for row in await aget_facet_cube()})
+        return [(name, counts.get(name, 0)) for name in names], facets
+
+    def get_filters(self):
+        return {
+            param: self.request.GET[param]
+            for param in self.filter_params
+            if self.request.GET.get(param)
+        }
+
+    async def get(self, request, *args, **kwargs):
+        filters = self.get_filters()
+        query_params = urlencode(filters)
+        # Cursors are only valid for the filters they were made with
+        paginator = CursorPaginator(self.get_queryset(), self.paginate_by, scope=query_params)
+        page = await paginator.apage(request.GET.get('cursor'))
+        methodologies, facets = await self.get_facets(filters)
+        context = {
+            'therapists': page.object_list,
+            'object_list': page.object_list,
+            'page_obj': page,
+            'is_paginated': page.has_other_pages(),
+            'query_params': query_params,
+            'methodologies': methodologies,
+            'facets': facets,
+            'view': self,
+        }
+        return await sync_to_async(render)(request, self.template_name, context)
 
-    def get_context_data(self, **kwargs):
-        context = super().get_context_data(**kwargs)
-        # Get unique methodologies for the filter dropdown
-        methodologies = Psychotherapist.objects.filter(
-            user__profile_completed=True,
-            working_methodology__isnull=False
-        ).values_list(
-            'working_methodology', flat=True
-        ).distinct()
-        
-        # Filter out empty strings in Python
-        context['methodologies'] = sorted([m for m in methodologies if m])
-        return context
-
-class TherapistDetailView(DetailView):
-    model = Psychotherapist
+class TherapistDetailView(View):
     template_name = 'psychotherapists/therapist_detail.html'
-    context_object_name = 'therapist'
 
     def get_queryset(self):
         return Psychotherapist.objects.filter(
@@ -47,10 +80,17 @@ class TherapistDetailView(DetailView):
             'working_methodology'
         )
 
-    def get_context_data(self, **kwargs):
-        context = super().get_context_data(**kwargs)
-        therapist = self.get_object()
-        
+    async def get(self, request, pk, *args, **kwargs):
+        try:
+            therapist = await self.get_queryset().aget(pk=pk)
+        except Psychotherapist.DoesNotExist:
+            raise Http404("No psychotherapist found matching the query")
+
+        context = {
+            'therapist': therapist,
+            'object': therapist,
+            'view': self,
+        }
         # Add additional context data
         context.update({
             'full_name': therapist.user.get_full_name(),
@@ -65,51 +105,31 @@ class TherapistDetailView(DetailView):
             'phone': therapist.user.phone_number,
             'email': therapist.user.email,
         })
-        return context
+        return await sync_to_async(render)(request, self.template_name, context)
 
-class TherapistSearchView(ListView):
-    model = Psychotherapist
-    template_name = 'psychotherapists/therapist_list.html'
-    context_object_name = 'therapists'
-    paginate_by = 9
+class TherapistSearchView(TherapistListView):
+    filter_params = ('q', 'methodology', 'experience', 'price')
 
     def get_queryset(self):
-        queryset = Psychotherapist.objects.filter(
-            user__profile_completed=True
-        ).select_related(
-            'user',
-            'working_methodology'
-        )
-        
+        queryset = super().get_queryset()
+
         q = self.request.GET.get('q')
         methodology = self.request.GET.get('methodology')
         experience = self.request.GET.get('experience')
+        price = self.request.GET.get('price')
 
-        if q:
-            queryset = queryset.filter(
-                Q(user__first_name__icontains=q) |
-                Q(user__last_name__icontains=q) |
-                Q(working_methodology__name__icontains=q)
-            )
-        
         if methodology:
-            queryset = queryset.filter(working_methodology__name=methodology)
-        
+            queryset = queryset.filter(methodology_name=methodology)
+
         if experience:
             queryset = queryset.filter(experience__gte=int(experience))
-        
-        return queryset
 
-    def get_context_data(self, **kwargs):
-        context = super().get_context_data(**kwargs)
-        # Get unique methodologies for the filter dropdown
-        methodologies = Psychotherapist.objects.filter(
-            user__profile_completed=True,
-            working_methodology__isnull=False
-        ).values_list(
-            'working_methodology', flat=True
-        ).distinct()
-        
-        # Filter out empty strings in Python
-        context['methodologies'] = sorted([m for m in methodologies if m])
-        return context
+        price_range = price_range_filter(price) if price else None
+        if price_range is not None:
+            queryset = queryset.filter(price_range)
+
+        if q:
+            # Full-text match on name, methodology, about and education, best matches first
+            queryset = search_cards(queryset, q)
+
+        return queryset
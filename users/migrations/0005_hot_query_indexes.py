@@ -0,0 +1,21 @@
+# Generated by Django 5.2.1 on 2026-10-18 11:53
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0004_alter_user_survey_done'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='user',
+            index=models.Index(fields=['user_role', 'survey_done'], name='user_role_survey_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='user',
+            index=models.Index(fields=['profile_completed'], name='user_profile_completed_idx'),
+        ),
+    ]
@@ -66,6 +66,14 @@ class User(AbstractBaseUser):
     USERNAME_FIELD = 'email'
     REQUIRED_FIELDS = []
     
+    class Meta:
+        indexes = [
+            # Matching pool and survey lookups: filter(user_role=..., survey_done=True)
+            models.Index(fields=['user_role', 'survey_done'], name='user_role_survey_idx'),
+            # Public therapist catalog: filter(user__profile_completed=True)
+            models.Index(fields=['profile_completed'], name='user_profile_completed_idx'),
+        ]
+    
     def __str__(self):
         return f"{self.email} ({self.get_user_role_display()})"
     
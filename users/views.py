@@ -1,3 +1,6 @@
+import logging
+
+from asgiref.sync import sync_to_async
 from django.shortcuts import render, redirect, get_object_or_404
 from django.contrib import messages
 from django.utils.translation import gettext_lazy as _
@@ -11,18 +14,12 @@ from users.models import User
 from psychotherapists.models import Psychotherapist, WorkingMethodology
 from django.utils import timezone
 from django.core.exceptions import ValidationError
-from django.core.paginator import Paginator
+
+logger = logging.getLogger(__name__)
 
 class HomeView(TemplateView):
+    # Only a welcome message; therapists are listed by the catalog views
     template_name = 'home.html'
-    
-    def get_context_data(self, **kwargs):
-        context = super().get_context_data(**kwargs)
-        therapist_list = Psychotherapist.objects.all()
-        paginator = Paginator(therapist_list, 9)  # 9 therapists per page
-        page = self.request.GET.get('page')
-        context['therapists'] = paginator.get_page(page)
-        return context
 
 class CustomLoginView(LoginView):
     template_name = 'registration/login.html'
@@ -147,60 +144,58 @@ def therapist_account(request):
     return render(request, 'accounts/therapist_account.html', context)
 
 @login_required
-def client_account(request):
-    if request.user.user_role != 'client':
+async def client_account(request):
+    # Async view: every query below goes through the async ORM, so one ASGI worker
+    # can serve other requests while this one waits on the database
+    user = await request.auser()
+    if user.user_role != 'client':
         return redirect('users:therapist_account')
     
     # Handle edit mode
     if request.method == 'POST' and request.POST.get('edit_mode'):
-        request.user.profile_completed = False
-        request.user.save()
+        user.profile_completed = False
+        await user.asave()
         return redirect('users:client_account')
     
     # Set profile as completed if it's not already
-    if not request.user.profile_completed:
-        request.user.profile_completed = True
-        request.user.save()
+    if not user.profile_completed:
+        user.profile_completed = True
+        await user.asave()
     
     # Get matched therapists from database
-    from matching.models import MatchingResult
-    from psychotherapists.models import Psychotherapist
+    from matching.data_access import aload_match_page
+    from matching.jobs import ais_match_pending
     
     matched_therapists = []
-    if request.user.survey_done:
-        # Get matching results ordered by rank with therapist details
-        matching_results = MatchingResult.objects.filter(
-            client=request.user
-        ).select_related(
-            'therapist'
-        ).order_by('rank')
+    pool_size = 0
+    next_cursor = None
+    # The background worker is still computing the latest ranking
+    matches_computing = user.survey_done and await ais_match_pending(user)
+    if user.survey_done and not matches_computing:
+        # First page of the ranking with the therapist profiles joined in, the rest
+        # is loaded from matching:client_matches. pool_size is the number ranked
+        page, pool_size = await aload_match_page(user.pk)
+        next_cursor = page.next_cursor
         
-        print(f"Found {matching_results.count()} matching results")  # Debug print
-        
-        # Get therapist details
-        for result in matching_results:
-            therapist = Psychotherapist.objects.filter(
-                user=result.therapist
-            ).select_related(
-                'working_methodology'
-            ).first()
-            
-            if therapist:  # Make sure therapist profile exists
-                matched_therapists.append({
-                    'therapist': therapist,
-                    'user': result.therapist,  # Add the User object
-                    'score': result.score,
-                    'rank': result.rank,
-                    'is_best_match': result.rank == 1
-                })
-                print(f"Added match: {result.therapist.get_full_name()} with score {result.score}")  # Debug print
+        for result in page:
+            matched_therapists.append({
+                'therapist': result.therapist.therapist,
+                'user': result.therapist,  # Add the User object
+                'score': result.score,
+                'rank': result.rank,
+                'is_best_match': result.rank == 1
+            })
     
     context = {
         'matched_therapists': matched_therapists,
-        'user': request.user
+        'pool_size': pool_size,
+        'next_cursor': next_cursor,
+        'matches_computing': matches_computing,
+        'user': user
     }
-    print(f"Context: {context}")  # Debug print
-    return render(request, 'accounts/client_account.html', context)
+    logger.debug("Showing %d matched therapists to client %s", len(matched_therapists), user.pk)
+    # Rendering reads the session for messages, which is still synchronous
+    return await sync_to_async(render)(request, 'accounts/client_account.html', context)
 
 class CustomLogoutView(LogoutView):
     next_page = 'home'